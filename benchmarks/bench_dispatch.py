@@ -0,0 +1,135 @@
+"""
+Micro-benchmark: reaction dispatch through the nested role_mappings dict vs DispatchIndex.
+
+Usage: python benchmarks/bench_dispatch.py [--mappings 100000] [--lookups 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discord import PartialEmoji  # noqa: E402
+
+from emoji_index import DispatchIndex  # noqa: E402
+
+UNICODE_EMOJIS = ["👑", "👋", "🎮", "❤️", "🔥", "🎵", "📚", "🎨", "⚽", "🍕"]
+EMOJIS_PER_MESSAGE = 5
+GUILDS = 500
+
+
+def legacy_lookup(role_mappings, message_id, emoji):
+    """The lookup the reaction handlers did before the index existed."""
+    if message_id in role_mappings:
+        emoji = str(emoji)
+        emoji_mappings = role_mappings[message_id]
+        if emoji in emoji_mappings:
+            return emoji_mappings[emoji]
+    return None
+
+
+def build_mappings(count, rng):
+    role_mappings = {}
+    mapping_locations = {}
+    message_count = count // EMOJIS_PER_MESSAGE
+    for n in range(message_count):
+        message_id = 10**17 + n
+        emojis = {}
+        for i in range(EMOJIS_PER_MESSAGE):
+            if i == 0:
+                # One custom emoji per message
+                emoji = f"<:custom{n}:{10**18 + n}>"
+            else:
+                emoji = UNICODE_EMOJIS[(n + i) % len(UNICODE_EMOJIS)]
+            emojis[emoji] = 5 * 10**17 + n * EMOJIS_PER_MESSAGE + i
+        role_mappings[message_id] = emojis
+        mapping_locations[message_id] = (rng.randrange(GUILDS), 12345)
+    return role_mappings, mapping_locations
+
+
+def build_events(role_mappings, mapping_locations, count, rng):
+    """(label, [(guild_id, message_id, emoji), ...]) workloads."""
+    message_ids = list(role_mappings)
+    # A reaction storm on one menu, the case the bot has to keep up with
+    busy_ids = rng.sample(message_ids, 3)
+    hits, busy, renamed, wrong_emoji, unmapped = [], [], [], [], []
+    for _ in range(count):
+        message_id = rng.choice(busy_ids)
+        busy.append((mapping_locations[message_id][0], message_id,
+                     PartialEmoji.from_str(rng.choice(list(role_mappings[message_id])))))
+
+        message_id = rng.choice(message_ids)
+        guild_id = mapping_locations[message_id][0]
+        emoji_text = rng.choice(list(role_mappings[message_id]))
+        hits.append((guild_id, message_id, PartialEmoji.from_str(emoji_text)))
+
+        custom = next(iter(role_mappings[message_id]))
+        emoji_id = int(custom.rsplit(":", 1)[1][:-1])
+        renamed.append((guild_id, message_id, PartialEmoji(name="renamed", id=emoji_id)))
+
+        wrong_emoji.append((guild_id, message_id, PartialEmoji(name="🦆")))
+        unmapped.append((guild_id, rng.randrange(10**18), PartialEmoji(name="👍")))
+    return [
+        ("hit", hits),
+        ("hit, one busy menu", busy),
+        ("renamed custom emoji", renamed),
+        ("mapped message, other emoji", wrong_emoji),
+        ("unmapped message", unmapped),
+    ]
+
+
+def measure_size(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mappings", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    (role_mappings, mapping_locations), nested_size = measure_size(lambda: build_mappings(args.mappings, rng))
+    index, index_size = measure_size(lambda: _build_index(role_mappings, mapping_locations))
+    workloads = build_events(role_mappings, mapping_locations, args.lookups, rng)
+
+    print(f"{args.mappings} mappings in {len(role_mappings)} messages, {args.lookups} lookups per workload")
+    print(f"nested dict: {nested_size / 1e6:.1f} MB, dispatch index: {index_size / 1e6:.1f} MB "
+          f"(index built in {_time_build(role_mappings, mapping_locations) * 1000:.0f} ms)")
+    print()
+    print(f"{'workload':<30} {'nested ns/op':>13} {'index ns/op':>12} {'nested hits':>12} {'index hits':>11}")
+
+    for label, events in workloads:
+        legacy_hits = sum(legacy_lookup(role_mappings, m, e) is not None for _, m, e in events)
+        index_hits = sum(index.lookup(g, m, e) is not None for g, m, e in events)
+
+        legacy_time = min(timeit.repeat(
+            lambda: [legacy_lookup(role_mappings, m, e) for _, m, e in events], number=1, repeat=5
+        ))
+        index_time = min(timeit.repeat(
+            lambda: [index.lookup(g, m, e) for g, m, e in events], number=1, repeat=5
+        ))
+        print(f"{label:<30} {legacy_time / len(events) * 1e9:>13.0f} {index_time / len(events) * 1e9:>12.0f} "
+              f"{legacy_hits:>12} {index_hits:>11}")
+
+
+def _build_index(role_mappings, mapping_locations):
+    index = DispatchIndex()
+    index.rebuild(role_mappings, mapping_locations)
+    return index
+
+
+def _time_build(role_mappings, mapping_locations):
+    return min(timeit.repeat(lambda: _build_index(role_mappings, mapping_locations), number=1, repeat=3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compare the Flask keep-alive thread with the in-loop async health server.
+
+Each server runs in its own process next to an offline discord.Client (nothing
+connects to Discord) and an event loop that is busy for ``--loop-busy`` of the
+time, like a bot handling events. The benchmark then sends requests to ``/`` and
+``/health`` over fresh connections (like an uptime pinger) and reports latency
+percentiles and the server process's RSS before and after.
+
+Usage: python benchmarks/bench_health.py [--requests 500] [--loop-busy 0.2]
+"""
+import argparse
+import asyncio
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+async def busy_loop(busy):
+    # Alternate between blocking the loop and yielding, 10 ms per cycle
+    while True:
+        started = time.perf_counter()
+        while time.perf_counter() - started < 0.01 * busy:
+            pass
+        await asyncio.sleep(0.01 * (1 - busy))
+
+
+def serve(kind, port, busy):
+    import discord
+
+    async def main():
+        bot = discord.Client(intents=discord.Intents.none())
+        if kind == "flask":
+            os.environ["HEALTH_PORT"] = str(port)
+            from keep_alive import keep_alive
+            keep_alive(bot)
+        else:
+            from health_server import HealthServer
+            await HealthServer(bot, port=port).start()
+        print("serving", flush=True)
+        if busy > 0:
+            await busy_loop(busy)
+        else:
+            await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"server on port {port} didn't come up")
+
+
+def measure(port, path, count):
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status != 200:
+            raise RuntimeError(f"GET {path} returned {response.status}")
+    latencies.sort()
+    return {
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+def run(kind, port, count, busy):
+    proc = subprocess.Popen(
+        [sys.executable, __file__, "--serve", kind, "--port", str(port), "--loop-busy", str(busy)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_up(port)
+        rss_before = process_rss_mb(proc.pid)
+        results = {path: measure(port, path, count) for path in ("/", "/health")}
+        return rss_before, process_rss_mb(proc.pid), results
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--loop-busy", type=float, default=0.2, help="share of time the bot's loop is busy (0-0.9)")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--serve", choices=("flask", "async"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.loop_busy)
+        return
+
+    busy = min(max(args.loop_busy, 0.0), 0.9)
+    print(f"{args.requests} requests per endpoint, event loop busy {busy:.0%} of the time")
+    print(f"{'server':<7} {'path':<8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'RSS idle MB':>12} {'RSS after MB':>13}")
+    for offset, kind in enumerate(("flask", "async")):
+        rss_before, rss_after, results = run(kind, args.port + offset, args.requests, busy)
+        for path, stats in results.items():
+            print(
+                f"{kind:<7} {path:<8} {stats['p50']:>7.2f} {stats['p95']:>7.2f} {stats['p99']:>7.2f}"
+                f" {rss_before:>12.1f} {rss_after:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Offline load test: the real bot against a fake Discord under a reaction storm.
+
+Starts benchmarks/fake_discord.py, fills a temporary mapping store with the same
+synthetic role messages, points discord.py's REST base URL and gateway at the
+fake and runs rolebot's bot through login, ready and (in the full profile)
+member chunking. The fake then sends a storm of reaction add/remove events and
+serves the resulting member fetches and role edits with simulated latency and
+429s. Nothing connects to Discord, no token is needed.
+
+Reports events/sec handled, reaction-to-role latency percentiles (from the
+event being sent until the role edit covering it went through), REST calls per
+event, 429s, whether every member ended up with the right roles, and peak RSS.
+
+Usage: python benchmarks/bench_load.py [--events 5000] [--rate 0] [--profile full|lean]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_discord  # noqa: E402
+from fake_discord import World  # noqa: E402
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def start_fake(args):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_discord.py"), "--port", str(args.port)]
+        + World.cli_arguments(args) + fake_discord.cli_arguments(args),
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = proc.stdout.readline()
+    if "listening" not in line:
+        proc.kill()
+        sys.exit("fake_discord.py failed to start")
+    return proc
+
+
+def seed_store(world, path):
+    from mapping_store import open_store
+
+    store = open_store("sqlite", os.path.join(os.path.dirname(path), "role_mappings.json"), path)
+    try:
+        for guild in world.guilds:
+            for message_id, emoji_roles in guild["role_messages"]:
+                store.save_message(guild["id"], guild["channel_id"], message_id, emoji_roles)
+    finally:
+        store.close()
+
+
+async def run(args, port):
+    import aiohttp
+    import discord
+    import yarl
+    from discord.gateway import DiscordWebSocket
+
+    import rolebot
+
+    discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v10"
+    if args.rest_workers:
+        rolebot.role_queue.worker_args += ["--api-base", discord.http.Route.BASE]
+    DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f"ws://127.0.0.1:{port}/gateway")
+    bot = rolebot.bot
+
+    received = []
+
+    async def on_raw_reaction(payload):
+        received.append(time.monotonic())
+
+    bot.add_listener(on_raw_reaction, "on_raw_reaction_add")
+    bot.add_listener(on_raw_reaction, "on_raw_reaction_remove")
+
+    started = time.monotonic()
+    bot_task = asyncio.get_running_loop().create_task(bot.start("fake-token"))
+    try:
+        ready_task = asyncio.get_running_loop().create_task(bot.wait_until_ready())
+        await asyncio.wait((ready_task, bot_task), timeout=args.timeout, return_when=asyncio.FIRST_COMPLETED)
+        if bot_task.done():
+            ready_task.cancel()
+            bot_task.result()
+            raise RuntimeError("the bot stopped before becoming ready")
+        if not ready_task.done():
+            ready_task.cancel()
+            raise TimeoutError(f"bot not ready after {args.timeout}s")
+        ready_after = time.monotonic() - started
+
+        storm = {
+            "events": args.events, "rate": args.rate, "user_skew": args.user_skew,
+            "message_skew": args.message_skew, "burst": args.burst, "toggle": args.toggle,
+            "noise": args.noise, "seed": args.seed + 1,
+        }
+        async with aiohttp.ClientSession(f"http://127.0.0.1:{port}") as session:
+            async with session.post("/_bench/storm", json=storm) as response:
+                response.raise_for_status()
+            deadline = time.monotonic() + args.timeout
+            while True:
+                await asyncio.sleep(0.5)
+                async with session.get("/_bench/results", params={"settle": str(args.settle)}) as response:
+                    results = await response.json()
+                if results["state"] == "done":
+                    break
+                if results["state"] == "failed":
+                    raise RuntimeError(f"storm failed: {results['error']}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"storm not finished after {args.timeout}s")
+        stats = {
+            "ready_after": ready_after,
+            "queue": rolebot.role_queue.stats.as_dict(),
+            "resolver": rolebot.member_resolver.stats.as_dict(),
+            "max_loop_lag": rolebot.loop_monitor.max_lag,
+            "worker_rss": [
+                peak_rss_mb(connection.proc.pid) for connection in getattr(rolebot.role_queue, "_connections", ())
+                if connection.proc is not None
+            ],
+        }
+    finally:
+        await bot.close()
+        await asyncio.gather(bot_task, return_exceptions=True)
+        rolebot.close_mapping_store()
+    return results, received, stats
+
+
+def report(args, results, received, stats):
+    latencies = [latency * 1000 for latency in results["latencies"]]
+    events = results["events_sent"]
+    rest_calls = sum(results["rest_calls"].values())
+    handling = received[-1] - received[0] if len(received) > 1 else float("nan")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    workers = f", {args.rest_workers} REST workers" if args.rest_workers else ""
+    print(f"Profile {args.profile}{workers}, {args.guilds} guilds x {args.messages} menus x {args.emojis} roles, "
+          f"{args.users} users, ready after {stats['ready_after']:.2f}s")
+    print(f"Events:          {events} sent ({results['role_events']} on role menus), {len(received)} received")
+    print(f"Throughput:      {len(received) / handling:,.0f} events/s handled "
+          f"({events / results['send_seconds']:,.0f} events/s sent)")
+    print(f"Latency (ms):    p50 {percentile(latencies, 0.5):.0f}  p99 {percentile(latencies, 0.99):.0f}  "
+          f"max {max(latencies, default=float('nan')):.0f}  mean {statistics.fmean(latencies) if latencies else float('nan'):.0f}"
+          f"  ({len(latencies)} measured, {results['uncovered_events']} without an edit, e.g. undone before it was applied)")
+    print(f"REST:            {rest_calls} calls, {rest_calls / max(results['role_events'], 1):.3f} per role event, "
+          f"{results['rate_limited']} answered 429")
+    for route, count in sorted(results["rest_calls"].items()):
+        print(f"                 {count:>7}  {route}")
+    print(f"Correctness:     {results['role_mismatches']} member/role pairs wrong at the end")
+    print(f"Role queue:      {stats['queue']}")
+    print(f"Member resolver: {stats['resolver']}")
+    print(f"Max loop lag:    {stats['max_loop_lag'] * 1000:.0f} ms")
+    print(f"Peak RSS:        {peak_rss:.1f} MB" + "".join(
+        f", worker {index} {rss:.1f} MB" for index, rss in enumerate(stats["worker_rss"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profile", choices=("full", "lean"), default="full")
+    parser.add_argument("--rest-workers", type=int, default=0, help="apply role changes in this many worker processes")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=0, help="events per second to send (0 = as fast as possible)")
+    parser.add_argument("--user-skew", type=float, default=1.1, help="Zipf exponent of user activity")
+    parser.add_argument("--message-skew", type=float, default=1.0, help="Zipf exponent of menu popularity")
+    parser.add_argument("--burst", type=float, default=0.3, help="share of users clicking several roles at once")
+    parser.add_argument("--toggle", type=float, default=0.1, help="share of reactions undone right away")
+    parser.add_argument("--noise", type=float, default=0.2, help="share of events on messages the bot ignores")
+    parser.add_argument("--settle", type=float, default=5.0, help="seconds without REST calls before the run counts as done")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--port", type=int, default=18300)
+    World.add_arguments(parser)
+    fake_discord.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Run in a scratch directory so the real mapping store, role_mappings.json and .env are left alone
+    workdir = tempfile.mkdtemp(prefix="rolebot-load-")
+    os.chdir(workdir)
+    db_path = os.path.join(workdir, "role_mappings.db")
+    os.environ.update({
+        "BOT_PROFILE": args.profile,
+        "MAPPINGS_BACKEND": "sqlite",
+        "MAPPINGS_DB": db_path,
+        "HEALTH_SERVER": "0",
+        "RECONCILE_ON_STARTUP": "0",
+        "REST_WORKERS": str(args.rest_workers),
+        "DISCORD_TOKEN": "fake-token",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+    for name in ("SHARD_COUNT", "SHARD_IDS"):
+        os.environ.pop(name, None)
+
+    seed_store(World.from_args(args), db_path)
+    fake = start_fake(args)
+    try:
+        results, received, stats = asyncio.run(run(args, args.port))
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+    report(args, results, received, stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare RSS and time-to-ready of the "full" and "lean" bot profiles.
+
+Starts rolebot.py once per profile with the DISCORD_TOKEN from the environment
+(or .env), waits for the "Ready after" log line, lets the process settle and then
+samples its RSS from /proc. This connects to Discord for real, so use a test bot
+or expect it to briefly handle reactions while it runs.
+
+Usage: python benchmarks/bench_profiles.py [--runs 3] [--settle 30]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_RE = re.compile(r"Ready after ([\d.]+)s, RSS ([\d.]+) MB")
+
+
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def run_once(profile, settle, timeout):
+    env = dict(os.environ, BOT_PROFILE=profile, PYTHONUNBUFFERED="1")
+    proc = subprocess.Popen(
+        [sys.executable, "rolebot.py"], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    try:
+        deadline = time.monotonic() + timeout
+        for line in proc.stdout:
+            match = READY_RE.search(line)
+            if match:
+                ready_seconds, ready_rss = float(match.group(1)), float(match.group(2))
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{profile} profile not ready after {timeout}s")
+        else:
+            raise RuntimeError(f"rolebot.py exited before becoming ready ({profile} profile)")
+        time.sleep(settle)
+        return ready_seconds, ready_rss, process_rss_mb(proc.pid)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--settle", type=float, default=30.0, help="seconds to wait after ready before sampling RSS")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    if not os.getenv("DISCORD_TOKEN") and not os.path.exists(os.path.join(ROOT, ".env")):
+        sys.exit("DISCORD_TOKEN is not set and there is no .env file")
+
+    print(f"{'profile':<8} {'run':>3} {'ready (s)':>10} {'RSS at ready (MB)':>18} {'RSS settled (MB)':>17}")
+    for profile in ("full", "lean"):
+        for run in range(1, args.runs + 1):
+            ready_seconds, ready_rss, settled_rss = run_once(profile, args.settle, args.timeout)
+            print(f"{profile:<8} {run:>3} {ready_seconds:>10.1f} {ready_rss:>18.1f} {settled_rss:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
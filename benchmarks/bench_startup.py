@@ -0,0 +1,106 @@
+"""
+Measure how long the bot takes to start: imports, login and ready.
+
+The import phase runs offline: each run imports rolebot.py in a fresh interpreter
+(as each health server mode) and reports the time and whether Flask/requests got
+loaded. With --connect, rolebot.py is also started for real with the
+DISCORD_TOKEN from the environment (or .env) and the "Logged in after" and
+"Ready after" log lines give time-to-login and time-to-ready.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--connect]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGIN_RE = re.compile(r"Logged in after ([\d.]+)s \(imports ([\d.]+)s\)")
+READY_RE = re.compile(r"Ready after ([\d.]+)s")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import rolebot
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "seconds": elapsed,
+    "modules": len(sys.modules),
+    "flask": "flask" in sys.modules,
+    "requests": "requests" in sys.modules,
+}), file=sys.stderr)
+"""
+
+
+def measure_import(health_server):
+    env = dict(os.environ, HEALTH_SERVER=health_server, LOG_LEVEL="WARNING")
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True,
+    ).stderr
+    # The bot logs to stdout, the result is the last line on stderr
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_connect(timeout):
+    env = dict(os.environ, PYTHONUNBUFFERED="1", RECONCILE_ON_STARTUP="0")
+    proc = subprocess.Popen(
+        [sys.executable, "rolebot.py"], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    login = imports = None
+    try:
+        deadline = time.monotonic() + timeout
+        for line in proc.stdout:
+            match = LOGIN_RE.search(line)
+            if match:
+                login, imports = float(match.group(1)), float(match.group(2))
+            match = READY_RE.search(line)
+            if match:
+                return imports, login, float(match.group(1))
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"bot not ready after {timeout}s")
+        raise RuntimeError("rolebot.py exited before becoming ready")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--connect", action="store_true", help="also log in to Discord (needs DISCORD_TOKEN)")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    print(f"{'health server':<14} {'import ms (median)':>19} {'min':>7} {'modules':>8}  extra imports")
+    for mode in ("0", "async", "flask"):
+        results = [measure_import(mode) for _ in range(args.runs)]
+        times = [result["seconds"] * 1000 for result in results]
+        extra = [name for name in ("flask", "requests") if results[-1][name]]
+        print(
+            f"{mode:<14} {statistics.median(times):>19.1f} {min(times):>7.1f} {results[-1]['modules']:>8}"
+            f"  {', '.join(extra) or '-'}"
+        )
+
+    if not args.connect:
+        return
+    if not os.getenv("DISCORD_TOKEN") and not os.path.exists(os.path.join(ROOT, ".env")):
+        sys.exit("DISCORD_TOKEN is not set and there is no .env file")
+
+    print()
+    print(f"{'run':>3} {'imports (s)':>12} {'login (s)':>10} {'ready (s)':>10}")
+    for run in range(1, args.runs + 1):
+        imports, login, ready = measure_connect(args.timeout)
+        print(f"{run:>3} {imports:>12.2f} {login:>10.2f} {ready:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+"""
+A local stand-in for the parts of Discord the bot talks to, for offline load tests.
+
+Serves the REST routes the bot uses (login, application info, gateway URL,
+member fetch, member edit and single role add/remove) with simulated latency
+and per-route rate limit buckets that answer 429 the way Discord does, and a
+gateway websocket that goes through HELLO/IDENTIFY/READY/GUILD_CREATE, answers
+member chunk requests and then replays a synthetic storm of reaction events.
+
+The fake records when each reaction event was sent and when the member edit
+covering it arrived, which gives reaction-to-role latency without touching the
+bot. It's started by bench_load.py; run it directly only to debug it:
+
+    python benchmarks/fake_discord.py --port 18300
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+from aiohttp import WSMsgType, web
+
+UNICODE_EMOJIS = ["👍", "🎮", "🎵", "📚", "🎨", "⚽", "🍕", "🔥", "❤️", "👑", "🎲", "🚀", "🌙", "🐍", "🍀"]
+CUSTOM_EMOJI_ID_BASE = 900_000_000_000_000_000
+GUILD_MEMBERS_INTENT = 1 << 1
+
+
+def snowflake(n):
+    """A valid-looking snowflake; the timestamp bits vary so guilds spread across shards."""
+    return ((1_000_000_000 + n * 7919) << 22) | (n & 0xFFF)
+
+
+class World:
+    """
+    The synthetic guilds, role messages and users both sides agree on.
+
+    Built deterministically from the same arguments in the fake and in the
+    benchmark, so the bot's mapping store and the fake's reaction storm match.
+    """
+
+    def __init__(self, guilds=4, messages=5, emojis=10, users=2000, seed=1):
+        rng = random.Random(seed)
+        counter = iter(range(1, 10**9))
+        self.bot_user_id = snowflake(next(counter))
+        self.user_ids = [snowflake(next(counter)) for _ in range(users)]
+        self.guilds = []
+        for _ in range(guilds):
+            guild_id = snowflake(next(counter))
+            channel_id = snowflake(next(counter))
+            role_messages = []
+            role_ids = []
+            for _ in range(messages):
+                message_id = snowflake(next(counter))
+                emoji_roles = {}
+                for index in range(min(emojis, 20)):
+                    role_id = snowflake(next(counter))
+                    role_ids.append(role_id)
+                    if index < len(UNICODE_EMOJIS) and rng.random() < 0.7:
+                        emoji_roles[UNICODE_EMOJIS[index]] = role_id
+                    else:
+                        emoji_id = CUSTOM_EMOJI_ID_BASE + next(counter)
+                        emoji_roles[f"<:custom{index}:{emoji_id}>"] = role_id
+                role_messages.append((message_id, emoji_roles))
+            # Plain messages people also react to, the bot has to ignore these
+            other_messages = [snowflake(next(counter)) for _ in range(messages)]
+            self.guilds.append({
+                "id": guild_id,
+                "channel_id": channel_id,
+                "role_ids": role_ids,
+                "role_messages": role_messages,
+                "other_messages": other_messages,
+            })
+
+    @staticmethod
+    def add_arguments(parser):
+        group = parser.add_argument_group("world")
+        group.add_argument("--guilds", type=int, default=4)
+        group.add_argument("--messages", type=int, default=5, help="role messages per guild")
+        group.add_argument("--emojis", type=int, default=10, help="emoji/role pairs per message (max 20)")
+        group.add_argument("--users", type=int, default=2000, help="members, shared by all guilds")
+        group.add_argument("--seed", type=int, default=1)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.guilds, args.messages, args.emojis, args.users, args.seed)
+
+    @staticmethod
+    def cli_arguments(args):
+        return [
+            "--guilds", str(args.guilds), "--messages", str(args.messages), "--emojis", str(args.emojis),
+            "--users", str(args.users), "--seed", str(args.seed),
+        ]
+
+
+def json_response(data, status=200, headers=None):
+    # discord.py only decodes bodies whose content type is exactly application/json, without a charset
+    return web.Response(body=json.dumps(data).encode(), status=status, headers=headers, content_type="application/json")
+
+
+def emoji_payload(emoji):
+    if emoji.startswith("<:"):
+        name, emoji_id = emoji[2:-1].split(":")
+        return {"id": emoji_id, "name": name, "animated": False}
+    return {"id": None, "name": emoji}
+
+
+def user_payload(user_id, bot=False):
+    return {
+        "id": str(user_id), "username": f"user{user_id % 100000}", "discriminator": "0",
+        "global_name": None, "avatar": None, "bot": bot, "public_flags": 0,
+    }
+
+
+class RateLimitBucket:
+    """A fixed-window bucket of ``limit`` requests per ``window`` seconds."""
+
+    def __init__(self, name, limit, window):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.reset_at = 0.0
+        self.remaining = limit
+
+    def take(self):
+        """Returns ``(allowed, headers)`` for one request."""
+        now = time.time()
+        if now >= self.reset_at:
+            self.reset_at = now + self.window
+            self.remaining = self.limit
+        reset_after = max(self.reset_at - now, 0.001)
+        allowed = self.remaining > 0
+        if allowed:
+            self.remaining -= 1
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": f"{self.reset_at:.3f}",
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+            "X-RateLimit-Bucket": self.name,
+        }
+        return allowed, headers, reset_after
+
+
+class FakeDiscord:
+    def __init__(self, world, rest_latency=0.05, rest_jitter=0.5, route_limit=50, route_window=1.0,
+                 global_limit=50, spurious_429=0.0):
+        self.world = world
+        self.rest_latency = rest_latency
+        self.rest_jitter = rest_jitter
+        self.route_limit = route_limit
+        self.route_window = route_window
+        self.global_bucket = RateLimitBucket("global", global_limit, 1.0) if global_limit else None
+        self.spurious_429 = spurious_429
+        self.rng = random.Random(world.user_ids[0])
+        self.guilds = {guild["id"]: guild for guild in world.guilds}
+        # channel_id -> role message IDs
+        self.messages = {
+            guild["channel_id"]: {message_id for message_id, _ in guild["role_messages"]} for guild in world.guilds
+        }
+        # (guild_id, user_id) -> role IDs the member has on the fake's side
+        self.member_roles = {}
+        self.buckets = {}
+        self.ws = None
+        self.intents = 0
+        self.sequence = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.rest_calls = {}
+        self.rate_limited = 0
+        self.pending_events = {}  # (guild_id, user_id) -> [(send time, role_id)] not yet covered by an edit
+        self.latencies = []
+        self.events_sent = 0
+        self.role_events = 0
+        self.storm_started = None
+        self.storm_sent = None
+        self.last_rest = time.time()
+        self.expected = {}  # (guild_id, user_id, role_id) -> should have the role
+        self.storm_task = None
+
+    # REST
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/gateway", self.gateway_ws)
+        app.router.add_get("/api/v10/users/@me", self.get_me)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self.get_application)
+        app.router.add_get("/api/v10/gateway", self.get_gateway)
+        app.router.add_get("/api/v10/gateway/bot", self.get_gateway)
+        app.router.add_get("/api/v10/channels/{channel_id}/messages/{message_id}", self.get_message)
+        app.router.add_get("/api/v10/guilds/{guild_id}/members/{user_id}", self.get_member)
+        app.router.add_patch("/api/v10/guilds/{guild_id}/members/{user_id}", self.edit_member)
+        app.router.add_put("/api/v10/guilds/{guild_id}/members/{user_id}/roles/{role_id}", self.edit_member_role)
+        app.router.add_delete("/api/v10/guilds/{guild_id}/members/{user_id}/roles/{role_id}", self.edit_member_role)
+        app.router.add_post("/_bench/storm", self.start_storm)
+        app.router.add_get("/_bench/results", self.results)
+        return app
+
+    async def simulate(self, request, route):
+        """Latency and rate limiting shared by the REST routes. Returns a 429 response or the headers to send."""
+        self.last_rest = time.time()
+        self.rest_calls[route] = self.rest_calls.get(route, 0) + 1
+        # Log-normal latency around the configured median
+        await asyncio.sleep(self.rest_latency * math.exp(self.rng.gauss(0, self.rest_jitter)))
+
+        if self.global_bucket is not None:
+            allowed, _, reset_after = self.global_bucket.take()
+            if not allowed:
+                return self.too_many_requests(reset_after, {"X-RateLimit-Global": "true"}, is_global=True)
+
+        key = (route, request.match_info.get("guild_id"))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = RateLimitBucket(f"{abs(hash(route)):x}", self.route_limit, self.route_window)
+        allowed, headers, reset_after = bucket.take()
+        if not allowed:
+            return self.too_many_requests(reset_after, headers)
+        if self.spurious_429 and self.rng.random() < self.spurious_429:
+            # A shared or sub rate limit the headers didn't announce
+            return self.too_many_requests(0.5, dict(headers, **{"X-RateLimit-Scope": "shared"}))
+        return headers
+
+    def too_many_requests(self, retry_after, headers, is_global=False):
+        self.rate_limited += 1
+        body = {"message": "You are being rate limited.", "retry_after": round(retry_after, 3), "global": is_global}
+        # Discord's 429s come through its proxy; discord.py treats a 429 without Via as a Cloudflare ban
+        headers = dict(headers, Via="1.1 google", **{"Retry-After": str(math.ceil(retry_after))})
+        return json_response(body, status=429, headers=headers)
+
+    def member_payload(self, guild_id, user_id):
+        return {
+            "user": user_payload(user_id), "roles": [str(role_id) for role_id in self.member_roles.get((guild_id, user_id), ())],
+            "joined_at": "2023-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0,
+            "nick": None, "avatar": None, "pending": False, "premium_since": None,
+            "communication_disabled_until": None,
+        }
+
+    async def get_me(self, request):
+        return json_response(user_payload(self.world.bot_user_id, bot=True))
+
+    async def get_application(self, request):
+        return json_response({
+            "id": str(self.world.bot_user_id), "name": "RoleBot", "description": "", "icon": None,
+            "bot_public": True, "bot_require_code_grant": False, "verify_key": "0" * 64,
+            "owner": user_payload(1), "flags": 0,
+        })
+
+    async def get_gateway(self, request):
+        url = f"ws://{request.host}/gateway"
+        return json_response({"url": url, "shards": 1, "session_start_limit": {
+            "total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}})
+
+    async def get_message(self, request):
+        # Only what the bot's startup sweep checks: whether the role message still exists
+        result = await self.simulate(request, "GET /channels/{channel_id}/messages/{message_id}")
+        if isinstance(result, web.Response):
+            return result
+        channel_id, message_id = int(request.match_info["channel_id"]), int(request.match_info["message_id"])
+        if message_id not in self.messages.get(channel_id, ()):
+            return json_response({"message": "Unknown Message", "code": 10008}, status=404, headers=result)
+        return json_response({
+            "id": str(message_id), "channel_id": str(channel_id), "type": 0, "content": "",
+            "author": user_payload(self.world.bot_user_id, bot=True), "timestamp": "2023-01-01T00:00:00+00:00",
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [],
+            "attachments": [], "embeds": [], "pinned": False, "reactions": [],
+        }, headers=result)
+
+    async def get_member(self, request):
+        result = await self.simulate(request, "GET /guilds/{guild_id}/members/{user_id}")
+        if isinstance(result, web.Response):
+            return result
+        guild_id, user_id = int(request.match_info["guild_id"]), int(request.match_info["user_id"])
+        return json_response(self.member_payload(guild_id, user_id), headers=result)
+
+    async def edit_member(self, request):
+        arrived = time.time()
+        result = await self.simulate(request, "PATCH /guilds/{guild_id}/members/{user_id}")
+        if isinstance(result, web.Response):
+            return result
+        guild_id, user_id = int(request.match_info["guild_id"]), int(request.match_info["user_id"])
+        body = await request.json()
+        if "roles" in body:
+            self.member_roles[(guild_id, user_id)] = {int(role_id) for role_id in body["roles"]}
+        await self.member_updated(guild_id, user_id, arrived)
+        return json_response(self.member_payload(guild_id, user_id), headers=result)
+
+    async def edit_member_role(self, request):
+        arrived = time.time()
+        result = await self.simulate(request, f"{request.method} /guilds/{{guild_id}}/members/{{user_id}}/roles/{{role_id}}")
+        if isinstance(result, web.Response):
+            return result
+        guild_id, user_id = int(request.match_info["guild_id"]), int(request.match_info["user_id"])
+        role_id = int(request.match_info["role_id"])
+        roles = self.member_roles.setdefault((guild_id, user_id), set())
+        if request.method == "PUT":
+            roles.add(role_id)
+        else:
+            roles.discard(role_id)
+        await self.member_updated(guild_id, user_id, arrived, role_id)
+        return web.Response(status=204, headers=result)
+
+    async def member_updated(self, guild_id, user_id, arrived, role_id=None):
+        """Record the latency of the reactions an edit covers and tell the bot like Discord would."""
+        # Every reaction the member made (on ``role_id``, for single role edits)
+        # before the edit was sent is covered by it
+        done = time.time()
+        pending = self.pending_events.pop((guild_id, user_id), [])
+        covered = [(sent, role) for sent, role in pending if sent <= arrived and role_id in (None, role)]
+        self.latencies.extend(done - sent for sent, _ in covered)
+        rest = [event for event in pending if event not in covered]
+        if rest:
+            self.pending_events[(guild_id, user_id)] = rest
+        if self.ws is not None and self.intents & GUILD_MEMBERS_INTENT:
+            # Discord tells bots with the members intent about the change, which keeps their member cache current
+            update = self.member_payload(guild_id, user_id)
+            update["guild_id"] = str(guild_id)
+            await self.send(0, update, "GUILD_MEMBER_UPDATE")
+
+    # Gateway
+
+    async def send(self, op, data, event=None):
+        payload = {"op": op, "d": data, "s": None, "t": event}
+        if op == 0:
+            self.sequence += 1
+            payload["s"] = self.sequence
+        await self.ws.send_str(json.dumps(payload))
+
+    def guild_payload(self, guild):
+        guild_id = guild["id"]
+        roles = [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+                  "hoist": False, "managed": False, "mentionable": False, "flags": 0}]
+        roles += [
+            {"id": str(role_id), "name": f"role{index}", "permissions": "0", "position": index + 1, "color": 0,
+             "hoist": False, "managed": False, "mentionable": False, "flags": 0}
+            for index, role_id in enumerate(guild["role_ids"])
+        ]
+        bot_member = self.member_payload(guild_id, self.world.bot_user_id)
+        bot_member["user"] = user_payload(self.world.bot_user_id, bot=True)
+        return {
+            "id": str(guild_id), "name": f"guild{guild_id % 1000}", "icon": None, "owner_id": "1",
+            "unavailable": False, "member_count": len(self.world.user_ids) + 1, "large": True,
+            "roles": roles, "emojis": [], "stickers": [], "features": [], "threads": [],
+            "channels": [{"id": str(guild["channel_id"]), "type": 0, "name": "roles", "position": 0,
+                          "permission_overwrites": [], "guild_id": str(guild_id)}],
+            "members": [bot_member], "presences": [], "voice_states": [],
+            "stage_instances": [], "guild_scheduled_events": [], "verification_level": 0,
+            "default_message_notifications": 0, "explicit_content_filter": 0, "mfa_level": 0,
+            "premium_tier": 0, "nsfw_level": 0, "preferred_locale": "en-US", "system_channel_flags": 0,
+            "joined_at": "2023-01-01T00:00:00+00:00",
+        }
+
+    async def gateway_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.ws = ws
+        await self.send(10, {"heartbeat_interval": 41250})
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(msg.data)
+            op = payload["op"]
+            if op == 1:
+                asyncio.get_running_loop().create_task(self.heartbeat_ack())
+            elif op == 2:
+                self.intents = payload["d"].get("intents", 0)
+                await self.identify(request)
+            elif op == 8:
+                await self.send_member_chunks(payload["d"])
+        self.ws = None
+        return ws
+
+    async def heartbeat_ack(self):
+        # An instant ACK can overtake discord.py recording when it sent the heartbeat,
+        # which it then reports as a huge gateway latency
+        await asyncio.sleep(0.05)
+        if self.ws is not None:
+            await self.send(11, None)
+
+    async def identify(self, request):
+        await self.send(0, {
+            "v": 10, "user": user_payload(self.world.bot_user_id, bot=True),
+            "guilds": [{"id": str(guild["id"]), "unavailable": True} for guild in self.world.guilds],
+            "session_id": "fake-session", "resume_gateway_url": f"ws://{request.host}/gateway",
+            "shard": [0, 1], "application": {"id": str(self.world.bot_user_id), "flags": 0},
+        }, "READY")
+        for guild in self.world.guilds:
+            await self.send(0, self.guild_payload(guild), "GUILD_CREATE")
+
+    async def send_member_chunks(self, data):
+        guild_id = int(data["guild_id"])
+        members = [self.member_payload(guild_id, user_id) for user_id in self.world.user_ids]
+        chunks = [members[i:i + 1000] for i in range(0, len(members), 1000)] or [[]]
+        for index, chunk in enumerate(chunks):
+            await self.send(0, {
+                "guild_id": str(guild_id), "members": chunk, "chunk_index": index,
+                "chunk_count": len(chunks), "nonce": data.get("nonce"),
+            }, "GUILD_MEMBERS_CHUNK")
+
+    # Storm
+
+    async def start_storm(self, request):
+        options = await request.json()
+        if self.ws is None:
+            return json_response({"error": "no gateway connection"}, status=409)
+        self.reset_stats()
+        self.storm_task = asyncio.get_running_loop().create_task(self.storm(**options))
+        return json_response({"started": True})
+
+    async def storm(self, events=5000, rate=0, user_skew=1.1, message_skew=1.0, burst=0.3, toggle=0.1,
+                    noise=0.2, seed=2):
+        """
+        Send ``events`` reaction events, ``rate`` per second (0 = as fast as possible).
+
+        Users and role messages are picked from Zipf-like distributions (a few
+        very active users, a few popular menus). A user then reacts with one
+        emoji, or with probability ``burst`` several in a row, and with
+        probability ``toggle`` changes their mind right away. A reaction that
+        is already there is removed instead. ``noise`` is the share of events
+        on messages the bot doesn't handle.
+        """
+        rng = random.Random(seed)
+        world = self.world
+        user_weights = [1 / (rank + 1) ** user_skew for rank in range(len(world.user_ids))]
+        menus = [(guild, message_id, emoji_roles)
+                 for guild in world.guilds for message_id, emoji_roles in guild["role_messages"]]
+        menu_weights = [1 / (rank + 1) ** message_skew for rank in range(len(menus))]
+        reacted = set()
+        interval = 1 / rate if rate else 0
+        self.storm_started = time.time()
+        next_at = time.monotonic()
+
+        async def emit(guild, message_id, user_id, emoji, role_id):
+            nonlocal next_at
+            key = (guild["id"], message_id, user_id, emoji)
+            add = key not in reacted
+            if add:
+                reacted.add(key)
+            else:
+                reacted.discard(key)
+            data = {
+                "user_id": str(user_id), "channel_id": str(guild["channel_id"]),
+                "message_id": str(message_id), "guild_id": str(guild["id"]), "emoji": emoji_payload(emoji),
+            }
+            if add:
+                data["member"] = self.member_payload(guild["id"], user_id)
+            if role_id is not None:
+                self.pending_events.setdefault((guild["id"], user_id), []).append((time.time(), role_id))
+                self.expected[(guild["id"], user_id, role_id)] = add
+                self.role_events += 1
+            await self.send(0, data, "MESSAGE_REACTION_ADD" if add else "MESSAGE_REACTION_REMOVE")
+            self.events_sent += 1
+            if interval:
+                next_at += interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif self.events_sent % 200 == 0:
+                # Let the REST handlers run between batches
+                await asyncio.sleep(0)
+
+        while self.events_sent < events and self.ws is not None:
+            user_id = rng.choices(world.user_ids, user_weights)[0]
+            if rng.random() < noise:
+                guild = rng.choice(world.guilds)
+                await emit(guild, rng.choice(guild["other_messages"]), user_id, rng.choice(UNICODE_EMOJIS), None)
+                continue
+            guild, message_id, emoji_roles = rng.choices(menus, menu_weights)[0]
+            pairs = list(emoji_roles.items())
+            clicks = rng.randint(2, 5) if rng.random() < burst else 1
+            for emoji, role_id in rng.sample(pairs, min(clicks, len(pairs))):
+                await emit(guild, message_id, user_id, emoji, role_id)
+                if rng.random() < toggle:
+                    await emit(guild, message_id, user_id, emoji, role_id)
+        self.storm_sent = time.time()
+
+    async def results(self, request):
+        settle = float(request.query.get("settle", "5"))
+        if self.storm_task is None:
+            return json_response({"state": "idle"})
+        if not self.storm_task.done() or time.time() - max(self.last_rest, self.storm_sent or 0) < settle:
+            return json_response({"state": "running", "events_sent": self.events_sent})
+        if self.storm_task.exception() is not None:
+            return json_response({"state": "failed", "error": repr(self.storm_task.exception())})
+
+        mismatches = sum(
+            1 for (guild_id, user_id, role_id), should_have in self.expected.items()
+            if (role_id in self.member_roles.get((guild_id, user_id), ())) != should_have
+        )
+        return json_response({
+            "state": "done",
+            "events_sent": self.events_sent,
+            "role_events": self.role_events,
+            "send_seconds": self.storm_sent - self.storm_started,
+            "rest_calls": self.rest_calls,
+            "rate_limited": self.rate_limited,
+            "latencies": self.latencies,
+            "uncovered_events": sum(len(events) for events in self.pending_events.values()),
+            "role_mismatches": mismatches,
+        })
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("fake Discord")
+    group.add_argument("--rest-latency", type=float, default=0.05, help="median REST latency in seconds")
+    group.add_argument("--route-limit", type=int, default=50, help="requests per bucket window, per route and guild")
+    group.add_argument("--route-window", type=float, default=1.0)
+    group.add_argument("--global-limit", type=int, default=50, help="requests per second across all routes (0 = off)")
+    group.add_argument("--spurious-429", type=float, default=0.0, help="share of requests answered with an unannounced 429")
+
+
+def cli_arguments(args):
+    return [
+        "--rest-latency", str(args.rest_latency), "--route-limit", str(args.route_limit),
+        "--route-window", str(args.route_window), "--global-limit", str(args.global_limit),
+        "--spurious-429", str(args.spurious_429),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Discord REST and gateway for offline load tests.")
+    parser.add_argument("--port", type=int, default=18300)
+    World.add_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = FakeDiscord(
+        World.from_args(args), rest_latency=args.rest_latency, route_limit=args.route_limit,
+        route_window=args.route_window, global_limit=args.global_limit, spurious_429=args.spurious_429,
+    )
+    print(f"Fake Discord listening on 127.0.0.1:{args.port}", flush=True)
+    web.run_app(fake.app(), host="127.0.0.1", port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import functools
+import re
+
+# <:name:id> or <a:name:id> as produced by str() of a custom emoji
+CUSTOM_EMOJI_RE = re.compile(r'<a?:\w+:(\d+)>')
+
+VARIATION_SELECTOR_16 = 0xFE0F
+
+
+@functools.lru_cache(maxsize=4096)
+def _unicode_key(text):
+    # Drop the emoji presentation selector so "❤" and "❤️" are the same key
+    return "-".join(f"{ord(c):x}" for c in text if ord(c) != VARIATION_SELECTOR_16)
+
+
+def emoji_key(emoji):
+    """
+    Normalize an emoji for lookups.
+
+    Custom (and animated) emoji are keyed by their ID, so renaming them doesn't
+    break existing mappings. Unicode emoji are keyed by a hex codepoint string.
+    Accepts either the string form stored in the mappings or a ``PartialEmoji``.
+    """
+    if isinstance(emoji, str):
+        text = emoji.strip()
+        match = CUSTOM_EMOJI_RE.fullmatch(text)
+        if match:
+            return int(match.group(1))
+        return _unicode_key(text)
+    if emoji.id is not None:
+        return emoji.id
+    return _unicode_key(emoji.name)
+
+
+class DispatchIndex:
+    """
+    ``message_id -> (guild_id, {emoji number: role_id})`` lookup table.
+
+    Compiled from the nested role mappings when they are loaded or changed, with
+    the emoji already normalized: custom emoji by ID, Unicode emoji numbered
+    above the snowflake range, so a lookup is two dict probes on ints and a
+    reaction on a message we don't track is rejected with the first, before the
+    emoji is even looked at. Reactions name Unicode emoji the way the client
+    sent them, those names are mapped to their numbers once and remembered.
+
+    Mappings saved without a guild (by older versions of the bot) are kept aside
+    until a reaction tells us which guild they belong to, see ``claim``.
+    """
+
+    def __init__(self):
+        # message_id -> (guild_id, {emoji number: role_id})
+        self._messages = {}
+        # message_id -> {emoji_key: role_id} for mappings with an unknown guild
+        self._unplaced = {}
+        # normalized Unicode key -> number, and raw emoji name -> number as seen
+        # in reactions so the hot path can skip normalizing
+        self._unicode_ids = {}
+        self._names = {}
+
+    def __len__(self):
+        return (sum(len(entry[1]) for entry in self._messages.values())
+                + sum(len(routes) for routes in self._unplaced.values()))
+
+    def _number(self, key):
+        if key.__class__ is int:
+            return key
+        number = self._unicode_ids.get(key)
+        if number is None:
+            number = self._unicode_ids[key] = (1 << 63) + len(self._unicode_ids)
+        return number
+
+    def _name_number(self, name):
+        number = self._unicode_ids.get(_unicode_key(name))
+        if number is not None:
+            # Only names of emoji we map get remembered, so this stays small
+            self._names[name] = number
+        return number
+
+    def rebuild(self, role_mappings, mapping_locations):
+        """Recompile the whole index from ``{message_id: {emoji: role_id}}``."""
+        self._messages = {}
+        self._unplaced = {}
+        for message_id, emoji_roles in role_mappings.items():
+            guild_id = mapping_locations.get(message_id, (None, None))[0]
+            self.add_message(guild_id, message_id, emoji_roles)
+
+    def add_message(self, guild_id, message_id, emoji_roles):
+        """Add or replace the routes of one role message."""
+        self.remove_message(message_id)
+        routes = {emoji_key(emoji): role_id for emoji, role_id in emoji_roles.items()}
+        if guild_id is None:
+            self._unplaced[message_id] = routes
+        else:
+            self._place(guild_id, message_id, routes)
+
+    def _place(self, guild_id, message_id, routes):
+        self._messages[message_id] = (guild_id, {self._number(key): role_id for key, role_id in routes.items()})
+
+    def remove_message(self, message_id):
+        self._unplaced.pop(message_id, None)
+        self._messages.pop(message_id, None)
+
+    def lookup(self, guild_id, message_id, emoji):
+        """Return the role ID for a reaction, or None if the reaction is irrelevant."""
+        # Most reactions are on messages we don't care about: reject those (and
+        # messages from another guild) before looking at the emoji
+        entry = self._messages.get(message_id)
+        if entry is None:
+            if self._unplaced and message_id in self._unplaced and guild_id is not None:
+                return self._unplaced[message_id].get(emoji_key(emoji))
+            return None
+        if entry[0] != guild_id:
+            return None
+        number = emoji.id
+        if number is None:
+            number = self._names.get(emoji.name)
+            if number is None:
+                number = self._name_number(emoji.name)
+        return entry[1].get(number)
+
+    def is_unplaced(self, message_id):
+        return message_id in self._unplaced
+
+    def claim(self, message_id, guild_id):
+        """Attach a message whose guild wasn't recorded to ``guild_id``."""
+        routes = self._unplaced.pop(message_id, None)
+        if routes is None:
+            return False
+        self._place(guild_id, message_id, routes)
+        return True
@@ -0,0 +1,56 @@
+class GuildIndex:
+    """
+    Role messages grouped by guild and channel.
+
+    ``role_mappings`` is keyed by message only, so anything that lists one
+    guild's menus would have to walk every message of every guild. This keeps
+    ``guild_id -> channel_id -> message IDs`` next to it (in the order the
+    messages were added), so listing or paging through a guild's or a
+    channel's menus only touches those entries. Messages saved without a
+    location (by older versions of the bot) are added once a reaction tells
+    us where they are.
+    """
+
+    def __init__(self):
+        # guild_id -> {channel_id: {message_id: None}}, dicts keep insertion order
+        self._guilds = {}
+        # message_id -> (guild_id, channel_id), to find a message's entry when it's removed
+        self._locations = {}
+
+    def __len__(self):
+        return len(self._locations)
+
+    def rebuild(self, mapping_locations):
+        """Recompile from ``{message_id: (guild_id, channel_id)}``."""
+        self._guilds = {}
+        self._locations = {}
+        for message_id, (guild_id, channel_id) in mapping_locations.items():
+            if guild_id is not None:
+                self.add(guild_id, channel_id, message_id)
+
+    def add(self, guild_id, channel_id, message_id):
+        self.remove(message_id)
+        self._guilds.setdefault(guild_id, {}).setdefault(channel_id, {})[message_id] = None
+        self._locations[message_id] = (guild_id, channel_id)
+
+    def remove(self, message_id):
+        location = self._locations.pop(message_id, None)
+        if location is None:
+            return
+        guild_id, channel_id = location
+        channels = self._guilds[guild_id]
+        channels[channel_id].pop(message_id, None)
+        if not channels[channel_id]:
+            del channels[channel_id]
+        if not channels:
+            del self._guilds[guild_id]
+
+    def count(self, guild_id):
+        return sum(len(messages) for messages in self._guilds.get(guild_id, {}).values())
+
+    def messages(self, guild_id, channel_id=None):
+        """``(message_id, channel_id)`` of a guild's role messages, grouped by channel, or of one channel only."""
+        channels = self._guilds.get(guild_id, {})
+        if channel_id is not None:
+            return [(message_id, channel_id) for message_id in channels.get(channel_id, ())]
+        return [(message_id, channel) for channel, messages in channels.items() for message_id in messages]
@@ -0,0 +1,144 @@
+import logging
+import time
+
+from metrics import CONTENT_TYPE, REGISTRY, rss_mb
+
+logger = logging.getLogger("health_server")
+
+STARTED_AT = time.time()
+
+
+def _latency_ms(latency):
+    # discord.py reports NaN until the first heartbeat is acknowledged
+    return round(latency * 1000, 1) if latency == latency else None
+
+
+def shard_health(bot):
+    """Connection state and latency of each shard, or None if the bot isn't sharded."""
+    shards = getattr(bot, 'shards', None)
+    if not shards:
+        return None
+    guilds_per_shard = {}
+    for guild in bot.guilds:
+        guilds_per_shard[guild.shard_id] = guilds_per_shard.get(guild.shard_id, 0) + 1
+    return {
+        str(shard_id): {
+            "connected": not shard.is_closed(),
+            "latency_ms": _latency_ms(shard.latency),
+            "guilds": guilds_per_shard.get(shard_id, 0),
+        }
+        for shard_id, shard in shards.items()
+    }
+
+
+def gateway_connected(bot):
+    """Whether every gateway connection of the bot is currently open."""
+    if bot.is_closed():
+        return False
+    shards = getattr(bot, 'shards', None)
+    if shards:
+        return all(not shard.is_closed() for shard in shards.values())
+    ws = bot.ws
+    return ws is not None and ws.open
+
+
+def bot_health(bot):
+    """The /health payload: process stats plus the bot's real gateway state."""
+    connected = gateway_connected(bot)
+    ready = bot.is_ready()
+    result = {
+        "status": "healthy" if connected and ready else "degraded",
+        "ready": ready,
+        "connected": connected,
+        "latency_ms": _latency_ms(bot.latency),
+        "guilds": len(bot.guilds),
+        "uptime_seconds": round(time.time() - STARTED_AT, 1),
+        "memory_usage_mb": rss_mb(),
+        "timestamp": time.time(),
+    }
+    shards = shard_health(bot)
+    if shards is not None:
+        result["shards"] = shards
+    return result
+
+
+class HealthServer:
+    """
+    Keep-alive and health HTTP server running on the bot's own event loop.
+
+    Serves ``/`` (the keep-alive ping), ``/health`` (gateway state, latency and
+    memory), ``/livez`` (the process and its event loop respond), ``/readyz``
+    (200 only while the bot is ready and every gateway connection is open) and
+    ``/metrics``. Because the handlers run on the bot's loop, a stalled loop
+    also stops the health checks from answering, which is what a liveness check
+    should see.
+    """
+
+    def __init__(self, bot, port=8080, host='0.0.0.0', loop_monitor=None, pinger=None):
+        self.bot = bot
+        self.port = port
+        self.host = host
+        self.loop_monitor = loop_monitor
+        # replit_ping.SelfPinger, its stats are included in /health
+        self.pinger = pinger
+        self._runner = None
+
+    async def start(self):
+        """Start listening. Errors such as the port being taken are logged, not raised."""
+        if self._runner is not None:
+            return
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/', self.home)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/livez', self.livez)
+        app.router.add_get('/readyz', self.readyz)
+        app.router.add_get('/metrics', self.metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            logger.error("Could not start health server on port %s: %s", self.port, e)
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info("Health server listening on port %s", self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def home(self, request):
+        from aiohttp import web
+        return web.Response(text=f"I'm alive! Timestamp: {time.time()}")
+
+    def health_payload(self):
+        """``bot_health`` plus event loop lag and self-ping stats, also served by keep_alive.py."""
+        result = bot_health(self.bot)
+        if self.loop_monitor is not None:
+            result["loop_lag_ms"] = round(self.loop_monitor.lag * 1000, 1)
+        if self.pinger is not None:
+            result["self_ping"] = self.pinger.stats()
+        return result
+
+    async def health(self, request):
+        from aiohttp import web
+        return web.json_response(self.health_payload())
+
+    async def livez(self, request):
+        from aiohttp import web
+        # Answering at all means the event loop is running
+        alive = not self.bot.is_closed()
+        return web.json_response({"alive": alive}, status=200 if alive else 503)
+
+    async def readyz(self, request):
+        from aiohttp import web
+        ready = self.bot.is_ready() and gateway_connected(self.bot)
+        return web.json_response({"ready": ready}, status=200 if ready else 503)
+
+    async def metrics(self, request):
+        from aiohttp import web
+        return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
@@ -1,18 +1,26 @@
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
 import logging
 import os
 import time
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from metrics import CONTENT_TYPE, REGISTRY, rss_mb
+from health_server import bot_health
+
 logger = logging.getLogger("keep_alive")
 
 # Create Flask app with minimal footprint
 app = Flask(__name__)
 app.config['PROPAGATE_EXCEPTIONS'] = True
 
+# Port of the keep-alive server; launcher.py gives each bot process its own
+PORT = int(os.getenv('HEALTH_PORT', '8080'))
+
+# The bot being kept alive, used to report its gateway state in /health
+_bot = None
+# health_server.HealthServer of the bot, adds loop lag and self-ping stats to /health
+_health = None
+
 @app.route('/')
 def home():
     # Return a simple page with timestamp to confirm it's working
@@ -21,12 +29,14 @@ def home():
 @app.route('/health')
 def health():
     # Health check endpoint for monitoring
-    memory_usage = os.popen('ps -o rss= -p ' + str(os.getpid())).read().strip()
     try:
-        memory_usage_mb = round(int(memory_usage) / 1024, 2)
+        if _health is not None:
+            return _health.health_payload()
+        if _bot is not None:
+            return bot_health(_bot)
         return {
             "status": "healthy",
-            "memory_usage_mb": memory_usage_mb,
+            "memory_usage_mb": rss_mb(),
             "timestamp": time.time()
         }
     except:
@@ -35,21 +45,33 @@ def health():
             "timestamp": time.time()
         }
 
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrape endpoint
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 def run():
     try:
         # Run with minimal resource usage
         logger.info("Starting keep_alive server...")
-        app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False)
+        app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
     except Exception as e:
-        logger.error(f"Error in keep_alive server: {e}")
+        logger.error("Error in keep_alive server: %s", e)
 
-def keep_alive():
+def keep_alive(bot=None, health=None):
     """
     Creates and starts a Flask web server in a separate thread 
     to keep the bot running on Replit.
     
     This implementation is designed to use minimal resources.
+    Pass the bot to include its gateway state in /health, and its
+    health_server.HealthServer (not started) for the loop lag and the
+    self-pinger's stats as well. The HealthServer serves the same on the
+    bot's event loop instead.
     """
+    global _bot, _health
+    _bot = bot
+    _health = health
     # Create daemon thread so it doesn't block bot shutdown
     t = Thread(target=run, daemon=True)
     t.start()
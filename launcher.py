@@ -0,0 +1,137 @@
+"""
+Run the bot sharded across several processes.
+
+Each process runs rolebot.py as an AutoShardedBot for a contiguous range of shards
+and gets its own keep-alive port (HEALTH_PORT = --health-port + process index).
+Processes that crash are restarted after a delay, like run.sh does for a single bot.
+
+Usage: python launcher.py --processes 2 [--shards 8]
+
+Without --shards the shard count recommended by Discord is used.
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+from dotenv import load_dotenv
+
+from log_setup import setup_logging
+from mapping_store import open_store
+from sharding import format_shard_ids, split_shards
+
+logger = logging.getLogger("launcher")
+
+# Discord allows one IDENTIFY per 5 seconds (per max_concurrency bucket)
+IDENTIFY_INTERVAL = 5.0
+
+
+def recommended_shard_count(token):
+    response = requests.get(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}"},
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()["shards"]
+
+
+class ShardProcess:
+    def __init__(self, index, shard_ids, shard_count, health_port):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.health_port = health_port
+        self.proc = None
+        self.restart_at = None
+
+    def start(self):
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=format_shard_ids(self.shard_ids),
+            HEALTH_PORT=str(self.health_port),
+            # All processes share the SQLite store, each loading its own guilds
+            MAPPINGS_BACKEND="sqlite",
+        )
+        self.proc = subprocess.Popen([sys.executable, "rolebot.py"], env=env)
+        self.restart_at = None
+        logger.info(
+            "Started process %d (pid %d) for shards %s of %d",
+            self.index, self.proc.pid, format_shard_ids(self.shard_ids), self.shard_count
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the role bot sharded across several processes.")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--shards", type=int, default=None, help="total shard count (default: Discord's recommendation)")
+    parser.add_argument("--health-port", type=int, default=8080, help="keep-alive port of the first process")
+    parser.add_argument("--restart-delay", type=float, default=10.0)
+    args = parser.parse_args()
+
+    if os.path.exists('.env'):
+        load_dotenv()
+    setup_logging(level=os.getenv('LOG_LEVEL', 'INFO'), fmt=os.getenv('LOG_FORMAT', 'text'))
+    token = os.getenv('DISCORD_TOKEN')
+    if not token:
+        sys.exit("No Discord token found. Set DISCORD_TOKEN in your .env file or environment.")
+
+    if os.getenv('MAPPINGS_BACKEND', 'sqlite') != 'sqlite':
+        sys.exit("Sharded processes share their mappings through SQLite, unset MAPPINGS_BACKEND or set it to sqlite.")
+
+    # Migrate role_mappings.json (if any) once, before the processes open the database
+    open_store('sqlite', "role_mappings.json", os.getenv('MAPPINGS_DB', 'role_mappings.db')).close()
+
+    shard_count = args.shards or recommended_shard_count(token)
+    processes = [
+        ShardProcess(index, shard_ids, shard_count, args.health_port + index)
+        for index, shard_ids in enumerate(split_shards(shard_count, args.processes))
+    ]
+    logger.info("Running %d shards in %d processes", shard_count, len(processes))
+
+    try:
+        for process in processes:
+            process.start()
+            # Give this process time to identify all its shards before the next starts
+            time.sleep(IDENTIFY_INTERVAL * len(process.shard_ids))
+
+        while True:
+            time.sleep(1)
+            for process in processes:
+                code = process.proc.poll()
+                if code is None:
+                    continue
+                if code == 0 and process.restart_at is None:
+                    logger.info("Process %d exited normally, not restarting it", process.index)
+                    process.restart_at = float("inf")
+                elif process.restart_at is None:
+                    logger.warning(
+                        "Process %d exited with code %d, restarting in %.0f seconds",
+                        process.index, code, args.restart_delay
+                    )
+                    process.restart_at = time.monotonic() + args.restart_delay
+                elif time.monotonic() >= process.restart_at:
+                    process.start()
+    except KeyboardInterrupt:
+        logger.info("Stopping bot processes...")
+    finally:
+        for process in processes:
+            if process.proc is not None and process.proc.poll() is None:
+                # SIGINT lets the bot shut down cleanly: it applies the role changes still
+                # waiting in its role edit queue and flushes its mapping writes
+                process.proc.send_signal(signal.SIGINT)
+        for process in processes:
+            if process.proc is not None:
+                try:
+                    process.proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.proc.kill()
+
+
+if __name__ == "__main__":
+    main()
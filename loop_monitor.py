@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as TallyCounter
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger("loop_monitor")
+
+LOOP_LAG = Histogram(
+    "rolebot_loop_lag_seconds", "How late the event loop ran a scheduled wakeup.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_STALLS = Counter("rolebot_loop_stalls", "Times the event loop was blocked for longer than the stall threshold.")
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+# The loop is idle (waiting for I/O) when its thread is inside one of these
+_IDLE_FUNCTIONS = {("selectors.py", "select"), ("selectors.py", "poll"), ("selectors.py", "epoll")}
+
+
+def _frame_id(frame):
+    code = frame.f_code
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _describe(func):
+    filename, line, name = func
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def _is_loop_machinery(func):
+    filename = func[0]
+    return os.path.dirname(filename) == _ASYNCIO_DIR or func[2] == "<module>"
+
+
+def _is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FUNCTIONS
+
+
+class LoopMonitor:
+    """
+    Watches the asyncio event loop for lag and stalls.
+
+    A task on the loop wakes up every ``interval`` seconds and records how late
+    it ran (the loop's scheduling delay). A separate watchdog thread checks that
+    those wakeups keep happening; once the loop hasn't run one for ``threshold``
+    seconds it logs the loop thread's current stack, which shows whatever is
+    blocking it (a synchronous save, a slow handler, ...). The stall's total
+    duration is logged when the loop recovers.
+    """
+
+    def __init__(self, interval=0.25, threshold=1.0):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0  # delay of the latest wakeup
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._heartbeat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    @property
+    def loop_thread_id(self):
+        return self._loop_thread_id
+
+    def start(self):
+        """Start monitoring the running loop. Calling it again is a no-op."""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._sample_lag())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        logger.info("Loop monitor started (stall threshold %.2fs)", self.threshold)
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _sample_lag(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.lag = lag
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def _watchdog(self):
+        stalled_since = None
+        while not self._stopped.wait(self.interval):
+            blocked = time.monotonic() - self._heartbeat
+            if blocked < self.threshold:
+                if stalled_since is not None:
+                    stalled = self._heartbeat - stalled_since
+                    logger.warning(
+                        "Event loop recovered after a %.2fs stall", stalled,
+                        extra={"stall_seconds": round(stalled, 3)}
+                    )
+                    stalled_since = None
+                continue
+            if stalled_since is not None:
+                continue
+            stalled_since = self._heartbeat
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack available)\n"
+            logger.warning(
+                "Event loop blocked for %.2fs, currently running:\n%s", blocked, stack.rstrip(),
+                extra={"blocked_seconds": round(blocked, 3)}
+            )
+
+
+class ProfileReport:
+    """Result of ``sample_profile``: how often each function was seen on the loop thread's stack."""
+
+    def __init__(self, duration, samples, idle, own, total):
+        self.duration = duration
+        self.samples = samples
+        self.idle = idle
+        self.own = own
+        self.total = total
+
+    def top(self, limit=15):
+        """
+        The ``limit`` hottest functions as ``(name, own, total)`` sample counts.
+
+        Sorted by own time, then by total time so callers of hot builtins (which
+        have no Python frame of their own) still show up. The event loop's own
+        frames are on every busy sample and are left out.
+        """
+        funcs = [func for func in self.total if not _is_loop_machinery(func)]
+        funcs.sort(key=lambda func: (self.own.get(func, 0), self.total[func]), reverse=True)
+        return [(_describe(func), self.own.get(func, 0), self.total[func]) for func in funcs[:limit]]
+
+    def summary(self, limit=15):
+        if not self.samples:
+            return "No samples collected."
+        busy = self.samples - self.idle
+        lines = [
+            f"{self.samples} samples over {self.duration:.1f}s, "
+            f"loop busy {busy / self.samples:.0%} of the time",
+        ]
+        if not busy:
+            return lines[0]
+        lines.append(f"{'own':>5} {'total':>6}  function")
+        for name, own, total in self.top(limit):
+            lines.append(f"{own / busy:>5.0%} {total / busy:>6.0%}  {name}")
+        return "\n".join(lines)
+
+
+def sample_profile(thread_id, duration=10.0, interval=0.005):
+    """
+    Sample the stack of ``thread_id`` every ``interval`` seconds for ``duration`` seconds.
+
+    Meant to run in a side thread against the event loop thread. Samples taken
+    while the loop waits for I/O count as idle. For every other sample the top
+    frame counts as the function's own time and every function on the stack
+    gets its total time.
+    """
+    own = TallyCounter()
+    total = TallyCounter()
+    samples = idle = 0
+    started = time.monotonic()
+    deadline = started + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            if _is_idle(frame):
+                idle += 1
+            else:
+                own[_frame_id(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    func = _frame_id(frame)
+                    if func not in seen:
+                        seen.add(func)
+                        total[func] += 1
+                    frame = frame.f_back
+        time.sleep(interval)
+    return ProfileReport(time.monotonic() - started, samples, idle, own, total)
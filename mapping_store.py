@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from sharding import shard_for_guild
+
+logger = logging.getLogger("mapping_store")
+
+
+class MappingStore:
+    """
+    Persistence for role mappings.
+
+    Rows are ``(guild_id, channel_id, message_id, emoji, role_id)`` tuples. Entries
+    written by older versions of the bot did not record where the message lives, so
+    ``guild_id``/``channel_id`` may be ``None``.
+
+    All writes are handed to a single background thread and return a
+    ``concurrent.futures.Future``, so callers on the event loop never block on disk.
+    A write that fails is logged (and counted in ``errors``) by the store itself,
+    its future raises the error for callers that wait for it.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mapping-store")
+        self._closed = False
+        self.errors = 0
+
+    def load(self, shards=None):
+        """
+        Return the stored mapping rows. Blocks, call before the bot connects.
+
+        ``shards`` is an optional ``(shard_ids, shard_count)`` pair: only rows of
+        guilds on those shards (and rows without a guild) are returned, so each
+        process of a sharded deployment only holds its own guilds' mappings.
+        """
+        return self._executor.submit(self._load, shards).result()
+
+    def save_message(self, guild_id, channel_id, message_id, emoji_roles):
+        """Replace the emoji -> role mappings of one message."""
+        return self._executor.submit(
+            self._logged, "save role message", message_id, self._save_message,
+            guild_id, channel_id, message_id, dict(emoji_roles)
+        )
+
+    def delete_message(self, message_id):
+        """Forget every mapping of one message."""
+        return self._executor.submit(self._logged, "delete role message", message_id, self._delete_message, message_id)
+
+    def set_location(self, message_id, guild_id, channel_id):
+        """Record where a message lives, for mappings saved without that information."""
+        return self._executor.submit(
+            self._logged, "record the location of role message", message_id, self._set_location,
+            message_id, guild_id, channel_id
+        )
+
+    def flush(self):
+        """Wait until every queued write has reached disk."""
+        if not self._closed:
+            try:
+                self._executor.submit(lambda: None).result()
+            except RuntimeError:
+                # At exit, after the executor was shut down: its queued writes ran already
+                pass
+
+    def close(self):
+        """Wait for queued writes and close the store."""
+        if self._closed:
+            return
+        self.flush()
+        # Closed from this thread: at exit the executor no longer takes new work
+        self._executor.shutdown(wait=True)
+        self._closed = True
+        self._close()
+
+    def _logged(self, action, message_id, write, *args):
+        try:
+            write(*args)
+        except Exception:
+            self.errors += 1
+            logger.exception("Could not %s %s", action, message_id)
+            raise
+
+    # Implemented by the backends, always called on the store's thread
+    def _load(self, shards):
+        raise NotImplementedError
+
+    def _save_message(self, guild_id, channel_id, message_id, emoji_roles):
+        raise NotImplementedError
+
+    def _delete_message(self, message_id):
+        raise NotImplementedError
+
+    def _set_location(self, message_id, guild_id, channel_id):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class JsonMappingStore(MappingStore):
+    """
+    Stores mappings in a JSON file.
+
+    The file is rewritten as a whole, but off the event loop and atomically through a
+    temporary file, so a crash mid-write can't truncate it. Understands both the
+    current format and the original ``{message_id: {emoji: role_id}}`` layout.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._messages = {}
+
+    def _load(self, shards):
+        if not os.path.exists(self.path):
+            logger.info("No mappings file found at %s", self.path)
+            return []
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+
+        rows = []
+        if data.get("version") == 2:
+            for message_id, entry in data["messages"].items():
+                for emoji, role_id in entry["roles"].items():
+                    rows.append((entry.get("guild_id"), entry.get("channel_id"), int(message_id), emoji, role_id))
+        else:
+            # Original format: {message_id: {emoji: role_id}}
+            for message_id, emojis in data.items():
+                for emoji, role_id in emojis.items():
+                    rows.append((None, None, int(message_id), emoji, role_id))
+
+        self._messages = {}
+        for guild_id, channel_id, message_id, emoji, role_id in rows:
+            entry = self._messages.setdefault(
+                message_id, {"guild_id": guild_id, "channel_id": channel_id, "roles": {}}
+            )
+            entry["roles"][emoji] = role_id
+
+        if shards is not None:
+            shard_ids, shard_count = shards
+            rows = [row for row in rows if row[0] is None or shard_for_guild(row[0], shard_count) in shard_ids]
+        return rows
+
+    def _write(self):
+        data = {"version": 2, "messages": {str(k): v for k, v in self._messages.items()}}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _save_message(self, guild_id, channel_id, message_id, emoji_roles):
+        self._messages[message_id] = {"guild_id": guild_id, "channel_id": channel_id, "roles": emoji_roles}
+        self._write()
+
+    def _delete_message(self, message_id):
+        if self._messages.pop(message_id, None) is not None:
+            self._write()
+
+    def _set_location(self, message_id, guild_id, channel_id):
+        entry = self._messages.get(message_id)
+        if entry is not None:
+            entry["guild_id"] = guild_id
+            entry["channel_id"] = channel_id
+            self._write()
+
+
+class SqliteMappingStore(MappingStore):
+    """
+    Stores mappings in SQLite (WAL mode), one row per message/emoji pair.
+
+    Saving a role message only touches that message's rows, so the cost of a write
+    doesn't grow with the number of role messages across all guilds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS role_mappings (
+            guild_id INTEGER,
+            channel_id INTEGER,
+            message_id INTEGER NOT NULL,
+            emoji TEXT NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (message_id, emoji)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_role_mappings_guild ON role_mappings (guild_id, message_id);
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            # Other bot processes may write to the same database when sharded
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _load(self, shards):
+        conn = self._connect()
+        query = "SELECT guild_id, channel_id, message_id, emoji, role_id FROM role_mappings"
+        if shards is None:
+            return conn.execute(query).fetchall()
+        shard_ids, shard_count = shards
+        placeholders = ",".join("?" * len(shard_ids))
+        return conn.execute(
+            f"{query} WHERE guild_id IS NULL OR ((guild_id >> 22) % ?) IN ({placeholders})",
+            (shard_count, *shard_ids),
+        ).fetchall()
+
+    def _save_message(self, guild_id, channel_id, message_id, emoji_roles):
+        if not emoji_roles:
+            self._delete_message(message_id)
+            return
+        conn = self._connect()
+        with conn:
+            placeholders = ",".join("?" * len(emoji_roles))
+            conn.execute(
+                f"DELETE FROM role_mappings WHERE message_id = ? AND emoji NOT IN ({placeholders})",
+                (message_id, *emoji_roles),
+            )
+            conn.executemany(
+                "INSERT INTO role_mappings (guild_id, channel_id, message_id, emoji, role_id) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (message_id, emoji) DO UPDATE SET "
+                "guild_id = excluded.guild_id, channel_id = excluded.channel_id, role_id = excluded.role_id",
+                [(guild_id, channel_id, message_id, emoji, role_id) for emoji, role_id in emoji_roles.items()],
+            )
+
+    def _delete_message(self, message_id):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM role_mappings WHERE message_id = ?", (message_id,))
+
+    def _set_location(self, message_id, guild_id, channel_id):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "UPDATE role_mappings SET guild_id = ?, channel_id = ? WHERE message_id = ?",
+                (guild_id, channel_id, message_id),
+            )
+
+    def _import_rows(self, rows):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO role_mappings (guild_id, channel_id, message_id, emoji, role_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _is_empty(self):
+        conn = self._connect()
+        return conn.execute("SELECT 1 FROM role_mappings LIMIT 1").fetchone() is None
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def migrate_json_to_sqlite(json_path, store):
+    """
+    One-time import of an existing JSON mappings file into a SQLite store.
+
+    Only runs while the database is still empty. The JSON file is renamed to
+    ``<name>.migrated`` afterwards so it isn't imported again.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    if not store._executor.submit(store._is_empty).result():
+        logger.warning("%s exists but %s already has mappings, not migrating", json_path, store.path)
+        return 0
+
+    json_store = JsonMappingStore(json_path)
+    try:
+        rows = json_store.load()
+    finally:
+        json_store.close()
+
+    store._executor.submit(store._import_rows, rows).result()
+    os.replace(json_path, json_path + ".migrated")
+    logger.info("Migrated %d role mappings from %s to %s", len(rows), json_path, store.path)
+    return len(rows)
+
+
+def open_store(backend, json_path, sqlite_path):
+    """Create the store selected by ``backend`` ("sqlite" or "json")."""
+    if backend == "json":
+        return JsonMappingStore(json_path)
+    if backend == "sqlite":
+        store = SqliteMappingStore(sqlite_path)
+        migrate_json_to_sqlite(json_path, store)
+        return store
+    raise ValueError(f"Unknown mappings backend: {backend}")
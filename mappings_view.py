@@ -0,0 +1,114 @@
+import re
+
+import discord
+
+# An embed holds 25 fields and 6000 characters in total, five menus of up to 20 roles always fit
+MENUS_PER_PAGE = 5
+FIELD_VALUE_LIMIT = 1024
+
+CHANNEL_MENTION_RE = re.compile(r'<#(\d+)>')
+ROLE_MENTION_RE = re.compile(r'<@&(\d+)>')
+
+
+def parse_filters(text, guild, role_index):
+    """
+    Parse the arguments of ``!show_mappings``: channel mentions and role mentions or names.
+
+    Returns ``(channel_id, role, errors)``.
+    """
+    channel_id = None
+    role = None
+    errors = []
+    for token in (text or "").split():
+        match = CHANNEL_MENTION_RE.fullmatch(token)
+        if match:
+            channel_id = int(match.group(1))
+            continue
+        match = ROLE_MENTION_RE.fullmatch(token)
+        if match:
+            role = guild.get_role(int(match.group(1)))
+            if role is None:
+                errors.append(f"Role {token} not found.")
+            continue
+        found, error = role_index.lookup(token)
+        if error is not None:
+            errors.append(error)
+        else:
+            role = found
+    return channel_id, role, errors
+
+
+class MappingPages(discord.ui.View):
+    """
+    A guild's role menus as pages of an embed, turned with Previous/Next buttons.
+
+    Holds only the ``(message_id, channel_id)`` list of the matching menus. Each
+    page's embed is built when it's shown, so the work per click is one page of
+    menus regardless of how many exist. Only the member who ran the command can
+    turn the pages, and the buttons are disabled once the view times out.
+    """
+
+    def __init__(self, guild, entries, role_mappings, author_id, description, timeout=180):
+        super().__init__(timeout=timeout)
+        self.guild = guild
+        self.entries = entries
+        self.role_mappings = role_mappings
+        self.author_id = author_id
+        self.description = description
+        self.page = 0
+        self.message = None
+        self._update_buttons()
+
+    @property
+    def page_count(self):
+        return max(1, -(-len(self.entries) // MENUS_PER_PAGE))
+
+    def render(self):
+        """The embed of the current page."""
+        embed = discord.Embed(title="Current Role Mappings", description=self.description, color=discord.Color.green())
+        start = self.page * MENUS_PER_PAGE
+        for message_id, channel_id in self.entries[start:start + MENUS_PER_PAGE]:
+            channel = self.guild.get_channel(channel_id)
+            link = f"https://discord.com/channels/{self.guild.id}/{channel_id}/{message_id}"
+            lines = [f"[Jump to message]({link})"]
+            for emoji, role_id in self.role_mappings.get(message_id, {}).items():
+                role = self.guild.get_role(role_id)
+                lines.append(f"{emoji} → {role.name if role else 'Unknown Role'}")
+            value = "\n".join(lines)
+            if len(value) > FIELD_VALUE_LIMIT:
+                value = value[:FIELD_VALUE_LIMIT - 1] + "…"
+            embed.add_field(name=f"#{channel.name}" if channel else f"Channel {channel_id}", value=value, inline=False)
+        embed.set_footer(text=f"Page {self.page + 1}/{self.page_count} · {len(self.entries)} role messages")
+        return embed
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def _show(self, interaction, page):
+        self.page = min(max(page, 0), self.page_count - 1)
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.page + 1)
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Only the person who ran the command can turn the pages.", ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        self.previous_page.disabled = True
+        self.next_page.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import discord
+
+logger = logging.getLogger("member_resolver")
+
+
+class ResolverStats:
+    def __init__(self):
+        self.negative_hits = 0  # known not to be a member
+        self.fetches = 0  # REST fetches actually made
+        self.deduplicated = 0  # lookups that joined a fetch already in flight
+        self.errors = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.negative_hits + self.fetches + self.deduplicated
+        if not lookups:
+            return 0.0
+        return (lookups - self.fetches) / lookups
+
+    def as_dict(self):
+        return {
+            "negative_hits": self.negative_hits,
+            "fetches": self.fetches,
+            "deduplicated": self.deduplicated,
+            "errors": self.errors,
+            "hit_rate": round(self.hit_rate, 3),
+        }
+
+
+class MemberResolver:
+    """
+    Fetches guild members for the role edit queue without duplicate REST calls.
+
+    Concurrent lookups for the same (guild, user) share one ``fetch_member``
+    call. Users that aren't members of the guild (NotFound) are remembered for
+    ``negative_ttl`` seconds, up to ``maxsize`` of them. Fetched members aren't
+    kept: the queue writes their role list back, so it needs it as it is now.
+    """
+
+    def __init__(self, maxsize=1000, negative_ttl=60.0):
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        # (guild_id, user_id) -> expires
+        self._missing = OrderedDict()
+        # (guild_id, user_id) -> Future resolving to the member or None
+        self._inflight = {}
+        self.stats = ResolverStats()
+
+    def __len__(self):
+        return len(self._missing)
+
+    @property
+    def inflight(self):
+        return len(self._inflight)
+
+    async def resolve(self, guild, user_id):
+        """Return the member, or None if they aren't in the guild or couldn't be fetched."""
+        key = (guild.id, user_id)
+        expires = self._missing.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.stats.negative_hits += 1
+                return None
+            del self._missing[key]
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.stats.deduplicated += 1
+            return await asyncio.shield(pending)
+
+        pending = self._inflight[key] = asyncio.get_running_loop().create_future()
+        member = None
+        try:
+            self.stats.fetches += 1
+            member = await guild.fetch_member(user_id)
+        except discord.errors.NotFound:
+            logger.warning("Could not find member with ID %s in guild %s", user_id, guild.id)
+            self._missing[key] = time.monotonic() + self.negative_ttl
+            while len(self._missing) > self.maxsize:
+                self._missing.popitem(last=False)
+        except Exception as e:
+            self.stats.errors += 1
+            logger.error("Error fetching member %s in guild %s: %s", user_id, guild.id, e)
+        finally:
+            del self._inflight[key]
+            pending.set_result(member)
+        return member
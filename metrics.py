@@ -0,0 +1,325 @@
+import asyncio
+import gc
+import logging
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger("metrics")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, **labels):
+        """The child metric for one label combination. Keep it around on hot paths."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield ``(name, labelnames, labelvalues, value)`` for every exposed sample."""
+        for key, child in list(self._children.items()):
+            for suffix, extra_names, extra_values, value in child.samples():
+                yield (self.name + suffix, self.labelnames + extra_names, key + extra_values, value)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield ("_total", (), (), self.value)
+
+
+class Counter(_Metric):
+    """Monotonic counter. Increments are plain float additions, safe under the GIL for our use."""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield ("_bucket", ("le",), (_format_value(float(bound)),), cumulative)
+        yield ("_sum", (), (), self.sum)
+        yield ("_count", (), (), self.count)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != float("inf"):
+            self.buckets += (float("inf"),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class CallbackMetric:
+    """
+    A gauge or counter whose value is read when the metrics are scraped.
+
+    ``callback`` returns either a number, or a dict mapping label value tuples
+    to numbers. Used for state that already lives elsewhere (queue sizes, cache
+    stats) so the hot paths don't have to update a second copy.
+    """
+
+    def __init__(self, name, documentation, callback, type="gauge", labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    def samples(self):
+        name = self.name + ("_total" if self.type == "counter" else "")
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.warning("Metric %s failed: %s", self.name, e)
+            return
+        if isinstance(value, dict):
+            for key, sample in value.items():
+                yield (name, self.labelnames, tuple(str(v) for v in key), sample)
+        elif value is not None:
+            yield (name, (), (), value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        # Re-registering a name replaces it, e.g. when a module is reloaded
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labelnames, values, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labelnames, values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def rss_mb():
+    """Current resident set size of this process in MB, without forking ``ps``."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 2)
+    except (OSError, ValueError, IndexError):
+        # No /proc (e.g. macOS): fall back to the peak RSS, reported in bytes there
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024), 2)
+
+
+_STARTED = time.time()
+
+
+def _gc_stats(field):
+    return {(str(generation),): stats[field] for generation, stats in enumerate(gc.get_stats())}
+
+
+CallbackMetric("process_resident_memory_bytes", "Resident memory size in bytes.",
+               lambda: rss_mb() * 1024 * 1024)
+CallbackMetric("process_cpu_seconds", "Total user and system CPU time spent in seconds.",
+               lambda: sum(resource.getrusage(resource.RUSAGE_SELF)[:2]), type="counter")
+CallbackMetric("process_start_time_seconds", "Start time of the process since unix epoch in seconds.",
+               lambda: _STARTED)
+CallbackMetric("python_gc_collections", "Number of times each generation was collected.",
+               lambda: _gc_stats("collections"), type="counter", labelnames=("generation",))
+CallbackMetric("python_gc_objects_collected", "Objects collected during GC.",
+               lambda: _gc_stats("collected"), type="counter", labelnames=("generation",))
+CallbackMetric("python_gc_objects_uncollectable", "Uncollectable objects found during GC.",
+               lambda: _gc_stats("uncollectable"), type="counter", labelnames=("generation",))
+CallbackMetric("python_gc_pending_objects", "Objects allocated since the generation was last collected.",
+               lambda: {(str(generation),): count for generation, count in enumerate(gc.get_count())},
+               labelnames=("generation",))
+
+# REST traffic to Discord, see instrument_http()
+REST_REQUESTS = Counter("rolebot_rest_requests", "Discord REST requests by route and outcome.",
+                        ("method", "route", "status"))
+REST_DURATION = Histogram("rolebot_rest_request_seconds",
+                          "Time spent in Discord REST requests, including rate limit waits.", ("method",))
+RATE_LIMITED = Counter("rolebot_rate_limited", "429 responses received from Discord.", ("scope",))
+RATE_LIMIT_WAIT = Counter("rolebot_rate_limit_wait_seconds", "Seconds spent sleeping after 429 responses.")
+PREEMPTIVE_WAITS = Counter("rolebot_rate_limit_preemptive_waits",
+                           "Waits for a rate limit bucket to reset before it ran out, no 429 involved.")
+PREEMPTIVE_WAIT = Counter("rolebot_rate_limit_preemptive_wait_seconds",
+                          "Seconds spent in those waits, requests queued on the bucket wait along.")
+
+
+class _RateLimitLogFilter(logging.Filter):
+    """
+    Counts 429s from discord.py's own ``discord.http`` warnings, which carry the
+    ``retry_after`` it's about to sleep for. Records are only let through if they
+    would have been emitted anyway.
+
+    Every 429 is logged with ``RETRY_MESSAGE``, and a global one right after
+    that (without yielding to the event loop) with ``GLOBAL_MESSAGE`` too. So
+    route 429s are counted from a callback scheduled on the loop, by which time
+    a global one has taken its count back, and each 429 counts once.
+    """
+
+    RETRY_MESSAGE = 'We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.'
+    TIMEOUT_MESSAGE = 'We are being rate limited. %s %s responded with 429. Timeout of %.2f was too long, erroring instead.'
+    GLOBAL_MESSAGE = 'Global rate limit has been hit. Retrying in %.2f seconds.'
+
+    def __init__(self, min_level):
+        super().__init__()
+        self.min_level = min_level
+        self.route_limited = RATE_LIMITED.labels(scope="route")
+        self.global_limited = RATE_LIMITED.labels(scope="global")
+        # Route 429s logged but not counted yet
+        self._unsettled = 0
+
+    def filter(self, record):
+        if record.msg == self.RETRY_MESSAGE:
+            RATE_LIMIT_WAIT.inc(float(record.args[2]))
+            self._unsettled += 1
+            try:
+                asyncio.get_running_loop().call_soon(self._settle)
+            except RuntimeError:
+                self._settle()
+        elif record.msg == self.TIMEOUT_MESSAGE:
+            self.route_limited.inc()
+        elif record.msg == self.GLOBAL_MESSAGE:
+            self.global_limited.inc()
+            self._unsettled = max(self._unsettled - 1, 0)
+        return record.levelno >= self.min_level
+
+    def _settle(self):
+        if self._unsettled:
+            self.route_limited.inc(self._unsettled)
+            self._unsettled = 0
+
+
+def _count_preemptive_waits():
+    """
+    Count the waits discord.py does on its own when a bucket's last request
+    came back with no requests remaining. It doesn't log those.
+    """
+    from discord.http import Ratelimit
+
+    refresh = Ratelimit._refresh
+    if getattr(refresh, "counted", False):
+        return
+
+    async def _refresh(self):
+        if self.reset_after > 0 and not (self._max_ratelimit_timeout and self.reset_after > self._max_ratelimit_timeout):
+            PREEMPTIVE_WAITS.inc()
+            PREEMPTIVE_WAIT.inc(self.reset_after)
+        await refresh(self)
+
+    _refresh.counted = True
+    Ratelimit._refresh = _refresh
+
+
+def instrument_http(http):
+    """Count and time every REST request made through a discord.py ``HTTPClient``."""
+    import discord
+
+    original_request = http.request
+
+    async def request(route, **kwargs):
+        started = time.monotonic()
+        status = "ok"
+        try:
+            return await original_request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            REST_REQUESTS.labels(method=route.method, route=route.path, status=status).inc()
+            REST_DURATION.labels(method=route.method).observe(time.monotonic() - started)
+
+    http.request = request
+
+    http_logger = logging.getLogger("discord.http")
+    min_level = http_logger.getEffectiveLevel()
+    # The 429 warnings have to reach the filter even if warnings aren't logged
+    http_logger.setLevel(min(min_level, logging.WARNING))
+    http_logger.addFilter(_RateLimitLogFilter(min_level))
+    _count_preemptive_waits()
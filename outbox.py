@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("outbox")
+
+
+class OutboxStats:
+    def __init__(self):
+        self.recorded = 0  # role changes written to the log
+        self.done = 0  # of those, marked done after their edit
+        self.left_open = 0  # given up on after transient errors, replayed on the next start
+        self.replayed = 0  # unfinished changes found at startup
+        self.batches = 0  # appends, each followed by one fsync
+        self.compactions = 0
+        self.errors = 0  # failed writes
+
+    def as_dict(self):
+        return {
+            "recorded": self.recorded,
+            "done": self.done,
+            "left_open": self.left_open,
+            "replayed": self.replayed,
+            "batches": self.batches,
+            "compactions": self.compactions,
+            "errors": self.errors,
+        }
+
+
+class RoleOutbox:
+    """
+    Append-only log of role changes, so changes in flight survive a crash.
+
+    Every change handed to the role edit queue is appended as ``+ seq guild
+    user role add`` and, once the edit that includes it was made (or failed
+    for good), marked with ``- seq``. Lines are collected for ``flush_interval`` seconds
+    and written by a background thread with one fsync per batch, and the queue
+    waits for the batch holding a member's changes (``sync``) before editing
+    their roles. That wait is normally already over, the coalescing window is
+    much longer than a batch.
+
+    ``open`` returns the changes that were never marked done, for the caller
+    to hand to the queue again. Replaying is safe: changes are "add role X" or
+    "remove role X", and the queue skips roles a member already has (or
+    doesn't). Once the log has grown past ``compact_lines`` lines, mostly of
+    finished changes, it's rewritten with only the unfinished ones.
+    """
+
+    def __init__(self, path, flush_interval=0.05, compact_lines=50_000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_lines = compact_lines
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="role-outbox")
+        self._file = None
+        # seq -> (guild_id, user_id, role_id, add) for changes not marked done yet
+        self._open = {}
+        self._next_seq = 1
+        self._buffer = []
+        self._flush_handle = None
+        # The newest batch handed to the writer thread, sync() waits for it
+        self._last_write = None
+        # Lines in the file since it was last compacted
+        self._lines = 0
+        self._closed = False
+        self.stats = OutboxStats()
+
+    def __len__(self):
+        return len(self._open)
+
+    def open(self):
+        """
+        Read the log, compact it and start appending. Returns the unfinished
+        changes as ``(seq, guild_id, user_id, role_id, add)`` in the order they
+        were made. Blocks, call before the bot connects.
+        """
+        return self._executor.submit(self._open_log).result()
+
+    def replay(self, submit):
+        """
+        ``open`` the log and hand every unfinished change to ``submit(guild_id,
+        user_id, role_id, add)``, the role edit queue's. Returns how many there were.
+        """
+        unfinished = self.open()
+        for _, guild_id, user_id, role_id, add in unfinished:
+            submit(guild_id, user_id, role_id, add)
+        # submit logged them again under new sequence numbers
+        self.done([seq for seq, *_ in unfinished])
+        return len(unfinished)
+
+    def record(self, guild_id, user_id, role_id, add):
+        """Log a role change, returns its sequence number for ``done``."""
+        seq = self._next_seq
+        self._next_seq += 1
+        self._open[seq] = (guild_id, user_id, role_id, add)
+        self._buffer.append(f"+ {seq} {guild_id} {user_id} {role_id} {1 if add else 0}\n")
+        self.stats.recorded += 1
+        self._schedule()
+        return seq
+
+    def done(self, seqs):
+        """Mark changes as applied (or failed for good), they won't be replayed."""
+        for seq in seqs:
+            if self._open.pop(seq, None) is not None:
+                self._buffer.append(f"- {seq}\n")
+                self.stats.done += 1
+        self._schedule()
+
+    def leave_open(self, seqs):
+        """Changes the queue gave up on for now, they're replayed on the next start."""
+        self.stats.left_open += len(seqs)
+
+    async def sync(self):
+        """Wait until everything recorded so far is on disk."""
+        if self._buffer:
+            self._flush()
+        write = self._last_write
+        if write is not None and not write.done():
+            try:
+                await asyncio.wrap_future(write)
+            except Exception:
+                # Logged by the writer, a full disk shouldn't stop role edits
+                pass
+
+    def close(self):
+        """Write what's buffered and close the log."""
+        if self._closed:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # Waits for queued writes. The rest is written from this thread, at exit
+        # the executor no longer takes new work
+        self._executor.shutdown(wait=True)
+        self._closed = True
+        if self._buffer and self._file is not None:
+            lines, self._buffer = self._buffer, []
+            try:
+                self._write("".join(lines))
+            except Exception:
+                pass
+        self._close_file()
+
+    def _schedule(self):
+        if self._flush_handle is None and self._buffer and not self._closed:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        self._lines += len(lines)
+        self._last_write = self._executor.submit(self._write, "".join(lines))
+        if self._lines > self.compact_lines and len(self._open) * 4 < self._lines:
+            # Lines recorded after this point are appended to the compacted log
+            self._last_write = self._executor.submit(self._compact, dict(self._open))
+            self._lines = len(self._open)
+
+    # Called on the writer thread
+
+    def _open_log(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # The line being written when the process died
+                        logger.warning("Ignoring incomplete outbox line %r", line)
+                        continue
+                    parts = line.split()
+                    try:
+                        if len(parts) == 6 and parts[0] == "+":
+                            seq, guild_id, user_id, role_id, add = (int(part) for part in parts[1:])
+                            self._open[seq] = (guild_id, user_id, role_id, add == 1)
+                            self._next_seq = max(self._next_seq, seq + 1)
+                        elif len(parts) == 2 and parts[0] == "-":
+                            self._open.pop(int(parts[1]), None)
+                    except ValueError:
+                        logger.warning("Ignoring damaged outbox line %r", line)
+        self.stats.replayed = len(self._open)
+        self._compact(dict(self._open))
+        self._lines = len(self._open)
+        if self._open:
+            logger.info("Found %d unfinished role changes in %s", len(self._open), self.path)
+        return [(seq, *change) for seq, change in sorted(self._open.items())]
+
+    def _write(self, data):
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.stats.batches += 1
+        except Exception:
+            self.stats.errors += 1
+            logger.exception("Could not write to the role change outbox %s", self.path)
+            raise
+
+    def _compact(self, changes):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for seq, (guild_id, user_id, role_id, add) in sorted(changes.items()):
+                f.write(f"+ {seq} {guild_id} {user_id} {role_id} {1 if add else 0}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._close_file()
+        self._file = open(self.path, 'a')
+        self.stats.compactions += 1
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
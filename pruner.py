@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from metrics import Counter
+
+logger = logging.getLogger("pruner")
+
+MAPPINGS_PRUNED = Counter(
+    "rolebot_mappings_pruned", "Role messages and menu entries removed because what they point at is gone.",
+    ("reason",)
+)
+
+# Discord's JSON error codes for a message or channel that doesn't exist. Any
+# other 404 (a proxy, a wrong API base) says nothing about the message.
+UNKNOWN_CHANNEL = 10003
+UNKNOWN_MESSAGE = 10008
+
+
+class PruneReport:
+    """What one compaction sweep checked and removed."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.messages = 0
+        self.messages_total = 0
+        self.messages_skipped = 0
+        self.requests = 0
+        self.messages_removed = 0
+        self.roles_removed = 0
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        return (
+            f"{self.messages}/{self.messages_total} messages checked ({self.messages_skipped} skipped), "
+            f"{self.requests} requests, {self.messages_removed} messages and {self.roles_removed} "
+            f"deleted roles removed, {self.elapsed:.1f}s elapsed"
+        )
+
+
+class MappingPruner:
+    """
+    Removes role mappings whose message, channel, role or guild no longer exists.
+
+    While the bot is online the delete events do this as they arrive. A sweep
+    catches what was deleted while it was offline (or while a shard was
+    disconnected): deleted roles and guilds the bot has left are found in the
+    cache, and each role message is fetched once, ``batch_size`` at a time with
+    ``batch_delay`` seconds between batches, so a sweep over many menus is
+    spread out instead of competing with role edits for the REST budget. Only
+    Discord's "Unknown Message" and "Unknown Channel" errors remove a message,
+    a message the bot can't read (403) or that fails otherwise is kept for the
+    next sweep.
+
+    ``forget_messages(message_ids, reason)`` and ``forget_role(guild_id,
+    role_id)`` do the removal, they're the same functions the event handlers
+    use. Messages in ``checked`` (read moments ago, e.g. by the startup
+    reconcile pass) aren't fetched again.
+
+    ``owns_guild`` (``ShardConfig.owns_guild``) tells whether this process
+    runs a guild's shard. Processes of a partitioned deployment share the
+    mapping store, and a guild missing from this process's cache is only
+    forgotten if it would be there.
+    """
+
+    def __init__(self, bot, forget_messages, forget_role, batch_size=25, batch_delay=5.0, owns_guild=None):
+        self.bot = bot
+        self.forget_messages = forget_messages
+        self.forget_role = forget_role
+        self.owns_guild = owns_guild
+        self.batch_size = max(batch_size, 1)
+        self.batch_delay = batch_delay
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def run(self, role_mappings, mapping_locations, checked=()):
+        """Check every placed role message once, those in ``checked`` without a request."""
+        async with self._lock:
+            report = PruneReport()
+            by_guild = {}
+            for message_id, (guild_id, channel_id) in list(mapping_locations.items()):
+                if message_id not in role_mappings:
+                    continue
+                report.messages_total += 1
+                if guild_id is None or channel_id is None:
+                    # Saved by an older version, we don't know where to look for it
+                    report.messages_skipped += 1
+                    continue
+                by_guild.setdefault(guild_id, []).append((channel_id, message_id))
+
+            try:
+                for guild_id, messages in by_guild.items():
+                    await self._prune_guild(guild_id, messages, role_mappings, checked, report)
+            finally:
+                report.finished = time.monotonic()
+            logger.info("Mapping sweep finished: %s", report.summary())
+            return report
+
+    async def _prune_guild(self, guild_id, messages, role_mappings, checked, report):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            if not self.bot.is_ready() or (self.owns_guild is not None and not self.owns_guild(guild_id)):
+                report.messages_skipped += len(messages)
+                return
+            # Every guild (even an unavailable one) is known once the bot is
+            # ready, so the bot has left this one
+            report.messages_removed += self.forget_messages([message_id for _, message_id in messages], "guild removed")
+            report.messages += len(messages)
+            return
+        if guild.unavailable:
+            report.messages_skipped += len(messages)
+            return
+
+        # Roles are all cached with the guild, so deleted ones cost no requests
+        role_ids = {role_id for _, message_id in messages for role_id in role_mappings.get(message_id, {}).values()}
+        for role_id in role_ids:
+            if guild.get_role(role_id) is None:
+                report.roles_removed += 1
+                self.forget_role(guild_id, role_id)
+        # Menus emptied by that are already gone, and the others may just have been read
+        report.messages += sum(message_id not in role_mappings or message_id in checked for _, message_id in messages)
+        messages = [(channel_id, message_id) for channel_id, message_id in messages if message_id not in checked]
+
+        for start in range(0, len(messages), self.batch_size):
+            if start:
+                await asyncio.sleep(self.batch_delay)
+            batch = [(channel_id, message_id) for channel_id, message_id in messages[start:start + self.batch_size]
+                     if message_id in role_mappings]
+            results = await asyncio.gather(*[self._exists(channel_id, message_id) for channel_id, message_id in batch])
+            report.requests += len(batch)
+            report.messages += sum(result is not None for result in results)
+            report.messages_skipped += sum(result is None for result in results)
+            gone = [message_id for (_, message_id), exists in zip(batch, results) if exists is False]
+            if gone:
+                report.messages_removed += self.forget_messages(gone, "message deleted")
+
+    async def _exists(self, channel_id, message_id):
+        """True or False, or None if we couldn't tell."""
+        try:
+            await self.bot.http.get_message(channel_id, message_id)
+            return True
+        except discord.NotFound as e:
+            if e.code in (UNKNOWN_CHANNEL, UNKNOWN_MESSAGE):
+                return False
+            logger.warning("Could not check role message %s: %s", message_id, e)
+            return None
+        except discord.HTTPException as e:
+            logger.warning("Could not check role message %s: %s", message_id, e)
+            return None
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from emoji_index import emoji_key
+from pruner import UNKNOWN_CHANNEL, UNKNOWN_MESSAGE
+
+logger = logging.getLogger("reconcile")
+
+# Discord returns at most 100 users per reaction page
+PAGE_SIZE = 100
+
+
+class ReconcileReport:
+    """Progress and pacing of one reconciliation pass."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.messages = 0
+        self.messages_total = 0
+        self.messages_skipped = 0
+        self.pages = 0
+        self.reactors = 0
+        # Reactors not in the member cache, whose roles weren't checked
+        self.unchecked = 0
+        self.adds = 0
+        self.removes = 0
+        # Pages that took much longer than a normal request, i.e. hit a rate limit
+        self.slow_pages = 0
+        self.slow_page_seconds = 0.0
+        # Time spent waiting for the role queue to drain
+        self.backpressure_seconds = 0.0
+        # Messages that were read, and those Discord says no longer exist
+        self.read = set()
+        self.deleted = 0
+        self.notes = []
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        elapsed = self.elapsed
+        rate = self.pages / elapsed if elapsed > 0 else 0.0
+        lines = [
+            f"{self.messages}/{self.messages_total} messages ({self.messages_skipped} skipped, {self.deleted} deleted), "
+            f"{self.pages} pages, {self.reactors} reactors",
+            f"{self.adds} roles to add, {self.removes} to remove, {self.unchecked} reactors not cached and not checked",
+            f"{self.slow_pages} pages slowed by rate limits ({self.slow_page_seconds:.1f}s), "
+            f"{self.backpressure_seconds:.1f}s waiting for the role queue",
+            f"{rate:.1f} pages/s, {elapsed:.1f}s elapsed",
+        ]
+        return "\n".join(lines + self.notes)
+
+
+class Reconciler:
+    """
+    Brings member roles back in line with the reactions on role messages.
+
+    Reactions added or removed while the bot was offline never reach the reaction
+    handlers. A pass pages through the users of every mapped reaction (100 per
+    request, only their IDs are kept) and queues the missing roles on the role
+    edit queue. With ``remove_stale``, members holding a mapped role without any
+    matching reaction lose it again. That needs the member cache (``full``
+    profile) and also removes roles that were given out by hand, so it is off
+    unless requested.
+
+    Without the member cache (``lean`` profile) a reactor's roles are unknown,
+    and queueing their role anyway costs one add call per reactor on every
+    pass, so those reactors are only counted unless ``add_uncached`` is set.
+
+    At most ``concurrency`` messages are processed at once and pages are spaced
+    at least ``page_delay`` seconds apart per worker. When the role edit queue
+    has more than ``max_pending`` members waiting, paging pauses until it drains,
+    so the REST budget isn't used up by the pass alone.
+
+    Messages Discord reports as deleted are handed to ``forget_messages``
+    (the pruner's, see ``pruner.MappingPruner``), and the report lists the
+    messages that were read, so a sweep right after the pass can skip them.
+    """
+
+    def __init__(self, bot, role_queue, concurrency=2, page_delay=0.25, max_pending=200,
+                 slow_page_seconds=1.0, remove_stale=False, add_uncached=False, forget_messages=None):
+        self.bot = bot
+        self.role_queue = role_queue
+        self.forget_messages = forget_messages
+        self.concurrency = concurrency
+        self.page_delay = page_delay
+        self.max_pending = max_pending
+        self.slow_page_seconds = slow_page_seconds
+        self.remove_stale = remove_stale
+        self.add_uncached = add_uncached
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def run(self, role_mappings, mapping_locations, guild_id=None, remove_stale=None, add_uncached=None,
+                  progress=None, progress_interval=10.0):
+        """
+        Reconcile every mapped message, or only those of ``guild_id``.
+
+        ``remove_stale`` and ``add_uncached`` override the reconciler's defaults
+        for this pass.
+        ``progress`` is an optional coroutine function called with the report
+        roughly every ``progress_interval`` seconds and once at the end.
+        """
+        if remove_stale is None:
+            remove_stale = self.remove_stale
+        if add_uncached is None:
+            add_uncached = self.add_uncached
+        async with self._lock:
+            report = ReconcileReport()
+            by_guild = {}
+            for message_id, emoji_roles in list(role_mappings.items()):
+                message_guild_id, channel_id = mapping_locations.get(message_id, (None, None))
+                if guild_id is not None and message_guild_id != guild_id:
+                    continue
+                report.messages_total += 1
+                if message_guild_id is None or channel_id is None:
+                    # Saved by an older version, we don't know where to look for it
+                    report.messages_skipped += 1
+                    continue
+                by_guild.setdefault(message_guild_id, []).append((channel_id, message_id, dict(emoji_roles)))
+
+            if report.messages_skipped:
+                report.notes.append(
+                    f"{report.messages_skipped} messages were saved without their channel and can't be checked"
+                )
+
+            reporter = asyncio.create_task(self._report_progress(report, progress, progress_interval))
+            try:
+                for message_guild_id, messages in by_guild.items():
+                    guild = self.bot.get_guild(message_guild_id)
+                    if guild is None:
+                        # Not a guild this process (or shard) can see
+                        report.messages_skipped += len(messages)
+                        continue
+                    await self._reconcile_guild(guild, messages, report, remove_stale, add_uncached)
+            finally:
+                reporter.cancel()
+                report.finished = time.monotonic()
+            if progress is not None:
+                await progress(report)
+            logger.info("Reconciliation finished:\n%s", report.summary())
+            return report
+
+    async def _report_progress(self, report, progress, interval):
+        if progress is None:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await progress(report)
+            except Exception as e:
+                logger.warning("Could not report reconciliation progress: %s", e)
+
+    async def _reconcile_guild(self, guild, messages, report, remove_stale, add_uncached):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # role_id -> IDs of members reacting for it, only collected for removals
+        reactors_by_role = {} if remove_stale else None
+        failed = []
+        deleted = []
+
+        async def worker(channel_id, message_id, emoji_roles):
+            async with semaphore:
+                try:
+                    await self._reconcile_message(
+                        guild, channel_id, message_id, emoji_roles, report, reactors_by_role, add_uncached
+                    )
+                except discord.HTTPException as e:
+                    failed.append(message_id)
+                    report.messages_skipped += 1
+                    if isinstance(e, discord.NotFound) and e.code in (UNKNOWN_CHANNEL, UNKNOWN_MESSAGE):
+                        deleted.append(message_id)
+                    else:
+                        logger.warning("Could not reconcile message %s: %s", message_id, e)
+
+        await asyncio.gather(*[worker(*message) for message in messages])
+        if deleted and self.forget_messages is not None:
+            report.deleted += self.forget_messages(deleted, "message deleted")
+
+        if reactors_by_role is not None:
+            if failed:
+                # Without every reactor we'd strip roles from people who did react
+                report.notes.append(f"Removals skipped for {guild.name}: {len(failed)} messages couldn't be read")
+            else:
+                self._queue_removals(guild, reactors_by_role, report)
+
+    async def _reconcile_message(self, guild, channel_id, message_id, emoji_roles, report, reactors_by_role,
+                                 add_uncached):
+        data = await self.bot.http.get_message(channel_id, message_id)
+        report.read.add(message_id)
+        roles_by_key = {emoji_key(emoji): role_id for emoji, role_id in emoji_roles.items()}
+        if reactors_by_role is not None:
+            # A role whose reaction is gone completely still needs its holders checked
+            for role_id in roles_by_key.values():
+                reactors_by_role.setdefault(role_id, set())
+
+        for reaction in data.get("reactions", []):
+            emoji = reaction["emoji"]
+            key = int(emoji["id"]) if emoji.get("id") else emoji_key(emoji["name"])
+            role_id = roles_by_key.get(key)
+            if role_id is None:
+                continue
+            reaction_str = f"{emoji['name']}:{emoji['id']}" if emoji.get("id") else emoji["name"]
+            reactors = reactors_by_role.setdefault(role_id, set()) if reactors_by_role is not None else None
+            await self._reconcile_reaction(
+                guild, channel_id, message_id, reaction_str, role_id, report, reactors, add_uncached
+            )
+
+        report.messages += 1
+
+    async def _reconcile_reaction(self, guild, channel_id, message_id, reaction_str, role_id, report, reactors,
+                                  add_uncached):
+        after = None
+        while True:
+            await self._wait_for_queue(report)
+
+            started = time.monotonic()
+            page = await self.bot.http.get_reaction_users(channel_id, message_id, reaction_str, PAGE_SIZE, after=after)
+            took = time.monotonic() - started
+            report.pages += 1
+            if took > self.slow_page_seconds:
+                report.slow_pages += 1
+                report.slow_page_seconds += took
+
+            for user in page:
+                if user.get("bot"):
+                    continue
+                user_id = int(user["id"])
+                report.reactors += 1
+                if reactors is not None:
+                    reactors.add(user_id)
+                member = guild.get_member(user_id)
+                if member is not None:
+                    if member.get_role(role_id) is not None:
+                        continue
+                elif guild.chunked:
+                    # Every member is cached, so this one has left the server
+                    continue
+                elif not add_uncached:
+                    # We can't tell whether they have the role, and the queue would
+                    # add it unconditionally with one call each
+                    report.unchecked += 1
+                    continue
+                self.role_queue.submit(guild.id, user_id, role_id, add=True)
+                report.adds += 1
+
+            if len(page) < PAGE_SIZE:
+                return
+            after = int(page[-1]["id"])
+            if self.page_delay:
+                await asyncio.sleep(self.page_delay)
+
+    def _queue_removals(self, guild, reactors_by_role, report):
+        if not guild.chunked:
+            report.notes.append(f"Removals skipped for {guild.name}: its members aren't cached")
+            return
+        for role_id, reactors in reactors_by_role.items():
+            role = guild.get_role(role_id)
+            if role is None:
+                continue
+            for member in role.members:
+                if member.id not in reactors and not member.bot:
+                    self.role_queue.submit(guild.id, member.id, role_id, add=False)
+                    report.removes += 1
+
+    async def _wait_for_queue(self, report):
+        if self.role_queue.pending_members <= self.max_pending:
+            return
+        started = time.monotonic()
+        while self.role_queue.pending_members > self.max_pending // 2:
+            await asyncio.sleep(0.5)
+        report.backpressure_seconds += time.monotonic() - started
@@ -1,23 +1,21 @@
-import time
+import asyncio
 import logging
-import requests
 import os
-import sys
+import random
 import re
-from threading import Thread
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+import time
+
+from metrics import CallbackMetric, Counter
+
 logger = logging.getLogger("replit_ping")
 
-def get_replit_url():
-    """Get the current Replit URL from environment variables or webserver log"""
+PINGS = Counter("rolebot_self_pings", "Self-pings by result.", ("result",))
+
+# Resolved once and reused until a ping fails, see get_replit_url()
+_cached_url = None
+
+def _find_replit_url():
+    """Work out the current Replit URL from the webserver log or environment variables"""
     # Method 1: Try to get from a webserver log
     try:
         with open('webserver.log', 'r') as f:
@@ -27,74 +25,44 @@ def get_replit_url():
                     match = re.search(r'Running on (http://[^ ]+)', line)
                     if match:
                         url = match.group(1)
-                        logger.info(f"Found URL in logs: {url}")
+                        logger.info("Found URL in logs: %s", url)
                         return url
-    except:
-        pass
-    
-    # Method 2: Check directly in Flask's werkzeug logs
-    try:
-        for line in sys.stdout.buffer:  # Try to read from stdout buffer
-            line_str = line.decode('utf-8', errors='ignore')
-            if 'Running on http://' in line_str and 'Running on http://127.0.0.1' not in line_str and 'Running on http://0.0.0.0' not in line_str:
-                # Extract the URL from the log
-                match = re.search(r'Running on (http://[^ ]+)', line_str)
-                if match:
-                    url = match.group(1)
-                    logger.info(f"Found URL in stdout: {url}")
-                    return url
-    except:
+    except OSError:
         pass
-    
-    # Method 3: Use a hardcoded URL based on Replit's new format
+
+    # Method 2: Replit's dev domain, set on current Replit deployments
+    dev_domain = os.environ.get('REPLIT_DEV_DOMAIN', '')
+    if dev_domain:
+        url = f"https://{dev_domain}"
+        logger.info("Using Replit dev domain: %s", url)
+        return url
+
+    # Method 3: Use a hardcoded URL based on Replit's older format
     # Extract username from environment
     username = os.environ.get('REPL_OWNER', 'unknown')
     slug = os.environ.get('REPL_SLUG', 'unknown')
-    
+
     if username != 'unknown' and slug != 'unknown':
         url = f"https://{slug}.{username}.repl.co"
-        logger.info(f"Using constructed URL: {url}")
+        logger.info("Using constructed URL: %s", url)
         return url
-    
-    # Method 4: Try Replit's newer URL format with ID
-    replit_id = os.environ.get('REPL_ID', '')
-    if replit_id:
-        # This follows the pattern seen in your error message
-        url = f"https://{slug}.{username}.repl.co"
-        logger.info(f"Using ID-based URL: {url}")
-        return url
-    
+
     # Fallback to localhost if nothing else works
-    logger.warning("Couldn't determine Replit URL, using localhost:8080")
-    return "http://localhost:8080"
+    port = os.getenv('HEALTH_PORT', '8080')
+    logger.warning("Couldn't determine Replit URL, using localhost:%s", port)
+    return f"http://localhost:{port}"
 
-def ping_self():
-    """Ping the Replit instance to keep it alive"""
-    url = get_replit_url()
-    try:
-        response = requests.get(f"{url}", timeout=10)  # Try root URL first
-        logger.info(f"Self-ping successful to root URL: {response.status_code}")
-        
-        # Also try health endpoint
-        try:
-            health_response = requests.get(f"{url}/health", timeout=5)
-            logger.info(f"Health endpoint ping: {health_response.status_code}")
-        except:
-            logger.info("Health endpoint not responsive, but root URL is working")
-            
-        return True
-    except Exception as e:
-        logger.error(f"Self-ping failed: {e}")
-        # Try with HTTP if HTTPS failed
-        if url.startswith("https://"):
-            try:
-                http_url = url.replace("https://", "http://")
-                response = requests.get(http_url, timeout=10)
-                logger.info(f"Self-ping successful with HTTP: {response.status_code}")
-                return True
-            except Exception as e2:
-                logger.error(f"HTTP fallback also failed: {e2}")
-        return False
+def get_replit_url(refresh=False):
+    """The Replit URL, resolved on first use and cached. ``refresh`` resolves it again."""
+    global _cached_url
+    if _cached_url is None or refresh:
+        _cached_url = _find_replit_url()
+    return _cached_url
+
+def invalidate_replit_url():
+    """Forget the cached URL, the next ping resolves it again."""
+    global _cached_url
+    _cached_url = None
 
 def write_url_to_file():
     """Writes the URL to a file for UptimeRobot setup"""
@@ -104,28 +72,143 @@ def write_url_to_file():
             f.write(f"Your Replit URL: {url}\n")
             f.write(f"UptimeRobot URL: {url}/health\n")
             f.write("\nCopy these URLs for setting up UptimeRobot.")
-        logger.info(f"Wrote URL information to replit_url.txt")
+        logger.info("Wrote URL information to replit_url.txt")
     except Exception as e:
-        logger.error(f"Failed to write URL to file: {e}")
+        logger.error("Failed to write URL to file: %s", e)
+
+
+class SelfPinger:
+    """
+    Pings the bot's own public URL so Replit keeps it running.
+
+    Runs as a task on the bot's event loop and reuses one pooled HTTP session,
+    so consecutive pings share a keep-alive connection. After a failed ping the
+    cached URL is dropped and resolved again, and the next attempt comes after
+    an exponential backoff (from ``retry_delay`` up to ``interval``) with random
+    jitter, so restarts of many bots don't ping in lockstep.
+    """
+
+    def __init__(self, interval=240, retry_delay=15, timeout=10):
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.url = None
+        self.pings = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = None  # unix time of the last successful ping
+        self.last_latency = None  # seconds the last successful ping took
+        self.last_error = None
+        self._session = None
+        self._task = None
+
+    def start(self):
+        """Start pinging from the running event loop. Calling it again is a no-op."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info("Self-pinger started with interval of %s seconds", self.interval)
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def next_delay(self):
+        """Seconds until the next ping: the interval, or a backoff after failures. Both jittered."""
+        if self.consecutive_failures:
+            delay = min(self.interval, self.retry_delay * 2 ** (self.consecutive_failures - 1))
+        else:
+            delay = self.interval
+        return delay * random.uniform(0.8, 1.2)
+
+    async def ping(self):
+        """Ping the URL once. Returns True if it answered."""
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.url = get_replit_url()
+        self.pings += 1
+        started = time.monotonic()
+        try:
+            async with self._session.get(self.url) as response:
+                await response.read()
+                if response.status >= 500:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(e) or type(e).__name__
+            PINGS.labels(result="failure").inc()
+            invalidate_replit_url()
+            logger.error("Self-ping to %s failed: %s", self.url, self.last_error)
+            return False
+        self.last_latency = time.monotonic() - started
+        self.last_success = time.time()
+        self.consecutive_failures = 0
+        PINGS.labels(result="success").inc()
+        logger.debug("Self-ping successful: %s in %.0f ms", response.status, self.last_latency * 1000)
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await self.ping()
+                except Exception:
+                    self.consecutive_failures += 1
+                    logger.exception("Unexpected error while pinging")
+                await asyncio.sleep(self.next_delay())
+        finally:
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+
+    def stats(self):
+        """Summary for the /health endpoint."""
+        return {
+            "url": self.url,
+            "pings": self.pings,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_success": self.last_success,
+            "last_latency_ms": round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+            "last_error": self.last_error,
+        }
+
 
 def start_self_pinger(interval_seconds=240):  # 4 minutes
-    """Start a background thread that pings the Replit instance periodically"""
+    """Start a self-pinger task on the running event loop and return it"""
     # First, write the URL to a file for reference
     write_url_to_file()
-    
-    def pinger_thread():
-        while True:
-            ping_self()
-            time.sleep(interval_seconds)
-    
-    thread = Thread(target=pinger_thread, daemon=True)
-    thread.start()
-    logger.info(f"Self-pinger started with interval of {interval_seconds} seconds")
-    return thread
+
+    pinger = SelfPinger(interval=interval_seconds)
+    pinger.start()
+    CallbackMetric("rolebot_self_ping_latency_seconds", "Duration of the last successful self-ping.",
+                   lambda: pinger.last_latency)
+    CallbackMetric("rolebot_self_ping_last_success_seconds", "Unix time of the last successful self-ping.",
+                   lambda: pinger.last_success)
+    return pinger
 
 if __name__ == "__main__":
     # If run directly, just ping once and print the URL
+    from log_setup import setup_logging
+    setup_logging()
     url = get_replit_url()
     print(f"Detected Replit URL: {url}")
     print(f"Health endpoint: {url}/health")
-    ping_self() 
\ No newline at end of file
+
+    async def ping_once():
+        pinger = SelfPinger()
+        try:
+            return await pinger.ping()
+        finally:
+            await pinger.stop()
+
+    asyncio.run(ping_once())
@@ -0,0 +1,450 @@
+"""
+Apply role changes in separate worker processes.
+
+With ``REST_WORKERS`` set, the bot's reaction handlers only look reactions up in
+the mapping index and write a one-line job (``seq guild user role add``) to a
+local Unix socket. Each worker process reads its socket, batches and throttles
+the changes per member like the in-process role edit queue does, and makes the
+REST calls with its own HTTP session and rate limit state. Guilds are split
+across workers the same way Discord splits them across shards, so each guild's
+edits and throttle live in one worker.
+
+``seq`` is the change's number in the bot's role change outbox. A worker writes
+back ``seq 1`` once the change is applied (or failed for good) and ``seq 0``
+once it gave up on it for now, and only then does the bot consider the job
+finished. Jobs a worker took but didn't answer are sent again to its
+replacement, and anything still open when the bot stops is replayed from the
+outbox on the next start.
+
+The bot starts and restarts its workers itself. To run one by hand (for
+debugging), with DISCORD_TOKEN set:
+
+    python rest_workers.py --socket /tmp/rolebot-rest.sock
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+import discord
+
+from metrics import instrument_http
+from role_queue import REASON, ROLE_APPLY_SECONDS, SINGLE_ROLE_CHANGES, RoleEditCoalescer
+from scheduler import GuildScheduler
+from sharding import shard_for_guild
+from throttle import ReactionThrottle
+
+logger = logging.getLogger("rest_workers")
+
+def encode_job(seq, guild_id, user_id, role_id, add):
+    return b"%d %d %d %d %d\n" % (seq, guild_id, user_id, role_id, 1 if add else 0)
+
+
+def decode_job(line):
+    seq, guild_id, user_id, role_id, add = line.split()
+    return int(seq), int(guild_id), int(user_id), int(role_id), add == b"1"
+
+
+class JobAcks:
+    """
+    Takes the outbox's place in a worker: the bot keeps the log, and the worker
+    reports finished changes back to it over the current connection.
+    """
+
+    def __init__(self):
+        self.writer = None
+        # Answers for a moment without a connection, sent once the bot reconnects
+        self._unsent = []
+
+    def connected(self, writer):
+        self.writer = writer
+        self._send()
+
+    def disconnected(self, writer):
+        if self.writer is writer:
+            self.writer = None
+
+    def done(self, seqs):
+        self._unsent.extend(b"%d 1\n" % seq for seq in seqs)
+        self._send()
+
+    def leave_open(self, seqs):
+        self._unsent.extend(b"%d 0\n" % seq for seq in seqs)
+        self._send()
+
+    async def sync(self):
+        # The bot made the change durable before sending it
+        pass
+
+    def _send(self):
+        if self.writer is not None and self._unsent and not self.writer.is_closing():
+            self.writer.write(b"".join(self._unsent))
+            self._unsent = []
+
+
+class RestRoleEditCoalescer(RoleEditCoalescer):
+    """
+    The role edit queue for a worker, which has no gateway connection and no member cache.
+
+    Small batches are applied with one add/remove call per role, which needs no
+    fetch and can't overwrite roles changed elsewhere. Larger ones fetch the
+    member right before the edit that replaces their role list.
+    """
+
+    def __init__(self, http, **kwargs):
+        super().__init__(None, None, **kwargs)
+        self.http = http
+
+    async def _apply(self, guild_id, user_id, changes, first_change=None, member=None, trust_cache=True):
+        if len(changes) <= SINGLE_ROLE_CHANGES:
+            await self._apply_each(guild_id, user_id, changes, first_change)
+            return
+
+        self.stats.fetches += 1
+        try:
+            data = await self.http.get_member(guild_id, user_id)
+        except discord.NotFound:
+            logger.warning("Could not find member with ID %s in guild %s", user_id, guild_id)
+            return
+        current = {int(role_id) for role_id in data["roles"]}
+
+        adds = {role_id for role_id, add in changes.items() if add and role_id not in current}
+        removes = {role_id for role_id, add in changes.items() if not add and role_id in current}
+        if not adds and not removes:
+            self.stats.noops += 1
+            return
+
+        roles = (current - removes) | adds
+        await self.http.edit_member(guild_id, user_id, roles=[str(role_id) for role_id in roles], reason=REASON)
+        self.stats.edits += 1
+        if first_change is not None:
+            ROLE_APPLY_SECONDS.observe(time.monotonic() - first_change)
+        logger.info(
+            "Updated roles for member %s: +%s -%s", user_id, sorted(adds), sorted(removes),
+            extra={"guild_id": guild_id, "user_id": user_id, "changes": len(changes)}
+        )
+
+
+class RestWorker:
+    """One worker process: reads jobs from a Unix socket and applies them."""
+
+    def __init__(self, socket_path, token, queue_options, stats_interval=600.0):
+        self.socket_path = socket_path
+        self.token = token
+        self.queue_options = queue_options
+        self.stats_interval = stats_interval
+        self.http = None
+        self.queue = None
+        self.acks = None
+        self.jobs = 0
+
+    async def run(self):
+        self.http = discord.http.HTTPClient(asyncio.get_running_loop())
+        instrument_http(self.http)
+        await self.http.static_login(self.token)
+        self.acks = JobAcks()
+        self.queue = RestRoleEditCoalescer(self.http, outbox=self.acks, **self.queue_options)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        logger.info("REST worker %d listening on %s", os.getpid(), self.socket_path)
+
+        parent = os.getppid()
+        last_stats = time.monotonic()
+        try:
+            # Exit with the bot: once it's gone, its jobs are done and nobody sends new ones
+            while os.getppid() == parent:
+                await asyncio.sleep(1)
+                if time.monotonic() - last_stats >= self.stats_interval:
+                    last_stats = time.monotonic()
+                    logger.info("REST worker %d: %d jobs, %s", os.getpid(), self.jobs, self.queue.stats.as_dict())
+                    if self.queue.scheduler is not None:
+                        logger.info(
+                            "REST worker %d scheduler: %s, busiest guilds %s",
+                            os.getpid(), self.queue.scheduler.stats.as_dict(), self.queue.scheduler.busiest(5)
+                        )
+            logger.info("REST worker %d: the bot exited, finishing pending changes", os.getpid())
+        finally:
+            server.close()
+            await self.queue.flush_all()
+            await self.http.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _handle(self, reader, writer):
+        self.acks.connected(writer)
+        try:
+            async for line in reader:
+                try:
+                    seq, *job = decode_job(line)
+                except ValueError:
+                    logger.warning("Ignoring malformed job %r", line)
+                    continue
+                self.jobs += 1
+                self.queue.submit(*job, seq=seq)
+        finally:
+            self.acks.disconnected(writer)
+            writer.close()
+
+
+class PoolStats:
+    def __init__(self):
+        self.submitted = 0  # role changes handed in by the reaction handlers
+        self.sent = 0  # jobs written to a worker socket
+        self.resent = 0  # of those, jobs sent again to a restarted worker
+        self.acked = 0  # jobs a worker reported as finished
+        self.left_open = 0  # jobs a worker gave up on, left in the outbox
+        self.dropped = 0  # jobs dropped because a worker's buffer was full
+        self.restarts = 0  # worker processes started again after exiting
+
+    def as_dict(self):
+        return {
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "resent": self.resent,
+            "acked": self.acked,
+            "left_open": self.left_open,
+            "dropped": self.dropped,
+            "restarts": self.restarts,
+        }
+
+
+class WorkerConnection:
+    """The bot's side of one worker: its process, its socket and the jobs it hasn't finished."""
+
+    def __init__(self, index, socket_path, max_buffered):
+        self.index = index
+        self.socket_path = socket_path
+        # (seq, job) not sent yet
+        self.buffer = deque()
+        self.max_buffered = max_buffered
+        # seq -> job sent to the worker and not answered yet, in the order sent
+        self.inflight = {}
+        self.wakeup = asyncio.Event()
+        self.proc = None
+        self.task = None
+
+    def push(self, seq, job, stats):
+        if len(self.buffer) >= self.max_buffered:
+            # Still open in the outbox, so it's replayed on the next start
+            self.buffer.popleft()
+            stats.dropped += 1
+            if stats.dropped == 1 or stats.dropped % 1000 == 0:
+                logger.warning(
+                    "REST worker %d is not keeping up, dropped %d role changes so far (kept in the outbox)",
+                    self.index, stats.dropped
+                )
+        self.buffer.append((seq, job))
+        self.wakeup.set()
+
+
+class RestWorkerPool:
+    """
+    Hands role changes to ``workers`` worker processes instead of applying them in the bot.
+
+    Has the same ``submit``/``pending_members``/``stats``/``flush_all``/``outbox``
+    interface as ``RoleEditCoalescer``, so the reaction handlers, the reconciler
+    and the outbox replay use either one. ``submit`` logs the change in the
+    ``outbox`` (see ``outbox.RoleOutbox``) and appends a job to the guild's
+    worker buffer; a task per worker waits for the outbox to have the jobs on
+    disk and writes them to its socket in batches, and marks them done in the
+    outbox as the worker answers. Workers that exit are restarted and get the
+    jobs they hadn't answered again. Jobs wait in the buffer (up to
+    ``max_buffered`` per worker, the oldest are dropped after that) until their
+    worker is back.
+    """
+
+    def __init__(self, workers, queue_options=None, outbox=None, socket_dir=None, restart_delay=5.0,
+                 max_buffered=100_000):
+        self.workers = workers
+        self.queue_options = queue_options or {}
+        self.outbox = outbox
+        # Numbers the jobs when there's no outbox to do it
+        self._next_seq = 1
+        self.restart_delay = restart_delay
+        # Extra command line arguments for the workers, e.g. --api-base
+        self.worker_args = []
+        socket_dir = socket_dir or tempfile.gettempdir()
+        self._connections = [
+            WorkerConnection(index, os.path.join(socket_dir, f"rolebot-{os.getpid()}-{index}.sock"), max_buffered)
+            for index in range(workers)
+        ]
+        self.stats = PoolStats()
+
+    @property
+    def pending_members(self):
+        """Jobs not finished by a worker yet, used by the reconciler to pace itself."""
+        return sum(len(connection.buffer) + len(connection.inflight) for connection in self._connections)
+
+    def submit(self, guild_id, user_id, role_id, add, member=None):
+        # A member snapshot can't be handed to a worker, it applies the change like a reaction
+        self.stats.submitted += 1
+        if self.outbox is not None:
+            seq = self.outbox.record(guild_id, user_id, role_id, add)
+        else:
+            seq = self._next_seq
+            self._next_seq += 1
+        connection = self._connections[shard_for_guild(guild_id, self.workers)]
+        connection.push(seq, encode_job(seq, guild_id, user_id, role_id, add), self.stats)
+
+    async def start(self):
+        for connection in self._connections:
+            if connection.task is None:
+                connection.task = asyncio.get_running_loop().create_task(self._run(connection))
+        logger.info("Applying role changes in %d REST worker processes", self.workers)
+
+    async def flush_all(self, timeout=10.0):
+        """
+        Wait until the workers have finished every job, called when the bot
+        closes. Jobs still open after ``timeout`` stay in the outbox, and the
+        workers apply what they have before exiting.
+        """
+        deadline = time.monotonic() + timeout
+        while self.pending_members and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def _command(self, connection):
+        options = self.queue_options
+        return [
+            sys.executable, os.path.abspath(__file__), "--socket", connection.socket_path,
+            "--window", str(options.get("window", 1.0)), "--max-delay", str(options.get("max_delay", 3.0)),
+            "--member-rate", str(options.get("member_rate", 0.2)), "--member-burst", str(options.get("member_burst", 3)),
+            "--guild-rate", str(options.get("guild_rate", 5.0)), "--guild-burst", str(options.get("guild_burst", 10)),
+            "--concurrency", str(options.get("concurrency", 8)), "--queue-size", str(options.get("queue_size", 100)),
+        ] + self.worker_args
+
+    async def _start_process(self, connection):
+        if connection.proc is not None:
+            self.stats.restarts += 1
+        # The token comes from the environment, so it never shows up in the process list
+        connection.proc = await asyncio.create_subprocess_exec(*self._command(connection))
+        logger.info("Started REST worker %d (pid %d)", connection.index, connection.proc.pid)
+
+    async def _connect(self, connection):
+        while True:
+            if connection.proc is None:
+                await self._start_process(connection)
+            elif connection.proc.returncode is not None:
+                logger.warning(
+                    "REST worker %d exited with code %d, restarting in %.0fs",
+                    connection.index, connection.proc.returncode, self.restart_delay
+                )
+                await asyncio.sleep(self.restart_delay)
+                await self._start_process(connection)
+            try:
+                return await asyncio.open_unix_connection(connection.socket_path)
+            except OSError:
+                # Not listening yet (or just died)
+                await asyncio.sleep(0.2)
+
+    async def _run(self, connection):
+        while True:
+            writer = acks = None
+            try:
+                reader, writer = await self._connect(connection)
+                acks = asyncio.get_running_loop().create_task(self._read_acks(connection, reader))
+                if connection.inflight:
+                    # Taken by the previous worker (or connection) and never answered
+                    writer.write(b"".join(connection.inflight.values()))
+                    await writer.drain()
+                    self.stats.sent += len(connection.inflight)
+                    self.stats.resent += len(connection.inflight)
+                while True:
+                    await connection.wakeup.wait()
+                    connection.wakeup.clear()
+                    if acks.done() or connection.proc.returncode is not None:
+                        raise ConnectionError("worker exited")
+                    while connection.buffer:
+                        if self.outbox is not None:
+                            # A worker may apply a change as soon as it has it
+                            await self.outbox.sync()
+                        batch = []
+                        while connection.buffer:
+                            seq, job = connection.buffer.popleft()
+                            connection.inflight[seq] = job
+                            batch.append(job)
+                        # If the write fails they're sent again with the rest of inflight
+                        writer.write(b"".join(batch))
+                        await writer.drain()
+                        self.stats.sent += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(
+                    "Lost REST worker %d (%s), restarting in %.0fs", connection.index, e, self.restart_delay
+                )
+                await asyncio.sleep(self.restart_delay)
+            finally:
+                if acks is not None:
+                    acks.cancel()
+                if writer is not None:
+                    writer.close()
+
+    async def _read_acks(self, connection, reader):
+        try:
+            async for line in reader:
+                try:
+                    seq, done = (int(part) for part in line.split())
+                except ValueError:
+                    logger.warning("Ignoring malformed answer %r from REST worker %d", line, connection.index)
+                    continue
+                if connection.inflight.pop(seq, None) is None:
+                    continue
+                if done:
+                    self.stats.acked += 1
+                    if self.outbox is not None:
+                        self.outbox.done([seq])
+                else:
+                    self.stats.left_open += 1
+                    if self.outbox is not None:
+                        self.outbox.leave_open([seq])
+        finally:
+            # The worker closed the connection, let _run reconnect
+            connection.wakeup.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the role bot's role changes from a Unix socket.")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--window", type=float, default=1.0)
+    parser.add_argument("--max-delay", type=float, default=3.0)
+    parser.add_argument("--member-rate", type=float, default=0.2)
+    parser.add_argument("--member-burst", type=int, default=3)
+    parser.add_argument("--guild-rate", type=float, default=5.0)
+    parser.add_argument("--guild-burst", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent role edits, 0 for no limit")
+    parser.add_argument("--queue-size", type=int, default=100, help="Role edits queued per guild")
+    parser.add_argument("--api-base", help="Discord API base URL, for testing against benchmarks/fake_discord.py")
+    args = parser.parse_args()
+
+    from log_setup import setup_logging
+    setup_logging(level=os.getenv('LOG_LEVEL', 'INFO'), fmt=os.getenv('LOG_FORMAT', 'text'))
+
+    if os.path.exists('.env'):
+        from dotenv import load_dotenv
+        load_dotenv()
+    token = os.getenv('DISCORD_TOKEN')
+    if not token:
+        sys.exit("No Discord token found. Set DISCORD_TOKEN in your .env file or environment.")
+    if args.api_base:
+        discord.http.Route.BASE = args.api_base
+
+    worker = RestWorker(args.socket, token, {
+        "window": args.window,
+        "max_delay": args.max_delay,
+        "throttle": ReactionThrottle(args.member_rate, args.member_burst, args.guild_rate, args.guild_burst),
+        "scheduler": GuildScheduler(args.concurrency, args.queue_size) if args.concurrency > 0 else None,
+    })
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
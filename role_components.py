@@ -0,0 +1,164 @@
+import logging
+
+import discord
+
+from metrics import Counter
+
+logger = logging.getLogger("role_components")
+
+# A message holds 5 rows of 5 buttons, and a select menu holds 25 options
+BUTTONS_PER_ROW = 5
+COMPONENTS_PER_MESSAGE = 25
+
+# custom_ids of the menu components, everything the handler needs is in them
+CUSTOM_ID_PREFIX = "rolebot:"
+TOGGLE_PREFIX = CUSTOM_ID_PREFIX + "toggle:"
+SELECT_ID = CUSTOM_ID_PREFIX + "select"
+
+STYLES = ("buttons", "select")
+
+COMPONENT_CLICKS = Counter(
+    "rolebot_component_interactions", "Role menu button and select interactions by outcome.", ("kind", "result")
+)
+
+
+def toggle_id(role_id):
+    return f"{TOGGLE_PREFIX}{role_id}"
+
+
+def parse_custom_id(custom_id):
+    """
+    ``("toggle", role_id)`` for a role button, ``("select", None)`` for a role
+    select menu, or None for components that aren't ours.
+    """
+    if custom_id == SELECT_ID:
+        return "select", None
+    if custom_id.startswith(TOGGLE_PREFIX):
+        role_id = custom_id[len(TOGGLE_PREFIX):]
+        if role_id.isdigit():
+            return "toggle", int(role_id)
+    return None
+
+
+def check_menu_roles(pairs):
+    """
+    Errors for roles listed twice (their custom_ids would collide) or that the
+    bot can't give out (managed, or not below its highest role).
+    """
+    errors = []
+    seen = set()
+    for role, _ in pairs:
+        if role.id in seen:
+            errors.append(f"Role '{role.name}' is listed more than once.")
+            continue
+        seen.add(role.id)
+        if role.managed:
+            errors.append(f"Role '{role.name}' is managed by an integration and can't be assigned.")
+        elif not role.is_assignable():
+            errors.append(f"Role '{role.name}' is not below the bot's highest role.")
+    return errors
+
+
+def build_view(pairs, style):
+    """
+    The components of one menu message, for ``(role, emoji)`` pairs.
+
+    The view is only used to send the components: the handler works from the
+    custom_ids alone, so the caller should ``stop()`` it once the message is
+    sent and the menus keep working across restarts without being registered.
+    """
+    view = discord.ui.View(timeout=None)
+    if style == "select":
+        view.add_item(discord.ui.Select(
+            custom_id=SELECT_ID,
+            placeholder="Choose your roles",
+            min_values=0,
+            max_values=len(pairs),
+            options=[discord.SelectOption(label=role.name, value=str(role.id), emoji=emoji) for role, emoji in pairs],
+        ))
+    else:
+        for index, (role, emoji) in enumerate(pairs):
+            view.add_item(discord.ui.Button(
+                custom_id=toggle_id(role.id),
+                label=role.name,
+                emoji=emoji,
+                style=discord.ButtonStyle.secondary,
+                row=index // BUTTONS_PER_ROW,
+            ))
+    return view
+
+
+def select_roles(message):
+    """Role IDs offered by the role select menu of ``message``."""
+    role_ids = []
+    for row in message.components:
+        for component in getattr(row, "children", ()):
+            if getattr(component, "custom_id", None) == SELECT_ID:
+                role_ids.extend(int(option.value) for option in component.options)
+    return role_ids
+
+
+def describe_changes(guild, changes):
+    added = [guild.get_role(role_id).mention for role_id, add in changes if add]
+    removed = [guild.get_role(role_id).mention for role_id, add in changes if not add]
+    parts = []
+    if added:
+        parts.append(f"Adding {', '.join(added)}")
+    if removed:
+        parts.append(f"removing {', '.join(removed)}" if added else f"Removing {', '.join(removed)}")
+    return "; ".join(parts) + "." if parts else "You already have exactly these roles."
+
+
+class ComponentRoleHandler:
+    """
+    Applies clicks on role buttons and choices in role select menus.
+
+    Nothing is stored per menu. A button's custom_id names its role, and a
+    select menu's options (sent back with the interaction's message) are the
+    roles it manages: chosen ones are added, the others removed. The
+    interaction carries the member with their roles, which goes to the role
+    edit queue along with every change of the interaction, so the queue applies
+    them in a single edit without fetching the member. The member gets an
+    ephemeral reply right away.
+    """
+
+    def __init__(self, role_queue):
+        self.role_queue = role_queue
+
+    async def handle(self, interaction, kind, role_id):
+        guild = interaction.guild
+        member = interaction.user
+        if guild is None or not isinstance(member, discord.Member):
+            return
+
+        held = {role.id for role in member.roles}
+        if kind == "toggle":
+            offered = [role_id]
+            wanted = set() if role_id in held else {role_id}
+        else:
+            offered = select_roles(interaction.message)
+            wanted = {int(value) for value in interaction.data.get("values", ())}
+
+        # Roles deleted or moved above the bot since the menu was made are left alone
+        usable = []
+        for role_id in offered:
+            role = guild.get_role(role_id)
+            if role is not None and role.is_assignable():
+                usable.append(role_id)
+        if not usable:
+            COMPONENT_CLICKS.labels(kind=kind, result="unavailable").inc()
+            await interaction.response.send_message("These roles are no longer available.", ephemeral=True)
+            return
+
+        changes = [(role_id, role_id in wanted) for role_id in usable if (role_id in held) != (role_id in wanted)]
+        for role_id, add in changes:
+            self.role_queue.submit(guild.id, member.id, role_id, add=add, member=member)
+
+        COMPONENT_CLICKS.labels(kind=kind, result="changed" if changes else "unchanged").inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Role menu interaction", extra={
+                "guild_id": guild.id, "user_id": member.id, "kind": kind, "changes": len(changes)
+            })
+        await interaction.response.send_message(
+            describe_changes(guild, changes), ephemeral=True, allowed_mentions=discord.AllowedMentions.none()
+        )
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from emoji_index import CUSTOM_EMOJI_RE, emoji_key
+from metrics import Counter
+
+logger = logging.getLogger("role_menu")
+
+# Discord allows at most 20 different reactions on a message
+REACTIONS_PER_MESSAGE = 20
+
+# Longest error report that still fits in one message with the header
+MAX_REPORT_LENGTH = 1800
+
+SEEDED_REACTIONS = Counter("rolebot_menu_reactions_seeded", "Reactions added to new role menus by result.", ("result",))
+
+
+class RoleIndex:
+    """
+    Case-insensitive role name lookup, built once per command from ``guild.roles``.
+
+    An exact (case-sensitive) match wins. Otherwise the name has to match
+    exactly one role ignoring case, so "admin" finds "Admin" but not when there
+    are both "Admin" and "ADMIN".
+    """
+
+    def __init__(self, roles):
+        self._exact = {}
+        self._folded = {}
+        for role in roles:
+            if role.is_default():
+                continue
+            self._exact.setdefault(role.name, role)
+            self._folded.setdefault(role.name.casefold(), []).append(role)
+
+    def lookup(self, name):
+        """Return ``(role, error)``, exactly one of them is None."""
+        role = self._exact.get(name)
+        if role is not None:
+            return role, None
+        matches = self._folded.get(name.casefold(), [])
+        if len(matches) == 1:
+            return matches[0], None
+        if matches:
+            names = ", ".join(sorted(f"'{role.name}'" for role in matches))
+            return None, f"Role '{name}' is ambiguous, it matches {names}."
+        return None, f"Role '{name}' not found."
+
+
+def parse_role_pairs(text, role_index, bot=None):
+    """
+    Parse ``Role:emoji`` pairs separated by whitespace.
+
+    Every pair is checked before anything is sent: the format, that the role
+    exists (see ``RoleIndex``), that no emoji is used twice and, when ``bot``
+    is given, that custom emoji are ones the bot can use. Returns ``(pairs,
+    errors)`` with ``pairs`` a list of ``(role, emoji)`` in input order.
+    """
+    pairs = []
+    errors = []
+    seen_emojis = {}
+    for pair in text.split():
+        role_name, separator, emoji = pair.partition(":")
+        if not separator or not role_name or not emoji:
+            errors.append(f"Invalid format for pair: {pair}. Use Role:emoji")
+            continue
+
+        role, error = role_index.lookup(role_name)
+        if error is not None:
+            errors.append(error)
+            continue
+
+        match = CUSTOM_EMOJI_RE.fullmatch(emoji)
+        if match and bot is not None and bot.get_emoji(int(match.group(1))) is None:
+            errors.append(f"Emoji {emoji} for '{role.name}' isn't from a server the bot is in.")
+            continue
+
+        # Compared like the dispatch index matches them: ❤ and ❤️, or two names for
+        # one custom emoji ID, are the same reaction
+        key = emoji_key(emoji)
+        if key in seen_emojis:
+            errors.append(f"Emoji {emoji} is used for both '{seen_emojis[key]}' and '{role.name}'.")
+            continue
+        seen_emojis[key] = role.name
+        pairs.append((role, emoji))
+    return pairs, errors
+
+
+def split_menu(pairs, size=REACTIONS_PER_MESSAGE):
+    """Split the pairs into chunks that fit on one message each."""
+    return [pairs[i:i + size] for i in range(0, len(pairs), size)]
+
+
+def format_errors(errors, header):
+    """All validation errors in one message, cut short if they don't fit."""
+    lines = []
+    length = len(header)
+    for index, error in enumerate(errors):
+        if length + len(error) + 3 > MAX_REPORT_LENGTH:
+            lines.append(f"...and {len(errors) - index} more")
+            break
+        lines.append(f"- {error}")
+        length += len(error) + 3
+    return "\n".join([header] + lines)
+
+
+class SeedReport:
+    """Outcome of seeding the reactions of one role menu."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.added = 0
+        self.retries = 0
+        # (emoji, reason) for reactions that couldn't be added
+        self.failed = []
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+
+class ReactionSeeder:
+    """
+    Adds the reactions of new role menu messages, several messages at a time.
+
+    Reactions on one message are added in order, so they show up in the same
+    order as the roles in the embed. Different messages are seeded in parallel
+    (up to ``concurrency`` at once), so each message's next request is already
+    queued on discord.py's rate limit bucket while the previous one is in flight
+    and no time is lost between responses. A 429 that discord.py gives up on is
+    retried after a backoff, and a reaction that fails for any other reason
+    (such as an emoji Discord doesn't know) is reported instead of stopping the
+    whole menu.
+    """
+
+    def __init__(self, concurrency=4, max_retries=3, retry_delay=1.0):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    async def seed(self, messages):
+        """Add reactions to each ``(message, emojis)`` pair. Returns a SeedReport."""
+        report = SeedReport()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def seed_message(message, emojis):
+            async with semaphore:
+                for emoji in emojis:
+                    await self._add(message, emoji, report)
+
+        await asyncio.gather(*[seed_message(message, emojis) for message, emojis in messages])
+        report.finished = time.monotonic()
+        return report
+
+    async def _add(self, message, emoji, report):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await message.add_reaction(emoji)
+            except discord.HTTPException as e:
+                if e.status == 429 and attempt < self.max_retries:
+                    report.retries += 1
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                report.failed.append((emoji, e.text or str(e)))
+                SEEDED_REACTIONS.labels(result="failed").inc()
+                logger.warning(
+                    "Could not add reaction %s: %s", emoji, e,
+                    extra={"message_id": message.id, "status": e.status}
+                )
+                return
+            report.added += 1
+            SEEDED_REACTIONS.labels(result="added").inc()
+            return
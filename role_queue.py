@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+import discord
+
+from metrics import Histogram
+
+logger = logging.getLogger("role_queue")
+
+REASON = "Reaction roles"
+
+# Batches of up to this many changes for a member whose roles aren't known
+# first-hand are applied with one add/remove call per role instead of a fetch
+# plus an edit
+SINGLE_ROLE_CHANGES = 2
+
+# Failures that may go away on their own: Discord's 5xx (after discord.py's own
+# retries), rate limits it gave up on, timeouts and connection errors
+TRANSIENT_ERRORS = (discord.DiscordServerError, discord.RateLimited, asyncio.TimeoutError, aiohttp.ClientError, OSError)
+
+
+def is_transient(error):
+    return isinstance(error, TRANSIENT_ERRORS) or (isinstance(error, discord.HTTPException) and error.status == 429)
+
+# From the first reaction change of a batch to its role edit going through
+ROLE_APPLY_SECONDS = Histogram(
+    "rolebot_role_apply_seconds", "Time from a reaction to its role change being applied.",
+    buckets=(0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+)
+
+
+class CoalescerStats:
+    """Counters describing how much work the coalescer saved."""
+
+    def __init__(self):
+        self.submitted = 0  # role changes handed in by the reaction handlers
+        self.cancelled = 0  # add/remove pairs that cancelled each other out
+        self.edits = 0  # member.edit() calls actually made
+        self.fetches = 0  # members fetched right before an edit
+        self.noops = 0  # flushes where the member already had the final role set
+        self.failed = 0  # flushes that raised while applying
+        self.retried = 0  # attempts repeated after a transient error
+        self.throttled = 0  # flushes postponed by the throttle
+        self.deferred = 0  # flushes postponed because their guild's scheduler queue was full
+
+    @property
+    def calls_saved(self):
+        """REST calls avoided compared to one add_roles/remove_roles per change."""
+        return self.submitted - self.edits - self.fetches
+
+    def as_dict(self):
+        return {
+            "submitted": self.submitted,
+            "cancelled": self.cancelled,
+            "edits": self.edits,
+            "fetches": self.fetches,
+            "noops": self.noops,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "deferred": self.deferred,
+            "calls_saved": self.calls_saved,
+        }
+
+
+class RoleEditCoalescer:
+    """
+    Collects reaction role changes per (guild, member) and applies them in one edit.
+
+    Every change restarts a short debounce window (capped at ``max_delay`` after the
+    first pending change). When the window closes, the pending adds and removes are
+    folded into a final role set, changes the member already has are dropped and the
+    result is applied with a single ``member.edit(roles=...)`` call.
+
+    That edit replaces the member's whole role list, so it's only computed from
+    roles known to be current: discord.py's member cache, which the gateway keeps
+    up to date when the bot has the members intent, or a member fetched right
+    before the edit. Members that aren't in that cache (the lean profile never has
+    any) get small batches as one add/remove call per role, which can't undo role
+    changes made elsewhere and needs no fetch, and larger ones fetched first.
+
+    With a ``throttle`` (see ``throttle.ReactionThrottle``), a flush that would
+    exceed the member's or the guild's edit rate is postponed instead of made.
+    Changes keep folding into the pending set meanwhile, so once the burst is
+    over the member's final reaction state is applied in one edit.
+
+    With a ``scheduler`` (see ``scheduler.GuildScheduler``), edits that are
+    due wait for a slot in their guild's queue, so one guild's reaction storm
+    can't take every concurrent edit. The changes are only taken when the slot
+    is granted, so anything submitted while waiting goes into the same edit.
+
+    A caller that has the member as they are right now (a component interaction
+    carries it) can hand it to ``submit``. The edit that follows then uses its
+    roles instead of add/remove calls or a fetch, as long as it runs within
+    ``max_delay`` seconds and no other edit for the member was in flight when
+    the member was taken.
+
+    With an ``outbox`` (see ``outbox.RoleOutbox``), every change is logged when
+    it's submitted, made durable before the edit that applies it and marked
+    done afterwards, so changes lost to a crash can be replayed on startup.
+
+    An edit that fails with a transient error (a 5xx, 429, timeout or connection
+    error) is tried again after ``retry_delay`` seconds, doubling each time, by
+    the same flush, so edits queued behind it for the member still run after
+    it. Changes submitted meanwhile that no later flush has taken join the
+    retry and take precedence. After ``max_retries`` its changes are left open
+    in the outbox for the next start. Other errors
+    (unknown member or role, missing permissions) are permanent, their changes
+    are marked done.
+    """
+
+    def __init__(self, bot, resolve_member, window=1.0, max_delay=3.0, throttle=None, scheduler=None, outbox=None,
+                 max_retries=3, retry_delay=5.0):
+        self.bot = bot
+        self.http = bot.http if bot is not None else None
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.throttle = throttle
+        self.scheduler = scheduler
+        self.outbox = outbox
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._resolve_member = resolve_member
+        # (guild_id, user_id) -> {role_id: True for add, False for remove}
+        self._pending = {}
+        # (guild_id, user_id) -> [first_change, deadline, throttled_until] in loop time
+        self._deadlines = {}
+        # (guild_id, user_id) -> flush task currently applying changes
+        self._running = {}
+        # (guild_id, user_id) -> outbox sequence numbers of the pending changes
+        self._outbox_seqs = {}
+        # (guild_id, user_id) -> (taken at, member) handed to submit for the next edit
+        self._snapshots = {}
+        self.stats = CoalescerStats()
+
+    @property
+    def pending_members(self):
+        return len(self._pending)
+
+    def submit(self, guild_id, user_id, role_id, add, seq=None, member=None):
+        """
+        Queue a role add (``add=True``) or remove for a member. ``seq`` is the
+        change's outbox sequence number if the caller already logged it, and
+        ``member`` the member with their current roles if the caller has it.
+        """
+        self.stats.submitted += 1
+        key = (guild_id, user_id)
+        now = time.monotonic()
+        if self.outbox is not None:
+            if seq is None:
+                seq = self.outbox.record(guild_id, user_id, role_id, add)
+            self._outbox_seqs.setdefault(key, []).append(seq)
+        if member is not None and key not in self._running:
+            self._snapshots[key] = (now, member)
+        elif key in self._running:
+            # The edit in flight may change roles this copy doesn't show yet
+            self._snapshots.pop(key, None)
+
+        changes = self._pending.get(key)
+        if changes is None:
+            changes = self._pending[key] = {}
+            self._deadlines[key] = [now, now + self.window, 0.0]
+            asyncio.get_running_loop().create_task(self._flush_later(key))
+        else:
+            first, _, throttled_until = self._deadlines[key]
+            self._deadlines[key][1] = max(min(now + self.window, first + self.max_delay), throttled_until)
+
+        previous = changes.get(role_id)
+        if previous is not None and previous != add:
+            # The reaction went back to where it started, nothing to do for this role
+            del changes[role_id]
+            self.stats.cancelled += 1
+        else:
+            changes[role_id] = add
+
+    async def flush_all(self):
+        """
+        Apply every pending change now, e.g. before shutting down. The throttle
+        is skipped, but the edits still take turns in the guild scheduler.
+        """
+        keys = list(self._pending)
+        for key in keys:
+            if key in self._deadlines:
+                self._deadlines[key][1] = 0
+        await asyncio.gather(*[self._flush_in_slot(key) for key in keys], return_exceptions=True)
+        running = list(self._running.values())
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def _flush_later(self, key):
+        granted = self.throttle is None
+        while True:
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                return
+            delay = deadline[1] - time.monotonic()
+            if delay <= 0:
+                delay = 0.0
+                if not granted:
+                    # Checked before any REST work, a throttled member keeps collecting changes
+                    granted, delay = self.throttle.acquire(*key)
+                if delay:
+                    self.stats.throttled += 1
+                elif self.scheduler is None or self.scheduler.has_room(key[0]):
+                    break
+                else:
+                    # The guild already has a full queue, keep collecting and try again later
+                    self.stats.deferred += 1
+                    delay = self.scheduler.retry_delay
+                deadline[1] = deadline[2] = time.monotonic() + delay
+            await asyncio.sleep(delay)
+        await self._flush_in_slot(key)
+
+    async def _flush_in_slot(self, key):
+        if self.scheduler is None:
+            await self._flush(key)
+        else:
+            async with self.scheduler.slot(key[0]):
+                await self._flush(key)
+
+    async def _flush(self, key):
+        changes = self._pending.pop(key, None)
+        first = self._deadlines.pop(key, (None,))[0]
+        seqs = self._outbox_seqs.pop(key, None)
+        snapshot = self._snapshots.pop(key, None)
+        if not changes:
+            # Everything cancelled out
+            if seqs:
+                self.outbox.done(seqs)
+            return
+
+        # Edits replace the whole role list, so never let two flushes for the
+        # same member overlap or the later one could undo the earlier one.
+        previous = self._running.get(key)
+        task = asyncio.current_task()
+        self._running[key] = task
+        attempts = 0
+        try:
+            # discord.py's member cache only catches up with the previous edit
+            # once its gateway event arrives
+            trust_cache = previous is None
+            if previous is not None:
+                await asyncio.wait([previous])
+                snapshot = None
+            member = None
+            if snapshot is not None and time.monotonic() - snapshot[0] <= self.max_delay:
+                member = snapshot[1]
+            while True:
+                if seqs:
+                    await self.outbox.sync()
+                try:
+                    await self._apply(key[0], key[1], changes, first, member, trust_cache)
+                    break
+                except Exception as e:
+                    if not is_transient(e) or attempts >= self.max_retries:
+                        raise
+                    attempts += 1
+                    self.stats.retried += 1
+                    logger.warning(
+                        "Could not apply role changes for member %s in guild %s, retrying: %s", key[1], key[0], e,
+                        extra={"guild_id": key[0], "user_id": key[1], "attempt": attempts}
+                    )
+                    # Part of the changes may have been made
+                    member = None
+                    trust_cache = False
+                    await asyncio.sleep(self.retry_delay * 2 ** (attempts - 1))
+                    if self._running.get(key) is task and key in self._pending:
+                        # No later flush took changes while this one waited, so the ones
+                        # submitted meanwhile can join it. Reactions on a role alternate:
+                        # a newer change for it wins, a newer pair that cancelled out
+                        # leaves the failed change as it was
+                        changes = {**changes, **self._pending.pop(key)}
+                        self._deadlines.pop(key, None)
+                        self._snapshots.pop(key, None)
+                        newer = self._outbox_seqs.pop(key, None)
+                        if newer:
+                            seqs = (seqs or []) + newer
+        except asyncio.CancelledError:
+            # Interrupted by shutdown, leave the changes in the outbox for the next start
+            seqs = None
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            if not is_transient(e):
+                logger.exception("Failed to apply role changes for member %s in guild %s", key[1], key[0])
+            else:
+                logger.error(
+                    "Giving up on role changes for member %s in guild %s after %d attempts, "
+                    "they stay in the outbox for the next start: %s", key[1], key[0], attempts + 1, e
+                )
+                if seqs:
+                    self.outbox.leave_open(seqs)
+                seqs = None
+        finally:
+            if seqs:
+                self.outbox.done(seqs)
+            if self._running.get(key) is task:
+                del self._running[key]
+
+    async def _apply(self, guild_id, user_id, changes, first_change=None, member=None, trust_cache=True):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None and not self.bot.is_ready():
+            # Changes replayed from the outbox can come due before the guilds are loaded
+            await self.bot.wait_until_ready()
+            guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            logger.warning("Could not find guild with ID %s", guild_id)
+            return
+
+        for role_id, add in list(changes.items()):
+            if add and guild.get_role(role_id) is None:
+                logger.warning("Could not find role with ID %s", role_id)
+                del changes[role_id]
+        if not changes:
+            self.stats.noops += 1
+            return
+
+        if self.bot.intents.members and trust_cache:
+            member = guild.get_member(user_id) or member
+        if member is None:
+            if len(changes) <= SINGLE_ROLE_CHANGES:
+                await self._apply_each(guild_id, user_id, changes, first_change)
+                return
+            self.stats.fetches += 1
+            member = await self._resolve_member(guild, user_id)
+            if member is None:
+                return
+
+        current = {role.id for role in member.roles if not role.is_default()}
+        adds = {role_id for role_id, add in changes.items() if add and role_id not in current}
+        removes = {role_id for role_id, add in changes.items() if not add and role_id in current}
+        if not adds and not removes:
+            self.stats.noops += 1
+            return
+
+        final_roles = [guild.get_role(role_id) for role_id in (current - removes) | adds]
+        await member.edit(roles=[role for role in final_roles if role is not None], reason=REASON)
+        self.stats.edits += 1
+        if first_change is not None:
+            ROLE_APPLY_SECONDS.observe(time.monotonic() - first_change)
+        logger.info(
+            "Updated roles for '%s': +%s -%s", member.display_name, sorted(adds), sorted(removes),
+            extra={"guild_id": guild_id, "user_id": user_id, "changes": len(changes)}
+        )
+
+    async def _apply_each(self, guild_id, user_id, changes, first_change=None):
+        """One add or remove call per role, each only touches its own role."""
+        for role_id, add in changes.items():
+            if add:
+                await self.http.add_role(guild_id, user_id, role_id, reason=REASON)
+            else:
+                await self.http.remove_role(guild_id, user_id, role_id, reason=REASON)
+            self.stats.edits += 1
+        if first_change is not None:
+            ROLE_APPLY_SECONDS.observe(time.monotonic() - first_change)
+        adds = sorted(role_id for role_id, add in changes.items() if add)
+        removes = sorted(role_id for role_id, add in changes.items() if not add)
+        logger.info(
+            "Updated roles for member %s: +%s -%s", user_id, adds, removes,
+            extra={"guild_id": guild_id, "user_id": user_id, "changes": len(changes)}
+        )
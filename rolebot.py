@@ -1,330 +1,818 @@
+import time
+# Used to report how long the bot took to log in and become ready, imports included
+STARTED_AT = time.monotonic()
+
 import os
-import json
 import discord
-import traceback
 import logging
-import time
 import sys
 from discord.ext import commands, tasks
-from dotenv import load_dotenv
 import atexit
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+import asyncio
+import threading
+from role_queue import RoleEditCoalescer
+from throttle import ReactionThrottle
+from scheduler import GuildScheduler
+from outbox import RoleOutbox
+from rest_workers import RestWorkerPool
+from mapping_store import open_store
+from emoji_index import DispatchIndex
+from member_resolver import MemberResolver
+from runtime_profile import bot_options
+from reconcile import Reconciler
+from sharding import ShardConfig
+from log_setup import setup_logging
+from metrics import CallbackMetric, Counter, instrument_http, rss_mb
+from loop_monitor import LoopMonitor, sample_profile
+from health_server import HealthServer
+from role_menu import ReactionSeeder, RoleIndex, format_errors, parse_role_pairs, split_menu
+from guild_index import GuildIndex
+from mappings_view import MappingPages, parse_filters
+from pruner import MAPPINGS_PRUNED, MappingPruner
+from role_components import (
+    COMPONENTS_PER_MESSAGE, STYLES, ComponentRoleHandler, build_view, check_menu_roles, parse_custom_id
 )
+
+IMPORTED_AT = time.monotonic()
+
+# Load environment variables from .env file if it exists
+LOADED_DOTENV = os.path.exists('.env')
+if LOADED_DOTENV:
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Set up logging: LOG_LEVEL (default INFO) and LOG_FORMAT ("text" or "json" lines)
+setup_logging(level=os.getenv('LOG_LEVEL', 'INFO'), fmt=os.getenv('LOG_FORMAT', 'text'))
 logger = logging.getLogger("rolebot")
 
 # Check if running on Replit
 ON_REPLIT = 'REPLIT_DB_URL' in os.environ
 
-# Import keep_alive if on Replit
-if ON_REPLIT:
+# Keep-alive/health server (/health, /readyz, /livez, /metrics): "async" runs it on the
+# bot's event loop, "flask" in a thread (the original keep_alive.py), "0" turns it off
+HEALTH_SERVER = os.getenv('HEALTH_SERVER', 'async' if ON_REPLIT else '0').lower()
+if HEALTH_SERVER == '1':
+    HEALTH_SERVER = 'async'
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8080'))
+
+# Import keep_alive if the Flask server was chosen
+if HEALTH_SERVER == 'flask':
     try:
         from keep_alive import keep_alive
-        logger.info("Running on Replit, keep_alive module imported")
-        
-        # Also import the self-pinger
-        try:
-            from replit_ping import start_self_pinger
-            logger.info("Self-pinger module imported")
-        except ImportError:
-            logger.warning("Self-pinger module not found. Bot may go to sleep on Replit.")
+        logger.info("keep_alive module imported")
     except ImportError:
         logger.warning("Warning: keep_alive module not found. Bot may go to sleep on Replit.")
 
-# Load environment variables from .env file if it exists
-if os.path.exists('.env'):
-    load_dotenv()
+# Also import the self-pinger on Replit
+if ON_REPLIT and HEALTH_SERVER != '0':
+    try:
+        from replit_ping import start_self_pinger
+        logger.info("Self-pinger module imported")
+    except ImportError:
+        logger.warning("Self-pinger module not found. Bot may go to sleep on Replit.")
+
+if LOADED_DOTENV:
     logger.info("Loaded environment from .env file")
 
+# Debounce window (seconds) for folding a member's reaction changes into one role edit
+ROLE_EDIT_WINDOW = float(os.getenv('ROLE_EDIT_WINDOW', '1.0'))
+ROLE_EDIT_MAX_DELAY = float(os.getenv('ROLE_EDIT_MAX_DELAY', '3.0'))
+
+# Token bucket limits on role edits (edits per second and burst size), 0 turns a limit off
+THROTTLE_MEMBER_RATE = float(os.getenv('THROTTLE_MEMBER_RATE', '0.2'))
+THROTTLE_MEMBER_BURST = int(os.getenv('THROTTLE_MEMBER_BURST', '3'))
+THROTTLE_GUILD_RATE = float(os.getenv('THROTTLE_GUILD_RATE', '5'))
+THROTTLE_GUILD_BURST = int(os.getenv('THROTTLE_GUILD_BURST', '10'))
+
+# Role edits running at once, shared fairly between guilds (0 disables the limit),
+# and how many may wait per guild before a guild's further edits are held back
+ROLE_EDIT_CONCURRENCY = int(os.getenv('ROLE_EDIT_CONCURRENCY', '8'))
+ROLE_EDIT_QUEUE_SIZE = int(os.getenv('ROLE_EDIT_QUEUE_SIZE', '100'))
+
+# Apply role changes in this many separate worker processes (see rest_workers.py), 0 = in this process
+REST_WORKERS = int(os.getenv('REST_WORKERS', '0'))
+
+# Users found not to be members of a server aren't fetched again for this many seconds
+MEMBER_NEGATIVE_TTL = float(os.getenv('MEMBER_NEGATIVE_TTL', '60'))
+
+
+# Sweep out mappings of messages, roles and guilds deleted while the bot was offline (hours, 0 disables)
+PRUNE_INTERVAL = float(os.getenv('PRUNE_INTERVAL', '24'))
+PRUNE_BATCH_SIZE = int(os.getenv('PRUNE_BATCH_SIZE', '25'))
+PRUNE_BATCH_DELAY = float(os.getenv('PRUNE_BATCH_DELAY', '5'))
+
+# Runtime profile: "full" (default) caches every member, "lean" trades that for lower memory use
+BOT_PROFILE = os.getenv('BOT_PROFILE', 'full')
+
+# Catch up on reactions missed while the bot was offline. Without the member cache (lean)
+# reactors' roles can't be checked, so the startup pass is off there by default
+RECONCILE_ON_STARTUP = os.getenv('RECONCILE_ON_STARTUP', '1' if BOT_PROFILE == 'full' else '0') == '1'
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', '2'))
+RECONCILE_REMOVE = os.getenv('RECONCILE_REMOVE', '0') == '1'
+
+# Log the blocking stack when the event loop stalls for longer than this (seconds), 0 disables
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '1.0'))
+
+# Sharding: set SHARD_COUNT (and SHARD_IDS, see launcher.py) to run an AutoShardedBot
+SHARDS = ShardConfig.from_env()
+
+# How long closing the bot waits for the role edit queue to apply what it still holds (seconds)
+ROLE_QUEUE_CLOSE_TIMEOUT = float(os.getenv('ROLE_QUEUE_CLOSE_TIMEOUT', '10'))
+
+class FlushOnClose:
+    """Applies the role changes still waiting in the role edit queue before the bot disconnects."""
+
+    async def close(self):
+        # close() also runs again when bot.run() exits, only flush the first time
+        if not getattr(self, '_role_queue_flushed', False):
+            self._role_queue_flushed = True
+            try:
+                # Before the HTTP session is closed, the edits still need it
+                await asyncio.wait_for(role_queue.flush_all(), ROLE_QUEUE_CLOSE_TIMEOUT)
+                logger.info("Applied pending role changes")
+            except asyncio.TimeoutError:
+                logger.warning("Role changes still pending after %.0fs, closing anyway", ROLE_QUEUE_CLOSE_TIMEOUT)
+            except Exception:
+                logger.exception("Error applying pending role changes")
+        await super().close()
+
+class RoleBot(FlushOnClose, commands.Bot):
+    pass
+
+class ShardedRoleBot(FlushOnClose, commands.AutoShardedBot):
+    pass
+
 # Bot configuration
-intents = discord.Intents.default()
-intents.reactions = True
-intents.messages = True
-intents.guilds = True
-intents.message_content = True  # This is a privileged intent
-intents.members = True  # Enable members intent to access the member list
+if SHARDS.enabled:
+    bot = ShardedRoleBot(**bot_options(BOT_PROFILE), **SHARDS.bot_options())
+else:
+    bot = RoleBot(**bot_options(BOT_PROFILE))
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Count and time REST calls and 429s for /metrics
+instrument_http(bot.http)
 
 # Dictionary to store role-emoji mappings
 # Format: {message_id: {emoji_id: role_id}}
 role_mappings = {}
 
-# File to save/load role mappings
+# Where each role message lives
+# Format: {message_id: (guild_id, channel_id)}, both None for mappings saved by older versions
+mapping_locations = {}
+
+# Storage backend for role mappings: "sqlite" (default) or "json"
+MAPPINGS_BACKEND = os.getenv('MAPPINGS_BACKEND', 'sqlite')
 MAPPINGS_FILE = "role_mappings.json"
+MAPPINGS_DB = os.getenv('MAPPINGS_DB', 'role_mappings.db')
+
+mapping_store = None
+
+# Log of role changes not applied yet, replayed after a crash ("" disables it). In a
+# partitioned deployment each process gets its own file, REST workers one each
+ROLE_OUTBOX = os.getenv('ROLE_OUTBOX', 'role_outbox.log')
+if ROLE_OUTBOX and SHARDS.partitioned:
+    ROLE_OUTBOX += f".{SHARDS.shard_ids[0]}"
+
+# Watches for event loop stalls, see LOOP_STALL_THRESHOLD and !profile
+loop_monitor = LoopMonitor(threshold=LOOP_STALL_THRESHOLD)
+
+# Started in setup_hook when HEALTH_SERVER is "async"
+health_server = HealthServer(bot, port=HEALTH_PORT, loop_monitor=loop_monitor)
+
+# Compiled (guild_id, message_id, emoji) -> role_id lookup used by the reaction handlers
+dispatch_index = DispatchIndex()
 
-# Load role mappings from file
+# Role messages by guild and channel, used to list one guild's menus
+guild_index = GuildIndex()
+
+# Adds the reactions of menus created with !setup_roles
+reaction_seeder = ReactionSeeder()
+
+# Load role mappings from the store
 def load_role_mappings():
-    global role_mappings
+    global mapping_store
     try:
-        if os.path.exists(MAPPINGS_FILE):
-            with open(MAPPINGS_FILE, 'r') as f:
-                # JSON loads message_id as string, need to convert back to int
-                data = json.load(f)
-                role_mappings = {int(k): v for k, v in data.items()}
-                logger.info(f"Loaded role mappings: {role_mappings}")
+        if mapping_store is None:
+            # Opening the SQLite store also migrates an existing role_mappings.json once
+            mapping_store = open_store(MAPPINGS_BACKEND, MAPPINGS_FILE, MAPPINGS_DB)
+        role_mappings.clear()
+        mapping_locations.clear()
+        # In a partitioned deployment, only load the guilds on this process's shards
+        shards = (SHARDS.shard_ids, SHARDS.shard_count) if SHARDS.partitioned else None
+        for guild_id, channel_id, message_id, emoji, role_id in mapping_store.load(shards):
+            role_mappings.setdefault(message_id, {})[emoji] = role_id
+            mapping_locations[message_id] = (guild_id, channel_id)
+        dispatch_index.rebuild(role_mappings, mapping_locations)
+        guild_index.rebuild(mapping_locations)
+        logger.info(
+            "Loaded %d role messages from the %s store (%s)",
+            len(role_mappings), MAPPINGS_BACKEND, SHARDS.describe()
+        )
+    except Exception:
+        logger.exception("Error loading role mappings")
+
+# Queue a write of one message's mappings, the store writes in a background thread.
+# Returns the write's future (None without a store), failures are logged by the store
+def save_role_mappings(message_id):
+    if mapping_store is None:
+        logger.error("Mapping store is not open, cannot save role mappings")
+        return None
+    guild_id, channel_id = mapping_locations.get(message_id, (None, None))
+    return mapping_store.save_message(guild_id, channel_id, message_id, role_mappings[message_id])
+
+# Forget role messages that were deleted, in memory and in the store
+def forget_role_messages(message_ids, reason):
+    removed = 0
+    for message_id in message_ids:
+        if role_mappings.pop(message_id, None) is None:
+            continue
+        mapping_locations.pop(message_id, None)
+        dispatch_index.remove_message(message_id)
+        guild_index.remove(message_id)
+        if mapping_store is not None:
+            mapping_store.delete_message(message_id)
+        removed += 1
+    if removed:
+        MAPPINGS_PRUNED.labels(reason=reason).inc(removed)
+        logger.info("Removed %d role messages (%s)", removed, reason, extra={"messages": removed, "reason": reason})
+    return removed
+
+# Drop a deleted role from its guild's menus, menus left without roles are forgotten
+def forget_role(guild_id, role_id):
+    emptied = []
+    for message_id, _ in guild_index.messages(guild_id):
+        emoji_roles = role_mappings[message_id]
+        stale = [emoji for emoji, mapped_role_id in emoji_roles.items() if mapped_role_id == role_id]
+        if not stale:
+            continue
+        for emoji in stale:
+            del emoji_roles[emoji]
+        MAPPINGS_PRUNED.labels(reason="role deleted").inc()
+        if emoji_roles:
+            dispatch_index.add_message(guild_id, message_id, emoji_roles)
+            save_role_mappings(message_id)
         else:
-            logger.info(f"No mappings file found at {MAPPINGS_FILE}")
-    except Exception as e:
-        logger.error(f"Error loading role mappings: {e}")
-        traceback.print_exc()
+            emptied.append(message_id)
+    forget_role_messages(emptied, "menu emptied")
 
-# Save role mappings to file
-def save_role_mappings():
-    try:
-        with open(MAPPINGS_FILE, 'w') as f:
-            # Convert message_id to string for JSON
-            json.dump({str(k): v for k, v in role_mappings.items()}, f, indent=4)
-            logger.info(f"Saved role mappings to {MAPPINGS_FILE}")
-    except Exception as e:
-        logger.error(f"Error saving role mappings: {e}")
-        traceback.print_exc()
+# Wait for pending writes and close the store
+def close_mapping_store():
+    if mapping_store is not None:
+        try:
+            mapping_store.close()
+            logger.info("Saved role mappings")
+        except Exception:
+            logger.exception("Error saving role mappings")
 
 @tasks.loop(minutes=10)
 async def status_update():
     """Periodically update bot status and log memory usage to keep it active"""
     try:
         guild_count = len(bot.guilds)
-        member_count = sum(len(guild.members) for guild in bot.guilds)
+        # Member counts come from guild metadata, no need to walk every cached member
+        member_count = sum(guild.member_count or 0 for guild in bot.guilds)
         
-        # Update bot status
-        activity = discord.Activity(
-            type=discord.ActivityType.watching,
-            name=f"{guild_count} servers | !setup_roles"
-        )
-        await bot.change_presence(activity=activity)
+        # Update bot status, per shard when sharded so each shows its own guilds
+        if SHARDS.enabled:
+            shard_guilds = {}
+            for guild in bot.guilds:
+                shard_guilds[guild.shard_id] = shard_guilds.get(guild.shard_id, 0) + 1
+            for shard_id, shard in bot.shards.items():
+                activity = discord.Activity(
+                    type=discord.ActivityType.watching,
+                    name=f"{shard_guilds.get(shard_id, 0)} servers | !setup_roles | shard {shard_id}"
+                )
+                await bot.change_presence(activity=activity, shard_id=shard_id)
+                logger.info(
+                    "Shard %s: %d guilds, latency %.0f ms, %s",
+                    shard_id, shard_guilds.get(shard_id, 0), shard.latency * 1000,
+                    'closed' if shard.is_closed() else 'connected',
+                    extra={"shard_id": shard_id, "latency_ms": round(shard.latency * 1000, 1)}
+                )
+        else:
+            activity = discord.Activity(
+                type=discord.ActivityType.watching,
+                name=f"{guild_count} servers | !setup_roles"
+            )
+            await bot.change_presence(activity=activity)
         
         # Log some stats to keep the bot active
-        logger.info(f"Status update: {guild_count} guilds, {member_count} members")
+        logger.info(
+            "Status update: %d guilds, ~%d members", guild_count, member_count,
+            extra={"guilds": guild_count, "members": member_count}
+        )
+        logger.info("Role edit queue: %s", role_queue.stats.as_dict())
+        if role_outbox is not None:
+            logger.info("Role change outbox: %d unfinished, %s", len(role_outbox), role_outbox.stats.as_dict())
+        if role_scheduler is not None:
+            logger.info("Role edit scheduler: %s, busiest guilds %s", role_scheduler.stats.as_dict(), role_scheduler.busiest(5))
+        logger.info("Member resolver: %s", member_resolver.stats.as_dict())
         
         # Log memory usage if on Replit
         if ON_REPLIT:
             try:
-                memory_usage = os.popen('ps -o rss= -p ' + str(os.getpid())).read().strip()
-                memory_usage_mb = round(int(memory_usage) / 1024, 2)
-                logger.info(f"Memory usage: {memory_usage_mb} MB")
+                memory_usage_mb = rss_mb()
+                logger.info("Memory usage: %s MB", memory_usage_mb, extra={"rss_mb": memory_usage_mb})
                 
                 # If memory usage is getting high, log a warning
                 if memory_usage_mb > 400:  # 400MB is getting close to the 512MB limit
-                    logger.warning(f"High memory usage: {memory_usage_mb} MB")
+                    logger.warning("High memory usage: %s MB", memory_usage_mb)
             except:
                 pass
     except Exception as e:
-        logger.error(f"Error in status update: {e}")
+        logger.error("Error in status update: %s", e)
 
 @bot.event
-async def on_ready():
-    logger.info(f'{bot.user.name} has connected to Discord!')
-    logger.info(f'Bot is in {len(bot.guilds)} guilds')
+async def setup_hook():
+    # Runs after logging in, before the bot connects to the gateway
+    login_seconds = time.monotonic() - STARTED_AT
+    import_seconds = IMPORTED_AT - STARTED_AT
+    logger.info(
+        "Logged in after %.2fs (imports %.2fs)", login_seconds, import_seconds,
+        extra={"login_seconds": round(login_seconds, 3), "import_seconds": round(import_seconds, 3)}
+    )
     
-    # Load the role mappings when the bot starts
+    # Load the role mappings before any gateway events can arrive
     load_role_mappings()
     
-    # Start the status update task
-    status_update.start()
+    # Queue the role changes a crash left unfinished ahead of any new ones, they
+    # are applied once the guilds are loaded
+    if role_outbox is not None:
+        replay_role_outbox()
+    
+    if REST_WORKERS > 0:
+        await role_queue.start()
+    
+    if HEALTH_SERVER == 'async':
+        await health_server.start()
+    
+    # Also start the self-pinger on Replit, as a task on this loop
+    if ON_REPLIT and HEALTH_SERVER != '0':
+        try:
+            health_server.pinger = start_self_pinger(interval_seconds=240)  # ping every 4 minutes
+        except Exception as e:
+            logger.error("Could not start self-pinger: %s", e)
+
+@bot.event
+async def on_ready():
+    logger.info('%s has connected to Discord!', bot.user.name)
+    logger.info('Bot is in %d guilds', len(bot.guilds))
+    ready_seconds = time.monotonic() - STARTED_AT
+    memory_usage_mb = rss_mb()
+    logger.info(
+        "Ready after %.1fs, RSS %s MB (%s profile)", ready_seconds, memory_usage_mb, BOT_PROFILE,
+        extra={"ready_seconds": round(ready_seconds, 2), "rss_mb": memory_usage_mb, "profile": BOT_PROFILE}
+    )
+    
+    # Start the status update task (on_ready fires again after a reconnect)
+    if not status_update.is_running():
+        status_update.start()
+    
+    if LOOP_STALL_THRESHOLD > 0:
+        loop_monitor.start()
+    
+    # Apply reactions that changed while we were offline and start the mapping
+    # sweeps, in the background
+    global startup_task
+    if startup_task is None:
+        startup_task = asyncio.create_task(catch_up())
 
 @bot.command(name='setup_roles')
 @commands.has_permissions(administrator=True)
 async def setup_roles(ctx, *, role_emoji_pairs=None):
     """
-    Set up a reaction role message.
+    Set up a reaction role menu.
     Usage: !setup_roles Role1:emoji1 Role2:emoji2 ...
     Example: !setup_roles Admin:👑 Member:👋 Gamer:🎮
+    Role names are matched ignoring case. Menus with more than 20 roles are
+    split across several messages, since a message holds at most 20 reactions.
     """
     if role_emoji_pairs is None:
         await ctx.send("Please provide role-emoji pairs. Example: `!setup_roles Admin:👑 Member:👋`")
         return
 
-    pairs = role_emoji_pairs.split()
-    embed = discord.Embed(
-        title="Role Assignment",
-        description="React to get roles:",
-        color=discord.Color.blue()
+    # Check every pair before sending anything, and report all problems at once
+    pairs, errors = parse_role_pairs(role_emoji_pairs, RoleIndex(ctx.guild.roles), bot)
+    logger.debug(
+        "Processing %d role-emoji pairs, %d invalid", len(pairs) + len(errors), len(errors),
+        extra={"guild_id": ctx.guild.id}
     )
-    
-    role_emojis = {}
-    
-    print(f"Processing role-emoji pairs: {pairs}")
-    
-    for pair in pairs:
-        if ":" not in pair:
-            await ctx.send(f"Invalid format for pair: {pair}. Use Role:emoji")
-            continue
-            
-        role_name, emoji = pair.split(":", 1)
-        role = discord.utils.get(ctx.guild.roles, name=role_name)
-        
-        if role is None:
-            await ctx.send(f"Role '{role_name}' not found.")
-            print(f"Role '{role_name}' not found in guild. Available roles: {[r.name for r in ctx.guild.roles]}")
-            continue
-            
-        embed.add_field(name=role.name, value=f"React with {emoji} to get the {role.name} role", inline=False)
-        role_emojis[emoji] = role.id
-        print(f"Added mapping: {emoji} -> {role.name} (ID: {role.id})")
-    
-    if not role_emojis:
+    if errors:
+        await ctx.send(format_errors(errors, "Nothing was set up. Fix these pairs and run the command again:"))
+        return
+    if not pairs:
         await ctx.send("No valid role-emoji pairs provided.")
         return
+
+    parts = split_menu(pairs)
+    menu = []
+    saves = []
+    for number, part in enumerate(parts, start=1):
+        title = "Role Assignment" if len(parts) == 1 else f"Role Assignment ({number}/{len(parts)})"
+        embed = discord.Embed(title=title, description="React to get roles:", color=discord.Color.blue())
+        for role, emoji in part:
+            embed.add_field(name=role.name, value=f"React with {emoji} to get the {role.name} role", inline=False)
+        message = await ctx.send(embed=embed)
         
-    message = await ctx.send(embed=embed)
+        # Store the role mappings for this message
+        role_emojis = {emoji: role.id for role, emoji in part}
+        role_mappings[message.id] = role_emojis
+        mapping_locations[message.id] = (ctx.guild.id, ctx.channel.id)
+        dispatch_index.add_message(ctx.guild.id, message.id, role_emojis)
+        guild_index.add(ctx.guild.id, ctx.channel.id, message.id)
+        saves.append(save_role_mappings(message.id))
+        menu.append((message, list(role_emojis)))
     
-    # Store the role mappings for this message
-    role_mappings[message.id] = role_emojis
-    print(f"Created role-reaction message with ID: {message.id}")
-    print(f"Current role_mappings: {role_mappings}")
+    logger.info(
+        "Created role menu with %d roles on %d messages", len(pairs), len(menu),
+        extra={"guild_id": ctx.guild.id, "message_id": menu[0][0].id, "role_messages": len(role_mappings)}
+    )
     
-    # Save the updated mappings
-    save_role_mappings()
+    # Only confirm once the menu is on disk, an unsaved one stops working at the next restart
+    results = await asyncio.gather(
+        *[asyncio.wrap_future(save) for save in saves if save is not None], return_exceptions=True
+    )
+    if None in saves or any(isinstance(result, Exception) for result in results):
+        await ctx.send("The menu works for now, but it couldn't be saved and will stop working after a restart. Check the bot's logs.")
     
-    # Add reactions to the message
-    for emoji in role_emojis.keys():
-        await message.add_reaction(emoji)
-        print(f"Added reaction {emoji} to message")
+    # Add the reactions to all messages of the menu at once
+    report = await reaction_seeder.seed(menu)
+    logger.info(
+        "Added %d reactions in %.1fs (%d retried, %d failed)",
+        report.added, report.elapsed, report.retries, len(report.failed),
+        extra={"guild_id": ctx.guild.id, "seconds": round(report.elapsed, 2)}
+    )
+    if report.failed:
+        await ctx.send(format_errors(
+            [f"{emoji}: {reason}" for emoji, reason in report.failed],
+            "The menu was created, but these reactions couldn't be added:"
+        ))
     
     await ctx.message.delete()
 
+@bot.command(name='setup_role_menu')
+@commands.has_permissions(administrator=True)
+async def setup_role_menu(ctx, style=None, *, role_emoji_pairs=None):
+    """
+    Set up a role menu with buttons or a select menu instead of reactions.
+    Usage: !setup_role_menu buttons|select Role1:emoji1 Role2:emoji2 ...
+    Example: !setup_role_menu select Admin:👑 Member:👋 Gamer:🎮
+    Buttons toggle one role each. The select menu sets all of its roles at
+    once: chosen roles are added and the others removed. Menus with more than
+    25 roles are split across several messages.
+    """
+    if style not in STYLES or role_emoji_pairs is None:
+        await ctx.send("Please provide a style and role-emoji pairs. Example: `!setup_role_menu buttons Admin:👑 Member:👋`")
+        return
+
+    pairs, errors = parse_role_pairs(role_emoji_pairs, RoleIndex(ctx.guild.roles), bot)
+    errors += check_menu_roles(pairs)
+    if errors:
+        await ctx.send(format_errors(errors, "Nothing was set up. Fix these pairs and run the command again:"))
+        return
+    if not pairs:
+        await ctx.send("No valid role-emoji pairs provided.")
+        return
+
+    # Nothing is saved, the components' custom_ids carry the roles
+    parts = split_menu(pairs, COMPONENTS_PER_MESSAGE)
+    description = "Click a button to get or drop a role:" if style == "buttons" else "Pick the roles you want:"
+    for number, part in enumerate(parts, start=1):
+        title = "Role Assignment" if len(parts) == 1 else f"Role Assignment ({number}/{len(parts)})"
+        embed = discord.Embed(title=title, description=description, color=discord.Color.blue())
+        view = build_view(part, style)
+        try:
+            await ctx.send(embed=embed, view=view)
+        except discord.HTTPException as e:
+            await ctx.send(f"Could not create the role menu: {e.text or e}")
+            return
+        finally:
+            view.stop()
+
+    logger.info(
+        "Created %s role menu with %d roles on %d messages", style, len(pairs), len(parts),
+        extra={"guild_id": ctx.guild.id}
+    )
+    await ctx.message.delete()
+
 @bot.command(name='show_mappings')
 @commands.has_permissions(administrator=True)
-async def show_mappings(ctx):
-    """Show the current role-emoji mappings."""
-    if not role_mappings:
-        await ctx.send("No role mappings have been set up.")
+async def show_mappings(ctx, *, filters=None):
+    """
+    Show this server's role-emoji mappings, a few menus per page.
+    Usage: !show_mappings [#channel] [role]
+    Only menus in the given channel, or with the given role (a mention or a name), are listed.
+    """
+    channel_id, role, errors = parse_filters(filters, ctx.guild, RoleIndex(ctx.guild.roles))
+    if errors:
+        await ctx.send(format_errors(errors, "Couldn't apply the filters:"))
         return
     
-    # Print the mappings to the console for debugging
-    print(f"Current mappings: {role_mappings}")
+    # Only this guild's (or channel's) menus are looked at, see GuildIndex
+    entries = guild_index.messages(ctx.guild.id, channel_id)
+    if role is not None:
+        entries = [entry for entry in entries if role.id in role_mappings.get(entry[0], {}).values()]
+    
+    logger.debug("Showing %d role messages", len(entries), extra={"guild_id": ctx.guild.id})
     
-    embed = discord.Embed(
-        title="Current Role Mappings",
-        description="The following role-emoji mappings are active:",
-        color=discord.Color.green()
+    if not entries:
+        if guild_index.count(ctx.guild.id):
+            await ctx.send("No role mappings match these filters.")
+        else:
+            await ctx.send("No role mappings have been set up.")
+        return
+    
+    description = "The following role-emoji mappings are active"
+    if channel_id is not None:
+        description += f" in <#{channel_id}>"
+    if role is not None:
+        description += f" for {role.mention}"
+    view = MappingPages(ctx.guild, entries, role_mappings, ctx.author.id, description + ":")
+    if view.page_count == 1:
+        await ctx.send(embed=view.render())
+        view.stop()
+    else:
+        view.message = await ctx.send(embed=view.render(), view=view)
+
+# Fetches members for the role edit queue, one fetch per member at a time
+member_resolver = MemberResolver(negative_ttl=MEMBER_NEGATIVE_TTL)
+
+# Reaction changes are applied per member in batches instead of one REST call each,
+# either on this event loop or by worker processes (which run their own scheduler).
+# The outbox stays in this process either way, workers report back what they applied
+role_scheduler = None
+role_outbox = RoleOutbox(ROLE_OUTBOX) if ROLE_OUTBOX else None
+if REST_WORKERS > 0:
+    role_queue = RestWorkerPool(REST_WORKERS, queue_options={
+        "window": ROLE_EDIT_WINDOW, "max_delay": ROLE_EDIT_MAX_DELAY,
+        "member_rate": THROTTLE_MEMBER_RATE, "member_burst": THROTTLE_MEMBER_BURST,
+        "guild_rate": THROTTLE_GUILD_RATE, "guild_burst": THROTTLE_GUILD_BURST,
+        "concurrency": ROLE_EDIT_CONCURRENCY, "queue_size": ROLE_EDIT_QUEUE_SIZE,
+    }, outbox=role_outbox)
+else:
+    if ROLE_EDIT_CONCURRENCY > 0:
+        role_scheduler = GuildScheduler(ROLE_EDIT_CONCURRENCY, ROLE_EDIT_QUEUE_SIZE)
+    role_queue = RoleEditCoalescer(
+        bot, member_resolver.resolve,
+        window=ROLE_EDIT_WINDOW, max_delay=ROLE_EDIT_MAX_DELAY,
+        throttle=ReactionThrottle(
+            member_rate=THROTTLE_MEMBER_RATE, member_burst=THROTTLE_MEMBER_BURST,
+            guild_rate=THROTTLE_GUILD_RATE, guild_burst=THROTTLE_GUILD_BURST
+        ),
+        scheduler=role_scheduler,
+        outbox=role_outbox
     )
+
+def replay_role_outbox():
+    """Hand the changes left in the outbox by the last run to the role edit queue again."""
+    try:
+        replayed = role_outbox.replay(role_queue.submit)
+    except Exception:
+        logger.exception("Could not read the role change outbox, continuing without it")
+        role_queue.outbox = None
+        return
+    if replayed:
+        logger.info("Replaying %d unfinished role changes", replayed, extra={"changes": replayed})
+
+def close_role_outbox():
+    if role_outbox is not None:
+        try:
+            role_outbox.close()
+        except Exception:
+            logger.exception("Error closing the role change outbox")
+
+# Exported on /metrics, read from the objects above when scraped
+CallbackMetric("rolebot_role_queue_pending_members", "Members with role changes waiting to be applied.",
+               lambda: role_queue.pending_members)
+CallbackMetric("rolebot_role_queue", "Role edit queue counters.",
+               lambda: {(name,): value for name, value in role_queue.stats.as_dict().items()},
+               type="counter", labelnames=("stat",))
+CallbackMetric("rolebot_member_fetches_inflight", "Member fetches currently in flight.",
+               lambda: member_resolver.inflight)
+CallbackMetric("rolebot_member_resolver", "Member resolver lookups by outcome.",
+               lambda: {(name,): value for name, value in member_resolver.stats.as_dict().items() if name != "hit_rate"},
+               type="counter", labelnames=("stat",))
+CallbackMetric("rolebot_member_resolver_hit_ratio", "Share of member lookups served without a fetch.",
+               lambda: member_resolver.stats.hit_rate)
+CallbackMetric("rolebot_role_messages", "Role messages loaded.", lambda: len(role_mappings))
+CallbackMetric("rolebot_guilds", "Guilds the bot is in.", lambda: len(bot.guilds))
+if role_outbox is not None:
+    CallbackMetric("rolebot_outbox_unfinished", "Role changes in the outbox that haven't been applied yet.",
+                   lambda: len(role_outbox))
+if role_scheduler is not None:
+    CallbackMetric("rolebot_scheduler_running", "Role edits currently running.", lambda: role_scheduler.running)
+    CallbackMetric("rolebot_scheduler_queued", "Role edits waiting for a slot, for the guilds with the longest queues.",
+                   lambda: {(guild_id,): queued for guild_id, queued, _ in role_scheduler.busiest()},
+                   labelnames=("guild",))
+    CallbackMetric("rolebot_scheduler_oldest_wait_seconds", "How long the oldest waiting role edit of those guilds has waited.",
+                   lambda: {(guild_id,): waited for guild_id, _, waited in role_scheduler.busiest()},
+                   labelnames=("guild",))
+CallbackMetric("rolebot_gateway_latency_seconds", "Gateway heartbeat latency per shard.",
+               lambda: {(shard_id,): latency for shard_id, latency in getattr(bot, 'latencies', [(0, bot.latency)])
+                        if latency == latency},
+               labelnames=("shard",))
+
+# Reaction events by outcome, "ignored" ones aren't on a role message
+REACTIONS = Counter("rolebot_reactions", "Raw reaction events received.", ("event", "result"))
+REACTION_ADDS_HANDLED = REACTIONS.labels(event="add", result="handled")
+REACTION_ADDS_IGNORED = REACTIONS.labels(event="add", result="ignored")
+REACTION_REMOVES_HANDLED = REACTIONS.labels(event="remove", result="handled")
+REACTION_REMOVES_IGNORED = REACTIONS.labels(event="remove", result="ignored")
+
+# Fixes up roles for reactions missed during downtime, see !reconcile
+reconciler = Reconciler(
+    bot, role_queue, concurrency=RECONCILE_CONCURRENCY, remove_stale=RECONCILE_REMOVE,
+    forget_messages=forget_role_messages
+)
+
+# The startup reconcile pass followed by the first mapping sweep, see on_ready
+startup_task = None
+
+@bot.command(name='reconcile')
+@commands.has_permissions(administrator=True)
+async def reconcile(ctx, mode=None):
+    """
+    Give out roles for reactions the bot missed while it was offline.
+    Usage: !reconcile [remove|all]
+    With "remove", members who hold a menu role without reacting for it lose the role.
+    With "all", reactors who aren't in the member cache (lean profile) get their role
+    queued without checking whether they have it, one request per reactor.
+    """
+    if reconciler.running:
+        await ctx.send("A reconciliation pass is already running, please wait for it to finish.")
+        return
     
-    for message_id, emojis in role_mappings.items():
-        message_link = f"https://discord.com/channels/{ctx.guild.id}/{ctx.channel.id}/{message_id}"
-        field_value = ""
-        
-        for emoji, role_id in emojis.items():
-            role = ctx.guild.get_role(role_id)
-            role_name = role.name if role else "Unknown Role"
-            field_value += f"{emoji} → {role_name}\n"
-            
-        embed.add_field(
-            name=f"Message: [Jump to message]({message_link})",
-            value=field_value,
-            inline=False
-        )
+    status = await ctx.send("Reconciling role messages...")
+    
+    async def progress(report):
+        await status.edit(content=f"Reconciling role messages...\n```{report.summary()}```")
     
-    await ctx.send(embed=embed)
+    report = await reconciler.run(
+        role_mappings, mapping_locations, guild_id=ctx.guild.id,
+        remove_stale=(mode == "remove"), add_uncached=(mode == "all"), progress=progress
+    )
+    await status.edit(content=f"Reconciliation finished.\n```{report.summary()}```")
+
+@bot.command(name='profile')
+@commands.has_permissions(administrator=True)
+async def profile(ctx, seconds: float = 10.0):
+    """
+    Sample what the bot spends its time on and show the busiest functions.
+    Usage: !profile [seconds]  (1-60, default 10)
+    """
+    seconds = min(max(seconds, 1.0), 60.0)
+    await ctx.send(f"Profiling for {seconds:.0f} seconds...")
+
+    # The sampler runs in a worker thread and looks at the event loop's thread
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, sample_profile, threading.get_ident(), seconds)
+    logger.info("Profile of %.0fs:\n%s", seconds, report.summary(limit=30))
+
+    summary = report.summary(limit=15)
+    if len(summary) > 1900:
+        summary = summary[:1900] + "\n..."
+    await ctx.send(
+        f"```{summary}```"
+        f"Loop lag: max {loop_monitor.max_lag * 1000:.0f} ms, {loop_monitor.stalls} stalls since start"
+    )
+
+def claim_message_location(payload):
+    """Record the guild/channel of a role message saved by an older version of the bot."""
+    if dispatch_index.claim(payload.message_id, payload.guild_id):
+        mapping_locations[payload.message_id] = (payload.guild_id, payload.channel_id)
+        guild_index.add(payload.guild_id, payload.channel_id, payload.message_id)
+        mapping_store.set_location(payload.message_id, payload.guild_id, payload.channel_id)
+        logger.info(
+            "Recorded guild for role message",
+            extra={"guild_id": payload.guild_id, "message_id": payload.message_id}
+        )
 
 @bot.event
 async def on_raw_reaction_add(payload):
-    # Ignore bot's own reactions
-    if payload.user_id == bot.user.id:
+    # Ignore reactions that aren't on one of our role messages, and the bot's own reactions
+    role_id = dispatch_index.lookup(payload.guild_id, payload.message_id, payload.emoji)
+    if role_id is None or payload.guild_id is None or payload.user_id == bot.user.id:
+        REACTION_ADDS_IGNORED.inc()
         return
+    REACTION_ADDS_HANDLED.inc()
         
     try:
-        # Check if the reacted message is one of our role messages
-        if payload.message_id in role_mappings:
-            emoji = str(payload.emoji)
-            emoji_mappings = role_mappings[payload.message_id]
-            
-            print(f"Reaction added - Message ID: {payload.message_id}, Emoji: {emoji}")
-            print(f"Available emojis for this message: {list(emoji_mappings.keys())}")
-            
-            # Check if the emoji is one we're tracking
-            if emoji in emoji_mappings:
-                role_id = emoji_mappings[emoji]
-                guild = bot.get_guild(payload.guild_id)
-                
-                if guild is None:
-                    print(f"Error: Could not find guild with ID {payload.guild_id}")
-                    return
-                    
-                role = guild.get_role(role_id)
-                
-                if role is None:
-                    print(f"Error: Could not find role with ID {role_id}")
-                    return
-                
-                # Try to get member from cache first, then try to fetch if not found
-                member = guild.get_member(payload.user_id)
-                if member is None:
-                    try:
-                        print(f"Member not in cache, attempting to fetch member {payload.user_id}")
-                        member = await guild.fetch_member(payload.user_id)
-                    except discord.errors.NotFound:
-                        print(f"Error: Could not find member with ID {payload.user_id} even after fetching")
-                        return
-                    except Exception as e:
-                        print(f"Error fetching member: {e}")
-                        return
-                
-                print(f"Attempting to add role '{role.name}' to user '{member.display_name}'")
-                await member.add_roles(role)
-                print(f"Role '{role.name}' added to '{member.display_name}' successfully")
-            else:
-                print(f"Emoji {emoji} not found in mappings for message {payload.message_id}")
-    except Exception as e:
-        print(f"Error in on_raw_reaction_add: {e}")
-        traceback.print_exc()
+        if dispatch_index.is_unplaced(payload.message_id):
+            claim_message_location(payload)
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Reaction added", extra={
+                "guild_id": payload.guild_id, "message_id": payload.message_id,
+                "user_id": payload.user_id, "emoji": str(payload.emoji), "role_id": role_id
+            })
+        role_queue.submit(payload.guild_id, payload.user_id, role_id, add=True)
+    except Exception:
+        logger.exception("Error in on_raw_reaction_add")
 
 @bot.event
 async def on_raw_reaction_remove(payload):
+    # Ignore reactions that aren't on one of our role messages
+    role_id = dispatch_index.lookup(payload.guild_id, payload.message_id, payload.emoji)
+    if role_id is None or payload.guild_id is None:
+        REACTION_REMOVES_IGNORED.inc()
+        return
+    REACTION_REMOVES_HANDLED.inc()
+        
     try:
-        # Check if the reacted message is one of our role messages
-        if payload.message_id in role_mappings:
-            emoji = str(payload.emoji)
-            emoji_mappings = role_mappings[payload.message_id]
-            
-            print(f"Reaction removed - Message ID: {payload.message_id}, Emoji: {emoji}")
-            
-            # Check if the emoji is one we're tracking
-            if emoji in emoji_mappings:
-                role_id = emoji_mappings[emoji]
-                guild = bot.get_guild(payload.guild_id)
-                
-                if guild is None:
-                    print(f"Error: Could not find guild with ID {payload.guild_id}")
-                    return
-                    
-                role = guild.get_role(role_id)
-                
-                if role is None:
-                    print(f"Error: Could not find role with ID {role_id}")
-                    return
-                
-                # Try to get member from cache first, then try to fetch if not found
-                member = guild.get_member(payload.user_id)
-                if member is None:
-                    try:
-                        print(f"Member not in cache, attempting to fetch member {payload.user_id}")
-                        member = await guild.fetch_member(payload.user_id)
-                    except discord.errors.NotFound:
-                        print(f"Error: Could not find member with ID {payload.user_id} even after fetching")
-                        return
-                    except Exception as e:
-                        print(f"Error fetching member: {e}")
-                        return
-                
-                print(f"Attempting to remove role '{role.name}' from user '{member.display_name}'")
-                await member.remove_roles(role)
-                print(f"Role '{role.name}' removed from '{member.display_name}' successfully")
-            else:
-                print(f"Emoji {emoji} not found in mappings for message {payload.message_id}")
-    except Exception as e:
-        print(f"Error in on_raw_reaction_remove: {e}")
-        traceback.print_exc()
+        if dispatch_index.is_unplaced(payload.message_id):
+            claim_message_location(payload)
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Reaction removed", extra={
+                "guild_id": payload.guild_id, "message_id": payload.message_id,
+                "user_id": payload.user_id, "emoji": str(payload.emoji), "role_id": role_id
+            })
+        role_queue.submit(payload.guild_id, payload.user_id, role_id, add=False)
+    except Exception:
+        logger.exception("Error in on_raw_reaction_remove")
+
+# Removes mappings whose message, role or guild was deleted while the bot was offline
+pruner = MappingPruner(
+    bot, forget_role_messages, forget_role, batch_size=PRUNE_BATCH_SIZE, batch_delay=PRUNE_BATCH_DELAY,
+    owns_guild=SHARDS.owns_guild
+)
+
+# Role messages the startup reconcile pass read, the first sweep doesn't fetch them again
+reconciled_messages = set()
+
+async def catch_up():
+    """Reconcile the reactions missed while offline, then start the mapping sweeps."""
+    if RECONCILE_ON_STARTUP:
+        try:
+            report = await reconciler.run(role_mappings, mapping_locations)
+            reconciled_messages.update(report.read)
+        except Exception:
+            logger.exception("Error in startup reconciliation")
+    # Started only now, so the first sweep can use what the pass has read
+    if PRUNE_INTERVAL > 0 and not prune_mappings.is_running():
+        prune_mappings.start()
+
+@tasks.loop(hours=max(PRUNE_INTERVAL, 0.01))
+async def prune_mappings():
+    """Periodically check every role message and forget the ones that are gone"""
+    try:
+        await pruner.run(role_mappings, mapping_locations, checked=reconciled_messages)
+    except Exception:
+        logger.exception("Error in mapping sweep")
+    finally:
+        # Later sweeps check everything again
+        reconciled_messages.clear()
+
+# Deleted messages, channels, roles and guilds take their mappings with them
+@bot.event
+async def on_raw_message_delete(payload):
+    if payload.message_id in role_mappings:
+        forget_role_messages([payload.message_id], "message deleted")
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if not role_mappings.keys().isdisjoint(payload.message_ids):
+        forget_role_messages(payload.message_ids, "message deleted")
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    messages = guild_index.messages(channel.guild.id, channel.id)
+    if messages:
+        forget_role_messages([message_id for message_id, _ in messages], "channel deleted")
+
+@bot.event
+async def on_raw_thread_delete(payload):
+    messages = guild_index.messages(payload.guild_id, payload.thread_id)
+    if messages:
+        forget_role_messages([message_id for message_id, _ in messages], "channel deleted")
+
+@bot.event
+async def on_guild_role_delete(role):
+    forget_role(role.guild.id, role.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    messages = guild_index.messages(guild.id)
+    if messages:
+        forget_role_messages([message_id for message_id, _ in messages], "guild removed")
+
+# Role menus made with !setup_role_menu, handled from their custom_ids without any stored state
+component_roles = ComponentRoleHandler(role_queue)
+
+@bot.event
+async def on_interaction(interaction):
+    if interaction.type is not discord.InteractionType.component:
+        return
+    parsed = parse_custom_id(interaction.data.get("custom_id", ""))
+    if parsed is None:
+        return
+    try:
+        await component_roles.handle(interaction, *parsed)
+    except Exception:
+        logger.exception("Error handling role menu interaction")
 
-# Also ensure we save any changes to role mappings when the bot stops 
-atexit.register(save_role_mappings)
+# Also ensure pending mapping writes reach disk when the bot stops
+atexit.register(close_mapping_store)
+atexit.register(close_role_outbox)
 
 # Reconnect handler
 @bot.event
@@ -334,8 +822,7 @@ async def on_resumed():
 # Error handler for the bot
 @bot.event
 async def on_error(event, *args, **kwargs):
-    logger.error(f"Error in event {event}: {sys.exc_info()[1]}")
-    traceback.print_exc()
+    logger.exception("Error in event %s: %s", event, sys.exc_info()[1])
 
 # Run the bot
 if __name__ == "__main__":
@@ -351,23 +838,17 @@ if __name__ == "__main__":
         try:
             logger.info("Starting bot...")
             
-            # Start the keep_alive server if on Replit
-            if ON_REPLIT:
+            # Start the Flask keep_alive server if selected (the async one starts in setup_hook)
+            if HEALTH_SERVER == 'flask':
                 try:
-                    keep_alive_thread = keep_alive()
+                    keep_alive_thread = keep_alive(bot, health_server)
                     logger.info("Keep alive server started")
-                    
-                    # Also start the self-pinger
-                    try:
-                        pinger_thread = start_self_pinger(interval_seconds=240)  # ping every 4 minutes
-                        logger.info("Self-pinger started")
-                    except Exception as e:
-                        logger.error(f"Could not start self-pinger: {e}")
                 except Exception as e:
-                    logger.error(f"Could not start keep_alive server: {e}")
+                    logger.error("Could not start keep_alive server: %s", e)
             
             # Run the bot with automatic reconnects enabled
-            bot.run(TOKEN, reconnect=True)
+            # (log_handler=None: discord.py's logs already go through our queue handler)
+            bot.run(TOKEN, reconnect=True, log_handler=None)
         except discord.errors.PrivilegedIntentsRequired:
             logger.error("\n===== ERROR: PRIVILEGED INTENTS REQUIRED =====")
             logger.error("You need to enable privileged intents in the Discord Developer Portal.")
@@ -382,5 +863,4 @@ if __name__ == "__main__":
             logger.error("\nIf you don't want to enable these intents, you will need to modify the code to not use them.")
             logger.error("===============================================")
         except Exception as e:
-            logger.error(f"Error starting bot: {e}")
-            traceback.print_exc() 
\ No newline at end of file
+            logger.exception("Error starting bot: %s", e) 
\ No newline at end of file
@@ -1,8 +1,16 @@
 #!/bin/bash
 # This script keeps the bot running even if it crashes
 
-echo "Installing dependencies..."
-pip install -r requirements.txt || python3 -m pip install -r requirements.txt
+# Only reinstall dependencies when requirements.txt changed since the last install
+REQUIREMENTS_HASH=$(sha256sum requirements.txt | cut -d' ' -f1)
+if [ "$REQUIREMENTS_HASH" != "$(cat .requirements.sha256 2>/dev/null)" ]; then
+  echo "Installing dependencies..."
+  if pip install -r requirements.txt || python3 -m pip install -r requirements.txt; then
+    echo "$REQUIREMENTS_HASH" > .requirements.sha256
+  fi
+else
+  echo "Dependencies unchanged, skipping install"
+fi
 
 echo "Starting Discord Role Bot with auto-restart..."
 
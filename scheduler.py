@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from metrics import Histogram
+
+SCHEDULER_WAIT_SECONDS = Histogram(
+    "rolebot_scheduler_wait_seconds", "Time role edits waited for a free slot in the guild scheduler.",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+)
+
+
+class SchedulerStats:
+    """Counters of the guild scheduler."""
+
+    def __init__(self):
+        self.started = 0  # edits that got a slot
+        self.queued = 0  # of those, edits that had to wait for it
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {
+            "started": self.started,
+            "queued": self.queued,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "max_wait": round(self.max_wait, 3),
+        }
+
+
+class GuildScheduler:
+    """
+    Shares a fixed number of concurrent role edits fairly between guilds.
+
+    At most ``concurrency`` edits run at once. Edits that find every slot
+    taken wait in their guild's queue, and a freed slot goes to the guilds
+    with waiting edits in turn, one edit each, so a guild with a thousand
+    queued edits delays a guild with one by at most one round, not by the
+    thousand. Within a guild, edits run in the order they were queued.
+
+    A guild's queue holds at most ``max_queued`` edits. The caller checks
+    ``has_room`` first and, when it's full, comes back after ``retry_delay``
+    seconds instead of queueing (the role edit queue keeps collecting that
+    member's changes meanwhile, like it does for the throttle).
+    """
+
+    def __init__(self, concurrency=8, max_queued=100, retry_delay=1.0):
+        self.concurrency = max(concurrency, 1)
+        self.max_queued = max(max_queued, 1)
+        self.retry_delay = retry_delay
+        self.running = 0
+        # guild_id -> deque of (queued at, future resolved when the slot is granted)
+        self._queues = {}
+        # Guilds with waiting edits, in the order they get their next slot
+        self._ring = deque()
+        self.stats = SchedulerStats()
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def has_room(self, guild_id):
+        queue = self._queues.get(guild_id)
+        return queue is None or len(queue) < self.max_queued
+
+    def busiest(self, limit=10):
+        """``(guild_id, queued edits, seconds the oldest has waited)`` of the guilds with the longest queues."""
+        now = time.monotonic()
+        guilds = [(guild_id, len(queue), now - queue[0][0]) for guild_id, queue in self._queues.items()]
+        guilds.sort(key=lambda guild: guild[1], reverse=True)
+        return guilds[:limit]
+
+    @asynccontextmanager
+    async def slot(self, guild_id):
+        """Hold one of the concurrent edit slots for ``guild_id`` while the block runs."""
+        await self._acquire(guild_id)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, guild_id):
+        if self.running < self.concurrency and not self._ring:
+            self.running += 1
+            self.stats.started += 1
+            SCHEDULER_WAIT_SECONDS.observe(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            queue = self._queues[guild_id] = deque()
+            self._ring.append(guild_id)
+        queue.append((time.monotonic(), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before being cancelled, give the slot to the next one
+                self._release()
+            # Otherwise the cancelled future stays queued and is skipped by _dispatch
+            raise
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.running < self.concurrency and self._ring:
+            guild_id = self._ring.popleft()
+            queue = self._queues[guild_id]
+            queued_at, future = queue.popleft()
+            if queue:
+                self._ring.append(guild_id)
+            else:
+                del self._queues[guild_id]
+            if future.done():
+                continue
+            self.running += 1
+            wait = now - queued_at
+            self.stats.started += 1
+            self.stats.queued += 1
+            self.stats.wait_seconds += wait
+            self.stats.max_wait = max(self.stats.max_wait, wait)
+            SCHEDULER_WAIT_SECONDS.observe(wait)
+            future.set_result(None)
@@ -0,0 +1,94 @@
+import os
+
+
+def shard_for_guild(guild_id, shard_count):
+    """The shard Discord delivers a guild's events to."""
+    return (guild_id >> 22) % shard_count
+
+
+def parse_shard_ids(text):
+    """Parse ``"0-3"``, ``"0,2,4"`` or a mix like ``"0-1,4"`` into a sorted list of IDs."""
+    shard_ids = set()
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        else:
+            shard_ids.add(int(part))
+    return sorted(shard_ids)
+
+
+def format_shard_ids(shard_ids):
+    return ",".join(str(shard_id) for shard_id in shard_ids)
+
+
+def split_shards(shard_count, processes):
+    """Split shards 0..shard_count-1 into ``processes`` contiguous, near-equal ranges."""
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        size = base + (1 if index < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+class ShardConfig:
+    """
+    Which shards this process runs, read from the environment.
+
+    ``SHARD_COUNT`` enables sharding (``auto`` lets Discord pick the count) and
+    ``SHARD_IDS`` limits this process to some of the shards, as set by
+    ``launcher.py``. Without ``SHARD_COUNT`` the bot runs unsharded.
+    """
+
+    def __init__(self, shard_count=None, shard_ids=None):
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+
+    @classmethod
+    def from_env(cls):
+        count = os.getenv('SHARD_COUNT', '').strip()
+        if not count:
+            return cls()
+        ids = os.getenv('SHARD_IDS', '').strip()
+        return cls(
+            shard_count=None if count == "auto" else int(count),
+            shard_ids=parse_shard_ids(ids) if ids else None,
+        )
+
+    @property
+    def enabled(self):
+        return self.shard_count is not None or self.shard_ids is not None
+
+    @property
+    def partitioned(self):
+        """True when other processes run the remaining shards."""
+        return self.shard_ids is not None and self.shard_count is not None
+
+    def owns_guild(self, guild_id):
+        """Whether this process receives the guild's events. Unknown guilds are kept."""
+        if guild_id is None or not self.partitioned:
+            return True
+        return shard_for_guild(guild_id, self.shard_count) in self.shard_ids
+
+    def bot_options(self):
+        """Extra keyword arguments for ``commands.AutoShardedBot``."""
+        options = {}
+        if self.shard_count is not None:
+            options["shard_count"] = self.shard_count
+        if self.shard_ids is not None:
+            options["shard_ids"] = self.shard_ids
+        return options
+
+    def describe(self):
+        if not self.enabled:
+            return "unsharded"
+        count = self.shard_count if self.shard_count is not None else "auto"
+        ids = format_shard_ids(self.shard_ids) if self.shard_ids is not None else "all"
+        return f"shards {ids} of {count}"
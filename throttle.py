@@ -0,0 +1,104 @@
+import time
+
+from metrics import Counter, Histogram
+
+THROTTLE_HITS = Counter("rolebot_throttle_hits", "Role edits postponed by a throttle, by the throttle that tripped.", ("scope",))
+THROTTLE_DELAY_SECONDS = Histogram(
+    "rolebot_throttle_delay_seconds", "How long a throttled role edit was postponed each time.",
+    buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+)
+
+
+class TokenBuckets:
+    """
+    One token bucket per key, refilling at ``rate`` tokens per second up to ``burst``.
+
+    Buckets are created on first use and forgotten once they've refilled, so
+    only keys that were active in the last ``burst / rate`` seconds take memory.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # key -> [tokens, last refill time]
+        self._buckets = {}
+        self._next_sweep = 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _refill(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait_time(self, key, now):
+        """Seconds until ``key`` has a token, 0 if it has one now."""
+        tokens = self._refill(key, now)[0]
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key, now):
+        """
+        Take a token, even one that hasn't refilled yet.
+
+        Returns the seconds until the token is actually available (0 if it is
+        now), so concurrent callers are handed consecutive slots instead of all
+        waking up for the next token.
+        """
+        bucket = self._refill(key, now)
+        bucket[0] -= 1
+        if now >= self._next_sweep:
+            self._sweep(now)
+        return -bucket[0] / self.rate if bucket[0] < 0 else 0.0
+
+    def _sweep(self, now):
+        full_after = self.burst / self.rate
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+        self._next_sweep = now + full_after
+
+
+class ReactionThrottle:
+    """
+    Per-member and per-guild limits on role edits.
+
+    Every role edit needs a token from the member's bucket and a slot from the
+    guild's bucket. A member toggling an emoji over and over can then only cost
+    a few edits before being slowed to ``member_rate``, and all of a guild's
+    members together can't use more than ``guild_rate`` of its shared REST
+    budget. A rate of 0 turns that limit off.
+    """
+
+    def __init__(self, member_rate=0.2, member_burst=3, guild_rate=5.0, guild_burst=10):
+        self.members = TokenBuckets(member_rate, member_burst) if member_rate > 0 else None
+        self.guilds = TokenBuckets(guild_rate, guild_burst) if guild_rate > 0 else None
+
+    def acquire(self, guild_id, user_id):
+        """
+        Take the tokens for one edit of a member's roles. Returns ``(granted, wait)``.
+
+        If the member is over their limit, nothing is taken and ``granted`` is
+        False: try again after ``wait`` seconds, the member's changes keep
+        collecting meanwhile. Otherwise the edit is granted and ``wait`` is how
+        long to hold it so the guild stays within its rate. Guild slots are
+        handed out in order, so a busy guild's edits queue up fairly.
+        """
+        now = time.monotonic()
+        if self.members is not None:
+            member_wait = self.members.wait_time((guild_id, user_id), now)
+            if member_wait:
+                THROTTLE_HITS.labels(scope="member").inc()
+                THROTTLE_DELAY_SECONDS.observe(member_wait)
+                return False, member_wait
+            self.members.take((guild_id, user_id), now)
+        guild_wait = self.guilds.take(guild_id, now) if self.guilds is not None else 0.0
+        if guild_wait:
+            THROTTLE_HITS.labels(scope="guild").inc()
+            THROTTLE_DELAY_SECONDS.observe(guild_wait)
+        return True, guild_wait